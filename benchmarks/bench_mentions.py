@@ -0,0 +1,65 @@
+"""Latency of the resolution of the users mentionned in a comment, before and after deduplicating and
+running the GitLab lookups concurrently. Each REST lookup is simulated with a fixed latency.
+
+Usage: python benchmarks/bench_mentions.py [--latency 0.05]
+"""
+
+import argparse
+import time
+from unittest import mock
+
+from gitlabnotifier.gitlab_api import invalidate_user_cache
+from gitlabnotifier.process_gitlab_notif import get_mentionned_user_emails
+
+
+def legacy_get_mentionned_user_emails(event, get_user_by_username):
+    """Implementation before concurrent lookups, kept for comparison."""
+    user_emails = set()
+    comment = event['object_attributes']['description']
+    if "@" in comment:
+        mentionned_user_names = [x.split(" ")[0] for x in comment.split("@")[1:]]
+        mentionned_user_names = [user_name for user_name in mentionned_user_names if user_name]
+        for user_name in mentionned_user_names:
+            users = get_user_by_username(user_name)
+            if users:
+                user_emails.add(users[0]["email"])
+    return user_emails
+
+
+def make_comment(mention_count: int) -> str:
+    # in real comments, the same people are often mentionned several times
+    distinct_count = max(1, mention_count // 2)
+    return " ".join(f"@user{i % distinct_count} please check" for i in range(mention_count))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.05, help="GitLab lookup latency (s)")
+    args = parser.parse_args()
+
+    def fake_get_user_by_username(username):
+        time.sleep(args.latency)
+        return [{"email": f"{username}@mycompany.com"}]
+
+    print(f"{'mentions':>8} {'legacy (s)':>11} {'new (s)':>8} {'speedup':>8}")
+    for mention_count in (1, 2, 5, 10, 20, 50, 100):
+        event = {'object_attributes': {'description': make_comment(mention_count)}}
+        start = time.perf_counter()
+        expected = legacy_get_mentionned_user_emails(event, fake_get_user_by_username)
+        legacy_duration = time.perf_counter() - start
+        invalidate_user_cache()
+        with mock.patch(
+            "gitlabnotifier.gitlab_api._get_user_by_username",
+            side_effect=fake_get_user_by_username
+        ):
+            start = time.perf_counter()
+            assert get_mentionned_user_emails(event) == expected
+            duration = time.perf_counter() - start
+        print(
+            f"{mention_count:>8} {legacy_duration:>11.3f} {duration:>8.3f} "
+            f"{legacy_duration / duration:>7.1f}x"
+        )
+
+
+if __name__ == '__main__':
+    main()
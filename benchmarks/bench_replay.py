@@ -0,0 +1,506 @@
+"""End-to-end benchmark: replays webhook payloads against the notifier, which talks to local
+stand-ins of GitLab and Slack with a configurable latency and error rate.
+
+Payloads are sent at a target rate (open loop: the latency of an event is measured from the time it
+was due to be sent, so a slow server isn't hidden by a slower sending). Once all the events are
+processed (according to the `/metrics` of the notifier, or once `gitlabnotifier serve` has shut
+down gracefully), the results are printed as JSON: throughput, latency percentiles, calls received
+by the stand-ins and memory of the notifier.
+
+Usage: python benchmarks/bench_replay.py [--rate 20] [--duration 10] [--output results.json]
+                                         [--corpus payloads.ndjson] [--env ASYNC_PROCESSING=true]
+                                         [--server serve --workers 4 --threads 32]
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+
+USER_COUNT = 50
+# users without a Slack account, their notifications go to the global channel
+UNMATCHED_USER_COUNT = 5
+PROJECT_ID = 1
+PROJECT = {
+    "id": PROJECT_ID,
+    "path_with_namespace": "group/project",
+    "web_url": "http://gitlab.local/group/project"
+}
+
+TRACE_LINE = b"tests/test_module.py::test_case_%08d PASSED" + b" " * 40 + b"[ 42%%]\n"
+TRACE_FAILURES = b"""=================================== FAILURES ===================================
+___________________________________ test_foo ___________________________________
+>       assert 1 == 2
+E       assert 1 == 2
+=========================== short test summary info ============================
+"""
+
+# (kind, weight) of the generated payloads: mostly comments, as on a real instance
+CORPUS_MIX = (("note", 60), ("approved", 10), ("merge", 10), ("assign", 10), ("pipeline", 10))
+
+
+def _user(user_id: int) -> Dict:
+    return {
+        "id": user_id,
+        "name": f"User {user_id}",
+        "username": f"user{user_id}",
+        "email": f"user{user_id}@mycompany.com"
+    }
+
+
+def _mr(iid: int) -> Dict:
+    return {
+        "iid": iid,
+        "title": f"Feature {iid}",
+        "url": f"{PROJECT['web_url']}/merge_requests/{iid}",
+        "action": None,
+        "assignee_id": None
+    }
+
+
+def _payload(kind: str, rng: random.Random) -> Dict:
+    user = _user(rng.randrange(USER_COUNT + UNMATCHED_USER_COUNT))
+    mr = _mr(rng.randrange(1, 20))
+    if kind == "note":
+        mentions = " ".join(f"@user{rng.randrange(USER_COUNT)}" for _ in range(rng.randrange(3)))
+        return {
+            "object_kind": "note",
+            "project_id": PROJECT_ID,
+            "project": PROJECT,
+            "user": user,
+            "merge_request": mr,
+            "object_attributes":
+                {
+                    "description": f"Could you have a look {mentions}? `@not_a_mention`",
+                    "url": f"{mr['url']}#note_{rng.randrange(10**6)}",
+                    # the stand-in of GitLab puts the author of the note in the discussion
+                    "discussion_id": f"{user['id']}-{rng.randrange(5)}",
+                }
+        }
+    if kind in ("approved", "merge", "assign"):
+        attributes = dict(mr, action="update" if kind == "assign" else kind)
+        changes = {}
+        if kind == "assign":
+            assignee = _user(rng.randrange(USER_COUNT))
+            attributes["assignee_id"] = assignee["id"]
+            changes = {"assignees": {"previous": [], "current": [assignee]}}
+        return {
+            "object_kind": "merge_request",
+            "project": PROJECT,
+            "user": user,
+            "object_attributes": attributes,
+            "changes": changes
+        }
+    job_id = rng.randrange(10**6)
+    builds = [
+        {"id": job_id, "name": "pytest", "stage": "test", "status": "failed"},
+        {"id": job_id + 1, "name": "flake8", "stage": "lint", "status": "success"},
+    ]  # yapf: disable
+    commit = {"id": "%040x" % rng.randrange(16**40), "url": f"{PROJECT['web_url']}/commit/0"}
+    return {
+        "object_kind": "pipeline",
+        "project": PROJECT,
+        "user": user,
+        "commit": commit,
+        "object_attributes": {"id": rng.randrange(10**6), "status": "failed"},
+        "builds": builds
+    }  # yapf: disable
+
+
+def generate_corpus(count: int, seed: int = 0) -> List[Dict]:
+    rng = random.Random(seed)
+    kinds, weights = zip(*CORPUS_MIX)
+    return [_payload(kind, rng) for kind in rng.choices(kinds, weights, k=count)]
+
+
+def load_corpus(path: str) -> List[Dict]:
+    """One payload per line, as recorded from GitLab webhooks."""
+    with open(path, encoding="utf-8") as corpus_file:
+        return [json.loads(line) for line in corpus_file if line.strip()]
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    # the default backlog of 5 connections resets connections under load
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class StubServer:
+    """Local HTTP server standing in for GitLab or Slack. `handler(method, path, body)` returns
+    `(status, headers, body)`, the body being bytes, an iterable of bytes or a JSON-serializable
+    object. Each response is delayed by `latency` seconds, and replaced by `error` with a probability
+    of `error_rate`. Calls are counted by `endpoint(path)`."""
+
+    def __init__(
+        self,
+        handler: Callable,
+        endpoint: Callable[[str], str],
+        latency: float,
+        error_rate: float,
+        error: Tuple[int, Dict, object],
+    ):
+        self.calls = Counter()
+        self.errors = 0
+        lock = threading.Lock()
+        rng = random.Random(0)
+        stub = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                time.sleep(latency)
+                with lock:
+                    stub.calls[endpoint(self.path)] += 1
+                    failed = rng.random() < error_rate
+                    stub.errors += failed
+                status, headers, response_body = error if failed else handler(
+                    self.command, self.path, body
+                )
+                if isinstance(response_body, (dict, list)):
+                    response_body = json.dumps(response_body).encode()
+                chunks = [response_body] if isinstance(response_body, bytes) else response_body
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for chunk in chunks:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                self.wfile.write(b"0\r\n\r\n")
+
+            do_GET = do_POST = _handle
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self.server = _HTTPServer(('localhost', 0), RequestHandler)
+        self.url = f"http://localhost:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def gitlab_stub(latency: float, error_rate: float, trace_mb: float) -> StubServer:
+    line_count = int(trace_mb * 1024 * 1024) // len(TRACE_LINE % 0)
+
+    def trace():
+        batch = 10000
+        for start in range(0, line_count, batch):
+            yield b"".join(TRACE_LINE % i for i in range(start, min(start + batch, line_count)))
+        yield TRACE_FAILURES
+
+    def handler(_method, path, _body):
+        path = path.split("/api/v4/", 1)[1]
+        if match := re.fullmatch(r"users/(\d+)", path):
+            return 200, {}, _user(int(match.group(1)))
+        if match := re.fullmatch(r"users\?username=user(\d+)", path):
+            return 200, {}, [_user(int(match.group(1)))]
+        if path.startswith("users?username="):
+            return 200, {}, []
+        if re.fullmatch(r"projects/\d+/jobs/\d+/trace", path):
+            return 200, {}, trace()
+        if match := re.fullmatch(r"projects/\d+/merge_requests/(\d+)/?", path):
+            return 200, {}, {"iid": int(match.group(1)), "author": _user(int(match.group(1)))}
+        if match := re.fullmatch(r"projects/\d+/merge_requests/(\d+)/participants", path):
+            return 200, {}, [_user(int(match.group(1)) + i) for i in range(3)]
+        if match := re.fullmatch(r"projects/\d+/merge_requests/(\d+)/discussions/(\d+)-\d+", path):
+            user_ids = {int(match.group(2))} | {int(match.group(1)) + i for i in range(3)}
+            return 200, {}, {"notes": [{"author": _user(user_id)} for user_id in user_ids]}
+        return 404, {}, {"message": "404 Not Found"}
+
+    def endpoint(path):
+        path = re.sub(r"\d+", "N", path.split("?")[0].split("/api/v4/", 1)[1])
+        return re.sub(r"discussions/[^/]+", "discussions/ID", path)
+
+    return StubServer(handler, endpoint, latency, error_rate, (503, {}, {"message": "unavailable"}))
+
+
+def slack_stub(latency: float, error_rate: float, directory_latency: float = 0.) -> StubServer:
+    """`directory_latency` is the additional latency of `users.list`, e.g. for a large workspace."""
+
+    def handler(_method, path, body):
+        if path.endswith("/conversations.open"):
+            user_id = json.loads(body)["users"]
+            return 200, {}, {"ok": True, "channel": {"id": "D" + user_id[1:]}}
+        if path.endswith("/users.list"):
+            time.sleep(directory_latency)
+            members = [
+                {
+                    "id": f"U{i:06d}",
+                    "name": f"user{i}",
+                    "deleted": False,
+                    "profile": {
+                        "email": _user(i)["email"]
+                    }
+                } for i in range(USER_COUNT)
+            ]
+            return 200, {}, {
+                "ok": True,
+                "members": members,
+                "response_metadata": {
+                    "next_cursor": ""
+                }
+            }
+        return 200, {}, {"ok": True}
+
+    def endpoint(path):
+        return path.rsplit("/", 1)[-1]
+
+    return StubServer(
+        handler, endpoint, latency, error_rate,
+        (429, {
+            "Retry-After": "1"
+        }, {
+            "ok": False,
+            "error": "ratelimited"
+        })
+    )
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def start_notifier(
+    gitlab_url: str,
+    slack_url: str,
+    env: Dict[str, str],
+    server: str = "flask",
+    workers: int = 2,
+    threads: int = 32,
+    log_path: str = os.devnull
+) -> Tuple[subprocess.Popen, str]:
+    port = _free_port()
+    server_env = dict(
+        os.environ,
+        # the stand-in of Slack doesn't rate limit
+        SLACK_RATE_LIMIT="1000",
+        SLACK_RATE_LIMIT_BURST="1000",
+        FLASK_APP="gitlabnotifier/app.py",
+        FLASK_ENV="production",
+        GITLAB_BASE_URL=gitlab_url,
+        GITLAB_TOKEN="benchmark",
+        SLACK_API_TOKEN="benchmark",
+        SLACK_API_URL=f"{slack_url}/api/",
+        PYTHONPATH=os.getcwd(),
+    )
+    server_env.update(env)
+    if server == "flask":
+        command = ["-m", "flask", "run", "--port", str(port), "--no-reload"]
+    else:
+        command = ["-m", "gitlabnotifier", "serve", "--host", "localhost", "--port", str(port)]
+        command += ["--workers", str(workers), "--threads", str(threads)]
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        process = subprocess.Popen(
+            [sys.executable] + command, env=server_env, stdout=log_file, stderr=subprocess.STDOUT
+        )
+    url = f"http://localhost:{port}"
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            requests.get(f"{url}/metrics", timeout=1).raise_for_status()
+            return process, url
+        except requests.RequestException:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError("The notifier did not start.")
+            time.sleep(0.1)
+
+
+def _read_proc_kb(path: str, field: str) -> int:
+    with open(path, encoding="utf-8") as proc_file:
+        for line in proc_file:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return 0
+
+
+def measure_memory(pid: int) -> Optional[Dict[str, float]]:
+    """Memory of a process and its children (the workers of `serve`), only available on Linux.
+    `peak_rss` counts the memory shared by the processes once per process, `pss` (proportional set
+    size, current) divides it between them."""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", encoding="utf-8") as children:
+            pids = [pid] + [int(child) for child in children.read().split()]
+        return {
+            "peak_rss": sum(_read_proc_kb(f"/proc/{pid}/status", "VmHWM:") for pid in pids) / 1024,
+            "pss": sum(_read_proc_kb(f"/proc/{pid}/smaps_rollup", "Pss:") for pid in pids) / 1024,
+            "processes": len(pids),
+        }
+    except OSError:
+        return None
+
+
+def processed_event_count(url: str) -> int:
+    metrics = requests.get(f"{url}/metrics", timeout=5).text
+    return sum(
+        int(float(line.rsplit(" ", 1)[1]))
+        for line in metrics.split("\n")
+        if line.startswith("gitlabnotifier_events_total{")
+    )
+
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def replay(url: str, payloads: List[Dict], rate: float, concurrency: int) -> Dict:
+    """Send the payloads at `rate` events per second, returns the latencies and statuses."""
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    bodies = [json.dumps(payload).encode() for payload in payloads]
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def send(index: int, due: float):
+        headers = {"Content-Type": "application/json", "X-Gitlab-Event-UUID": f"replay-{index}"}
+        try:
+            status = session.post(url, data=bodies[index], headers=headers, timeout=300).status_code
+        except requests.RequestException:
+            status = "error"
+        with lock:
+            latencies.append(time.monotonic() - due)
+            statuses[status] += 1
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index in range(len(bodies)):
+            due = start + index / rate
+            time.sleep(max(0., due - time.monotonic()))
+            executor.submit(send, index, due)
+    return {"latencies": latencies, "statuses": statuses, "duration": time.monotonic() - start}
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=float, default=20, help="events per second")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of replay")
+    parser.add_argument('--concurrency', type=int, default=64, help="maximum pending requests")
+    parser.add_argument('--corpus', help="NDJSON file of payloads, generated if not given")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gitlab-latency', type=float, default=0.02, help="seconds")
+    parser.add_argument('--slack-latency', type=float, default=0.05, help="seconds")
+    parser.add_argument('--error-rate', type=float, default=0.01, help="of the stand-ins calls")
+    parser.add_argument('--trace-mb', type=float, default=20, help="size of the job traces")
+    parser.add_argument('--timeout', type=float, default=300, help="to process all the events")
+    parser.add_argument(
+        '--env',
+        action='append',
+        default=[],
+        metavar="NAME=VALUE",
+        help="configuration of the notifier, e.g. ASYNC_PROCESSING=true"
+    )
+    parser.add_argument(
+        '--server',
+        choices=["flask", "serve"],
+        default="flask",
+        help="`flask run`, or `gitlabnotifier serve` (gunicorn)"
+    )
+    parser.add_argument('--workers', type=int, default=2, help="processes of `serve`")
+    parser.add_argument('--threads', type=int, default=32, help="threads per process of `serve`")
+    parser.add_argument('--log', default=os.devnull, help="file of the logs of the notifier")
+    parser.add_argument('--output', help="JSON file of the results, printed if not given")
+    args = parser.parse_args()
+
+    event_count = int(args.rate * args.duration)
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+        payloads = [corpus[i % len(corpus)] for i in range(event_count)]
+    else:
+        payloads = generate_corpus(event_count, args.seed)
+    env = dict(item.split("=", 1) for item in args.env)
+
+    gitlab = gitlab_stub(args.gitlab_latency, args.error_rate, args.trace_mb)
+    slack = slack_stub(args.slack_latency, args.error_rate)
+    server, url = start_notifier(
+        gitlab.url, slack.url, env, args.server, args.workers, args.threads, args.log
+    )
+    processed = None
+    try:
+        start = time.monotonic()
+        results = replay(url, payloads, args.rate, args.concurrency)
+        memory = measure_memory(server.pid)
+        if args.server == "flask":
+            # with ASYNC_PROCESSING, events are still being processed
+            deadline = time.monotonic() + args.timeout
+            while processed_event_count(url) < event_count and time.monotonic() < deadline:
+                time.sleep(0.1)
+            processed = processed_event_count(url)
+        else:
+            # each worker has its own metrics, the events are all processed once the workers
+            # have shut down gracefully
+            server.terminate()
+            server.wait(args.timeout)
+        total_duration = time.monotonic() - start
+    finally:
+        server.terminate()
+        server.wait()
+        gitlab.close()
+        slack.close()
+
+    latencies = sorted(results["latencies"])
+    report = {
+        "revision": _git_revision(),
+        "config": dict(vars(args), env=env),
+        "events": event_count,
+        "processed_events": processed,
+        "event_kinds": Counter(
+            payload.get("object_attributes", {}).get("action") or payload["object_kind"]
+            for payload in payloads
+        ),
+        "statuses": {str(status): count for status, count in results["statuses"].items()},
+        "duration": total_duration,
+        "throughput": event_count / total_duration,
+        "latency": {
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else None,
+        },
+        "gitlab_calls": dict(gitlab.calls),
+        "gitlab_errors": gitlab.errors,
+        "slack_calls": dict(slack.calls),
+        "slack_errors": slack.errors,
+        "memory_mb": memory,
+    }  # yapf: disable
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
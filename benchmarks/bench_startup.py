@@ -0,0 +1,95 @@
+"""Startup time of the notifier, without (cold) and with (warm) a snapshot of its warm state.
+
+The stand-in of Slack answers `users.list` after `--directory-latency` seconds, like a large
+workspace whose directory takes many pages to fetch. For each start, the results give the time until
+the notifier answers HTTP requests, and until it notified a first comment (processed before
+answering). The warm start loads the snapshot saved when the cold one was stopped.
+
+Usage: PYTHONPATH=. python benchmarks/bench_startup.py [--directory-latency 3] [--server serve]
+"""
+
+import argparse
+import json
+import os
+import random
+import signal
+import tempfile
+import time
+from typing import Dict
+
+import requests
+from bench_replay import (_git_revision, _payload, gitlab_stub, slack_stub,
+                          start_notifier)
+
+
+def measure_start(gitlab, slack, env: Dict[str, str], args: argparse.Namespace) -> Dict:
+    gitlab.calls.clear()
+    slack.calls.clear()
+    payload = _payload("note", random.Random(args.seed))
+    start = time.monotonic()
+    server, url = start_notifier(
+        gitlab.url, slack.url, env, args.server, args.workers, args.threads, args.log
+    )
+    try:
+        ready = time.monotonic() - start
+        status = requests.post(url, json=payload, timeout=300).status_code
+        first_notification = time.monotonic() - start
+    finally:
+        # the snapshot is saved on exit, `flask run` only exits gracefully on SIGINT
+        server.send_signal(signal.SIGINT if args.server == "flask" else signal.SIGTERM)
+        server.wait(60)
+    return {
+        "ready": ready,
+        "first_notification": first_notification,
+        "status": status,
+        "gitlab_calls": dict(gitlab.calls),
+        "slack_calls": dict(slack.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--directory-latency', type=float, default=3, help="seconds to fetch the Slack directory"
+    )
+    parser.add_argument('--gitlab-latency', type=float, default=0.02, help="seconds")
+    parser.add_argument('--slack-latency', type=float, default=0.05, help="seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--server', choices=["flask", "serve"], default="flask")
+    parser.add_argument('--workers', type=int, default=2, help="processes of `serve`")
+    parser.add_argument('--threads', type=int, default=32, help="threads per process of `serve`")
+    parser.add_argument('--log', default=os.devnull, help="file of the logs of the notifier")
+    parser.add_argument('--output', help="JSON file of the results, printed if not given")
+    args = parser.parse_args()
+
+    gitlab = gitlab_stub(args.gitlab_latency, error_rate=0, trace_mb=0)
+    slack = slack_stub(args.slack_latency, error_rate=0, directory_latency=args.directory_latency)
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_path = os.path.join(tmp_dir, "snapshot.json.gz")
+            env = {"SNAPSHOT_PATH": snapshot_path}
+            cold = measure_start(gitlab, slack, env, args)
+            snapshot_size = os.path.getsize(snapshot_path
+                                           ) if os.path.exists(snapshot_path) else None
+            warm = measure_start(gitlab, slack, env, args)
+    finally:
+        gitlab.close()
+        slack.close()
+
+    report = {
+        "revision": _git_revision(),
+        "config": vars(args),
+        "snapshot_bytes": snapshot_size,
+        "cold": cold,
+        "warm": warm,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Peak memory used to extract the pytest failures of a large job trace, before and after streaming
+the trace. A synthetic trace is served by a local HTTP server standing in for GitLab, each extraction
+runs in its own process to measure its peak RSS.
+
+Usage: python benchmarks/bench_trace_memory.py [--size-mb 300]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOG_LINE = b"tests/test_module.py::test_case_%08d PASSED" + b" " * 40 + b"[ 42%%]\n"
+FAILURES = b"""=================================== FAILURES ===================================
+___________________________________ test_foo ___________________________________
+>       assert 1 == 2
+E       assert 1 == 2
+=========================== short test summary info ============================
+"""
+
+
+def serve_trace(size_mb: int) -> ThreadingHTTPServer:
+    line_count = size_mb * 1024 * 1024 // len(LOG_LINE % 0)
+
+    class TraceHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            self.send_response(200)
+            self.send_header('Content-Length', str(line_count * len(LOG_LINE % 0) + len(FAILURES)))
+            self.end_headers()
+            batch = 10000
+            for start in range(0, line_count, batch):
+                self.wfile.write(
+                    b"".join(LOG_LINE % i for i in range(start, min(start + batch, line_count)))
+                )
+            self.wfile.write(FAILURES)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = ThreadingHTTPServer(('localhost', 0), TraceHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def legacy_extract_pytest_fails(trace):
+    """Implementation before streaming, kept for comparison."""
+    failures_block = False
+    for line in trace.split('\n'):
+        if line.startswith('=================================== FAILURES'):
+            failures_block = True
+            continue
+        elif failures_block and line.startswith('======================'):
+            failures_block = False
+        if failures_block:
+            yield line
+
+
+def extract(mode: str):
+    """Run in a child process, with `GITLAB_BASE_URL` pointing to the local server."""
+    # pylint: disable=import-outside-toplevel
+    from gitlabnotifier import process_gitlab_notif
+    from gitlabnotifier.gitlab_api import get_job_trace
+
+    start = time.perf_counter()
+    if mode == 'legacy':
+        details = "\n".join(legacy_extract_pytest_fails(get_job_trace(1, 1)))
+    else:
+        details = process_gitlab_notif.get_job_error_details(
+            1, {
+                'id': 1,
+                'stage': 'test',
+                'name': 'pytest'
+            }
+        )
+    duration = time.perf_counter() - start
+    assert "assert 1 == 2" in details
+    # ru_maxrss is in KB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"mode": mode, "duration": duration, "peak_rss_mb": peak_rss_mb}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=300, help="size of the synthetic trace")
+    parser.add_argument('--mode', choices=['legacy', 'streaming'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.mode:
+        extract(args.mode)
+        return
+
+    server = serve_trace(args.size_mb)
+    env = dict(os.environ, GITLAB_BASE_URL=f"http://localhost:{server.server_port}")
+    print(f"trace of {args.size_mb} MB")
+    print(f"{'mode':>10} {'duration (s)':>13} {'peak RSS (MB)':>14}")
+    for mode in ('legacy', 'streaming'):
+        output = subprocess.run(
+            [sys.executable, __file__, '--mode', mode], env=env, check=True, stdout=subprocess.PIPE
+        ).stdout
+        result = json.loads(output.decode().strip().split('\n')[-1])
+        print(f"{mode:>10} {result['duration']:>13.2f} {result['peak_rss_mb']:>14.1f}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
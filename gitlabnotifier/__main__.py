@@ -0,0 +1,3 @@
+from gitlabnotifier.cli import main
+
+main()
@@ -1,19 +1,59 @@
+import atexit
+import functools
+import hashlib
 import json
 import logging
+import os
 
 from flask import Flask, Response, jsonify, request
-from werkzeug.exceptions import Forbidden
+from slack.signature import SignatureVerifier
+from werkzeug.exceptions import Forbidden, NotFound
 
-from gitlabnotifier.constants import (DEV_CHANEL, FLASK_ENV, GLOBAL_CHANEL,
+from gitlabnotifier.constants import (ASYNC_PROCESSING, DEV_CHANEL,
+                                      DIGEST_IMMEDIATE_KINDS, DIGEST_MAX_DELAY,
+                                      DIGEST_WINDOW, EVENT_MAX_ATTEMPTS,
+                                      EVENT_RETRY_DELAY,
+                                      EVENT_STORE_BATCH_SIZE,
+                                      EVENT_STORE_LEASE,
+                                      EVENT_STORE_MAINTENANCE_INTERVAL,
+                                      EVENT_STORE_PATH, EVENT_STORE_RETENTION,
+                                      FLASK_ENV, GLOBAL_CHANEL,
+                                      PARTITION_QUEUE_SIZE, QUEUE_SIZE,
+                                      SHUTDOWN_TIMEOUT,
+                                      SLACK_DELIVERY_CONCURRENCY,
+                                      SLACK_DIRECTORY_REFRESH_INTERVAL,
+                                      SLACK_SIGNING_SECRET, SNAPSHOT_INTERVAL,
+                                      SNAPSHOT_PATH, WORKER_COUNT,
                                       X_GITLAB_TOKEN)
-from gitlabnotifier.process_gitlab_notif import \
-    get_messages_and_emails_from_event
-from gitlabnotifier.slack_api import EMAIL_TO_SLACK_NAME, slack_message
+from gitlabnotifier.digest import DigestBuffer, get_digest_key
+from gitlabnotifier.discussion_index import discussion_index
+from gitlabnotifier.event_filter import should_drop
+from gitlabnotifier.event_store import EventStore
+from gitlabnotifier.gitlab_api import (get_user_cache_stats, gitlab_breaker,
+                                       gitlab_limiter, gitlab_traces_breaker,
+                                       gitlab_traces_limiter,
+                                       invalidate_user_cache)
+from gitlabnotifier.metrics import (EVENT_DURATION, EVENTS, NOTIFICATIONS,
+                                    REGISTRY, gauge)
+from gitlabnotifier.mr_store import mr_store
+from gitlabnotifier.process_gitlab_notif import (
+    get_event_priority, get_messages_and_emails_from_event, get_partition_key)
+from gitlabnotifier.resilience import priority
+from gitlabnotifier.slack_api import (EMAIL_TO_SLACK_ID, slack_breaker,
+                                      slack_client, slack_direct_message,
+                                      slack_direct_messages, slack_message)
+from gitlabnotifier.snapshot import SnapshotSaver, load_snapshot
+from gitlabnotifier.tracing import tracer
+from gitlabnotifier.worker import WorkerPool
 
 app = Flask(__name__)
 
+# https://docs.gitlab.com/ee/administration/system_hooks.html, the users whose cached lookups are
+# outdated: a new user may have been cached as an unknown username
+USER_SYSTEM_HOOK_EVENTS = {"user_create", "user_rename", "user_destroy"}
 
-def process_notification(event):
+
+def process_notification(event, event_id=None):
     message, user_emails = get_messages_and_emails_from_event(event)
     if FLASK_ENV == 'development':
         message['attachments'] = message.get("attachments", []) + [{"text": json.dumps(event)}]
@@ -26,19 +66,36 @@ def process_notification(event):
 
     user_emails_not_matched = set()
     print(f"user_emails = {user_emails}")
+    slack_user_ids = {}
     for user_email in user_emails:
-        slack_username = EMAIL_TO_SLACK_NAME.get(user_email)
-        if not slack_username:
+        slack_user_id = EMAIL_TO_SLACK_ID.get(user_email)
+        if not slack_user_id:
             user_emails_not_matched.add(user_email)
         else:
-            res_slack_user = slack_message(message, slack_username)
-            print(f"Tried sending to {slack_username}, response: {res_slack_user}")
-            if res_slack_user['ok']:
-                yield message
-            else:
-                user_emails_not_matched.add(user_email)
+            slack_user_ids[user_email] = slack_user_id
+
+    digest_key = get_digest_key(event, DIGEST_IMMEDIATE_KINDS) if DIGEST_WINDOW > 0 else None
+    if digest_key is not None:
+        # the digests are sent later, a failure to send them is only logged. The event is only done
+        # once they are sent, see `ack_event`
+        for slack_user_id in set(slack_user_ids.values()):
+            digest_buffer.add(slack_user_id, digest_key, dict(message), event_id)
+            NOTIFICATIONS.labels("digest").inc()
+            yield message
+        slack_user_ids = {}
+
+    responses = slack_direct_messages(message, set(slack_user_ids.values()))
+    for user_email, slack_user_id in slack_user_ids.items():
+        res_slack_user = responses[slack_user_id]
+        print(f"Tried sending to {slack_user_id}, response: {res_slack_user}")
+        if res_slack_user['ok']:
+            NOTIFICATIONS.labels("sent").inc()
+            yield message
+        else:
+            user_emails_not_matched.add(user_email)
 
     if user_emails_not_matched:
+        NOTIFICATIONS.labels("unmatched").inc(len(user_emails_not_matched))
         message['text'] += f" (user emails {user_emails_not_matched} " \
                            f"do not match a slack username !)"
         res_slack_global = slack_message(message, GLOBAL_CHANEL)
@@ -48,24 +105,306 @@ def process_notification(event):
         yield message
 
 
+def handle_event(event, event_id=None):
+    mr_store.update_from_event(event)
+    object_kind = event.get('object_kind', 'unknown')
+    try:
+        with EVENT_DURATION.labels(object_kind).time(), priority(get_event_priority(event)), \
+                tracer.trace("event", payload=event, object_kind=object_kind):
+            msgs = list(process_notification(event, event_id))
+    except Exception:
+        EVENTS.labels(object_kind, "failed").inc()
+        raise
+    EVENTS.labels(object_kind, "processed").inc()
+    if msgs:
+        print(msgs)
+
+
+def handle_queued_event(queued_event):
+    event_id, event, attempt = queued_event
+    try:
+        handle_event(event, event_id)
+    except Exception:
+        if attempt < EVENT_MAX_ATTEMPTS:
+            # e.g. while the circuit of GitLab or Slack is open, see `resilience.py`
+            delay = EVENT_RETRY_DELAY * 2**(attempt - 1)
+            logging.exception(f"Failed to process an event, it will be retried in {delay:.0f}s.")
+            worker_pool.retry((event_id, event, attempt + 1), delay)
+            return
+        if event_id is not None:
+            event_store.failed(event_id)
+        raise
+    if event_id is not None:
+        ack_event(event_id)
+
+
+def ack_event(event_id):
+    """Mark a processed event as done in the event store, once its digests are sent."""
+    digest_buffer.ack(event_id, functools.partial(event_store.done, event_id))
+
+
+def recover_event(event_id, payload):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        # stored before the payload was validated: it would be recovered again on every start
+        logging.exception(f"Failed to decode the stored event {event_id}.")
+        event_store.failed(event_id)
+        return
+    worker_pool.submit((event_id, event, 1), block=True)
+
+
+snapshot_saver = None
+if SNAPSHOT_PATH:
+    snapshot_saver = SnapshotSaver(SNAPSHOT_PATH, SNAPSHOT_INTERVAL)
+    # registered first, so called last: the state after the processing of the last events is saved
+    atexit.register(snapshot_saver.save)
+
+event_store = None
+if EVENT_STORE_PATH:
+    event_store = EventStore(
+        EVENT_STORE_PATH,
+        batch_size=EVENT_STORE_BATCH_SIZE,
+        lease=EVENT_STORE_LEASE,
+        retention=EVENT_STORE_RETENTION,
+        maintenance_interval=EVENT_STORE_MAINTENANCE_INTERVAL,
+        on_recovered=recover_event,
+    )
+    # registered before the pool, so called after it: the events processed by the pool on shutdown
+    # are then marked as done
+    atexit.register(event_store.close, timeout=SHUTDOWN_TIMEOUT)
+
+digest_buffer = DigestBuffer(
+    slack_direct_message,
+    window=DIGEST_WINDOW,
+    max_delay=DIGEST_MAX_DELAY,
+    concurrency=SLACK_DELIVERY_CONCURRENCY
+)
+# registered before the pool, so called after it: the digests of the events processed by the pool
+# on shutdown are sent
+atexit.register(digest_buffer.flush, force=True)
+
+worker_pool = WorkerPool(
+    handle_queued_event,
+    worker_count=WORKER_COUNT,
+    queue_size=QUEUE_SIZE,
+    # queued events are (event ID, event, attempt)
+    partition_key=lambda queued_event: get_partition_key(queued_event[1]),
+    partition_size=PARTITION_QUEUE_SIZE,
+)
+atexit.register(worker_pool.shutdown, timeout=SHUTDOWN_TIMEOUT)
+
+_warm_state_loaded = False
+
+
+def load_warm_state():
+    """Load the snapshot of the warm state, once: `gitlabnotifier serve` loads it before forking its
+    workers, so that they share its memory."""
+    global _warm_state_loaded  # pylint: disable=global-statement
+    if SNAPSHOT_PATH and not _warm_state_loaded:
+        load_snapshot(SNAPSHOT_PATH)
+    _warm_state_loaded = True
+
+
+def load_slack_directory():
+    """Fetch the Slack directory if the snapshot didn't have it: `gitlabnotifier serve` calls this
+    before forking its workers, so that they share the directory instead of each fetching it. A
+    directory loaded from the snapshot is revalidated by each worker in the background, not to delay
+    the start."""
+    if FLASK_ENV != 'development' and slack_client is not None and not EMAIL_TO_SLACK_ID.loaded:
+        EMAIL_TO_SLACK_ID.try_refresh()
+
+
+def start_background_tasks():
+    """Start the threads of the process. Threads don't survive a fork, so this is called again in
+    each worker forked by `gitlabnotifier serve`."""
+    load_warm_state()
+    if snapshot_saver is not None:
+        snapshot_saver.start()
+    if event_store is not None:
+        # claims the events that were not processed before the last shutdown
+        event_store.start()
+    if FLASK_ENV != 'development' and slack_client is not None:
+        EMAIL_TO_SLACK_ID.start_background_refresh(SLACK_DIRECTORY_REFRESH_INTERVAL)
+
+
+# `gitlabnotifier serve` imports the app once before forking its workers, to share the warm state
+# between them. The threads are then started in the workers only.
+if not os.environ.get('GITLABNOTIFIER_PRELOAD'):
+    start_background_tasks()
+
+
+def _user_cache_hit_ratio():
+    stats = get_user_cache_stats()
+    total = stats["hits"] + stats["misses"]
+    return stats["hits"] / total if total else 0.
+
+
+gauge(
+    "gitlabnotifier_queue_depth", "Events waiting to be processed.", lambda: worker_pool.queue_depth
+)
+gauge(
+    "gitlabnotifier_queue_partitions", "MRs and pipelines with events waiting or being processed.",
+    lambda: worker_pool.partition_count
+)
+gauge(
+    "gitlabnotifier_user_cache_hit_ratio", "Hit ratio of the GitLab user cache.",
+    _user_cache_hit_ratio
+)
+gauge(
+    "gitlabnotifier_user_cache_size", "Users in the GitLab user cache.",
+    lambda: get_user_cache_stats()["size"]
+)
+gauge(
+    "gitlabnotifier_slack_directory_size", "Emails in the Slack directory.",
+    lambda: len(EMAIL_TO_SLACK_ID)
+)
+gauge(
+    "gitlabnotifier_mr_store_hit_ratio", "Ratio of the MR lookups answered without calling GitLab.",
+    lambda: mr_store.hit_ratio
+)
+gauge("gitlabnotifier_mr_store_size", "MRs in the MR store.", lambda: len(mr_store))
+gauge(
+    "gitlabnotifier_discussion_index_hit_ratio",
+    "Ratio of the comments whose discussion wasn't fetched from GitLab.",
+    lambda: discussion_index.hit_ratio
+)
+gauge(
+    "gitlabnotifier_discussion_index_size", "Discussions in the discussion index.",
+    lambda: len(discussion_index)
+)
+gauge(
+    "gitlabnotifier_digest_pending", "Digests waiting to be sent.",
+    lambda: digest_buffer.pending_count
+)
+for breaker in (gitlab_breaker, gitlab_traces_breaker, slack_breaker):
+    gauge(
+        f"gitlabnotifier_{breaker.name}_circuit_open",
+        f"1 while the circuit of {breaker.name} is open or half-open.",
+        lambda breaker=breaker: float(breaker.is_open)
+    )
+for limiter in (gitlab_limiter, gitlab_traces_limiter):
+    gauge(
+        f"gitlabnotifier_{limiter.name}_concurrency_limit",
+        f"Current limit of the concurrent calls to {limiter.name}.",
+        lambda limiter=limiter: limiter.limit
+    )
+    gauge(
+        f"gitlabnotifier_{limiter.name}_waiting_calls",
+        f"Calls to {limiter.name} waiting for the concurrency limit.",
+        lambda limiter=limiter: limiter.waiting_count
+    )
+
+
 @app.before_request
 def check_token():
+    if request.endpoint == 'metrics_route':
+        # scraped by Prometheus, which doesn't send GitLab's token
+        return
+    if request.endpoint == 'slack_events_route':
+        # sent by Slack, which signs its requests instead
+        return
     header_token = request.headers.get('x-gitlab-token')
     if X_GITLAB_TOKEN is not None and header_token != X_GITLAB_TOKEN:
         raise Forbidden('Missing or invalid x-gitlab-token header.')
 
 
+def store_event():
+    """Store the event of the request, returns its ID, or None if it was already received."""
+    body = request.get_data()
+    # GitLab sends the same UUID when it delivers a webhook again
+    event_uuid = request.headers.get('X-Gitlab-Event-UUID') or hashlib.sha256(body).hexdigest()
+    return event_store.add(event_uuid, body)
+
+
+def handle_user_system_hook(event):
+    # without a user nor a username, `invalidate_user_cache` clears the whole cache
+    if event.get('user_id') is not None or event.get('username'):
+        invalidate_user_cache(user_id=event.get('user_id'), username=event.get('username'))
+    if event.get('old_username'):
+        invalidate_user_cache(username=event['old_username'])
+
+
 @app.route("/", methods=["POST"])
 def post_route():
-    event = request.json
+    if request.headers.get('X-Gitlab-Event') == 'System Hook':
+        event = request.get_json(silent=True)
+        if isinstance(event, dict) and event.get('event_name') in USER_SYSTEM_HOOK_EVENTS:
+            handle_user_system_hook(event)
+            return "User cache invalidated."
+    if should_drop(request.headers.get('X-Gitlab-Event'), request.get_data()):
+        return "Event ignored."
+    # decoded before it is stored, so that only the events that can be processed are recovered
+    event = request.get_json(silent=True)
+    if not isinstance(event, dict):
+        return Response("Invalid event.", status=400)
+    event_id = None
+    if event_store is not None:
+        event_id = store_event()
+        if event_id is None:
+            return "Event already received."
     if FLASK_ENV == 'development':
         print(json.dumps(event, indent=4))
-    msgs = list(process_notification(event))
-    if msgs:
-        print(msgs)
+    if ASYNC_PROCESSING:
+        if not worker_pool.submit((event_id, event, 1)):
+            if event_id is not None:
+                # so that the event is accepted when GitLab delivers it again
+                event_store.discard(event_id)
+            return Response("Event queue is full.", status=503)
+        return Response("Event queued.", status=202)
+    try:
+        handle_event(event, event_id)
+    except Exception:
+        if event_id is not None:
+            event_store.discard(event_id)
+        raise
+    if event_id is not None:
+        ack_event(event_id)
     return "Event processed."
 
 
+@app.route("/metrics")
+def metrics_route():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/admin/user-cache/invalidate", methods=["POST"])
+def invalidate_user_cache_route():
+    """Forget a cached user, e.g. after an email change, which GitLab has no system hook for:
+    `{"user_id": 12}` or `{"username": "alice"}`, or all of them without a body."""
+    body = request.get_json(silent=True) or {}
+    invalidate_user_cache(user_id=body.get('user_id'), username=body.get('username'))
+    return "User cache invalidated."
+
+
+SLACK_USER_EVENTS = {"user_change", "team_join"}
+
+
+@app.route("/slack/events", methods=["POST"])
+def slack_events_route():
+    """Slack's Events API: the users changed on Slack are updated in the Slack directory, instead of
+    waiting for its next refresh."""
+    if SLACK_SIGNING_SECRET is None:
+        raise NotFound()
+    if not SignatureVerifier(SLACK_SIGNING_SECRET
+                            ).is_valid_request(request.get_data(), request.headers):
+        raise Forbidden('Missing or invalid Slack signature.')
+    body = request.get_json(silent=True) or {}
+    if body.get('type') == 'url_verification':
+        # sent once, when the URL is set in the settings of the Slack app
+        return jsonify(challenge=body.get('challenge'))
+    event = body.get('event') or {}
+    if event.get('type') in SLACK_USER_EVENTS and isinstance(event.get('user'), dict):
+        EMAIL_TO_SLACK_ID.update_user(event['user'])
+    return ""
+
+
+@app.route("/debug/slow-events")
+def slow_events_route():
+    """The last events slower than `SLOW_EVENT_THRESHOLD` processed by this process, latest first."""
+    return jsonify(tracer.get_slow_events())
+
+
 @app.route("/")
 def get_route():
     return jsonify({"message": "dummy"})
@@ -0,0 +1,74 @@
+"""Bounded in-process cache with TTL expiration and LRU eviction."""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Tuple
+
+_MISSING = object()
+
+
+class TTLCache:
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        """`ttl` is in seconds, entries never expire if it is None (the cache is then a plain LRU)."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expiration time, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING, count=False) is not _MISSING
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def get(self, key: Hashable, default: Any = None, count: bool = True) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expiration, value = entry
+                if expiration is None or expiration > time.monotonic():
+                    self._data.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return value
+                del self._data[key]
+            if count:
+                self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = _MISSING):
+        """Store a value, `ttl` overrides the default TTL of the cache for this entry."""
+        ttl = self.ttl if ttl is _MISSING else ttl
+        expiration = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (expiration, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        """The entries which haven't expired, from the least to the most recently used."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                (key, value)
+                for key, (expiration, value) in self._data.items()
+                if expiration is None or expiration > now
+            ]
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
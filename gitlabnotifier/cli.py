@@ -0,0 +1,167 @@
+"""Command line of the notifier: `gitlabnotifier serve` runs the webservice in production,
+`gitlabnotifier replay` processes archived webhook payloads."""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+
+from gitlabnotifier.constants import (ASYNC_PROCESSING, FLASK_ENV, SERVE_HOST,
+                                      SERVE_PORT, SERVE_THREADS, SERVE_WORKERS,
+                                      SHUTDOWN_TIMEOUT, SNAPSHOT_PATH,
+                                      WORKER_COUNT)
+
+
+def serve(args: argparse.Namespace):
+    """Run the app with gunicorn. The app is imported once by the master process, before forking
+    the workers: the snapshot of the warm state (Slack directory, caches) is loaded once, and its
+    memory is shared by the workers (copy-on-write)."""
+    # imported here, since gunicorn isn't available on Windows
+    from gunicorn.app.base import \
+        BaseApplication  # pylint: disable=import-outside-toplevel
+
+    class Application(BaseApplication):  # pylint: disable=abstract-method
+
+        def load_config(self):
+            self.cfg.set('bind', f"{args.host}:{args.port}")
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('preload_app', True)
+            self.cfg.set('timeout', args.timeout)
+            self.cfg.set('graceful_timeout', int(SHUTDOWN_TIMEOUT))
+            self.cfg.set('post_fork', post_fork)
+
+        def load(self):
+            os.environ['GITLABNOTIFIER_PRELOAD'] = 'true'
+            from gitlabnotifier.app import (  # pylint: disable=import-outside-toplevel
+                app, load_slack_directory, load_warm_state)
+            load_warm_state()
+            load_slack_directory()
+
+            # objects created during the import won't be freed, moving them out of the tracking of
+            # the garbage collector keeps their memory shared with the workers
+            gc.freeze()
+            return app
+
+    if ASYNC_PROCESSING and args.workers > 1:
+        logging.warning(
+            f"The {args.workers} workers each have their own queue: the events of a same MR may be "
+            "processed by several of them at once, out of order."
+        )
+    Application().run()
+
+
+def post_fork(_server, _worker):
+    from gitlabnotifier.app import start_background_tasks  # pylint: disable=import-outside-toplevel
+    start_background_tasks()
+
+
+def replay(args: argparse.Namespace):
+    """Process the payloads of a file as if they were received, or only write the messages that
+    would be sent with `--dry-run`. Prints the counts of the events by outcome as JSON."""
+    # pylint: disable=import-outside-toplevel
+    from gitlabnotifier.replay import (MessageRecorder, parse_time,
+                                       replay_events)
+
+    output = None
+    if args.dry_run:
+        from gitlabnotifier.snapshot import load_snapshot
+        if SNAPSHOT_PATH:
+            load_snapshot(SNAPSHOT_PATH)  # for its caches of the GitLab users and MRs
+        output = sys.stdout if args.output == '-' else open(args.output, 'a', encoding='utf-8')
+        handler = MessageRecorder(output)
+        _refresh_slack_directory()
+    else:
+        # the background tasks of the app, e.g. the recovery of the events of the event store, are
+        # the ones of `gitlabnotifier serve`
+        os.environ['GITLABNOTIFIER_PRELOAD'] = 'true'
+        from gitlabnotifier.app import handle_event, load_warm_state
+        load_warm_state()
+        _refresh_slack_directory()
+        handler = handle_event
+
+    try:
+        stats = replay_events(
+            args.input,
+            handler,
+            concurrency=args.concurrency,
+            since=parse_time(args.since) if args.since else None,
+            until=parse_time(args.until) if args.until else None,
+            checkpoint_path=args.checkpoint,
+            checkpoint_interval=args.checkpoint_interval,
+        )
+    finally:
+        if output not in (None, sys.stdout):
+            output.close()
+    print(json.dumps(stats), file=sys.stderr)
+
+
+def _refresh_slack_directory():
+    """Fetch the Slack directory before replaying, the messages mention the Slack users."""
+    # pylint: disable=import-outside-toplevel
+    from gitlabnotifier.slack_api import EMAIL_TO_SLACK_ID, slack_client
+    if FLASK_ENV != 'development' and slack_client is not None:
+        EMAIL_TO_SLACK_ID.refresh()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="gitlabnotifier")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the webservice")
+    serve_parser.add_argument("--host", default=SERVE_HOST)
+    serve_parser.add_argument("--port", type=int, default=SERVE_PORT)
+    serve_parser.add_argument(
+        "--workers", type=int, default=SERVE_WORKERS, help="number of worker processes"
+    )
+    serve_parser.add_argument(
+        "--threads", type=int, default=SERVE_THREADS, help="number of threads per worker"
+    )
+    serve_parser.add_argument(
+        "--timeout",
+        type=int,
+        default=120,
+        help="seconds after which a worker handling a request is restarted"
+    )
+    serve_parser.set_defaults(func=serve)
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="process archived webhook payloads, one JSON payload per line"
+    )
+    replay_parser.add_argument("input", help="file of payloads")
+    replay_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=WORKER_COUNT,
+        help="number of events processed at the same time"
+    )
+    replay_parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="write the messages that would be sent to --output instead of sending them"
+    )
+    replay_parser.add_argument(
+        "--output", default="-", help="file where the dry run appends the messages, - for stdout"
+    )
+    replay_parser.add_argument("--since", help="skip the events updated before this ISO 8601 time")
+    replay_parser.add_argument("--until", help="skip the events updated from this ISO 8601 time")
+    replay_parser.add_argument(
+        "--checkpoint", help="file where the progress is saved, to resume an interrupted replay"
+    )
+    replay_parser.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        default=1000,
+        help="number of lines between two saves of the checkpoint"
+    )
+    replay_parser.set_defaults(func=replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Helpers to run independent blocking calls (mostly HTTP requests) concurrently.
+
+The calls run in the context (see `contextvars`) of the calling thread, e.g. with the priority of the
+event being processed.
+
+Threads rather than asyncio: slackclient 2 does ship an `AsyncWebClient` (`slack.web.async_client`),
+but the GitLab client is built on `requests`, and its circuit breakers and limits (`resilience.py`),
+the caches and the Slack directory all block. An asyncio engine would need an async copy of each of
+them and of every resolver, and an ASGI server instead of the gunicorn gthread workers.
+"""
+
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterable, List, Optional, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# threads shared by the calls of `run_concurrently`, which runs for most events
+_SHARED_THREAD_COUNT = 32
+_SHARED_THREAD_PREFIX = "gitlabnotifier-concurrent"
+_shared_executor: Optional[ThreadPoolExecutor] = None
+_shared_executor_pid: Optional[int] = None
+_shared_executor_lock = threading.Lock()
+
+
+def _get_shared_executor() -> ThreadPoolExecutor:
+    """Threads don't survive a fork, so the executor is created again in a forked process."""
+    global _shared_executor, _shared_executor_pid  # pylint: disable=global-statement
+    with _shared_executor_lock:
+        if _shared_executor_pid != os.getpid():
+            _shared_executor = ThreadPoolExecutor(
+                max_workers=_SHARED_THREAD_COUNT, thread_name_prefix=_SHARED_THREAD_PREFIX
+            )
+            _shared_executor_pid = os.getpid()
+        return _shared_executor
+
+
+def map_concurrently(func: Callable[[T], R], items: Iterable[T], max_workers: int) -> List[R]:
+    """Same as `list(map(func, items))`, with at most `max_workers` calls running at the same time.
+    The first exception raised by a call is re-raised."""
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [func(item) for item in items]
+    # a context can't be entered by several threads at once, each call gets its copy
+    calls = [(contextvars.copy_context(), item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(lambda call: call[0].run(func, call[1]), calls))
+
+
+def run_concurrently(*funcs: Callable[[], Any]) -> List[Any]:
+    """Call independent functions at the same time, in threads shared by all the calls, and return
+    their results in order. The first exception raised by a call is re-raised, once all of them
+    finished."""
+    # a call from a shared thread waiting for the other shared threads could wait forever once all
+    # of them are busy
+    if len(funcs) <= 1 or threading.current_thread().name.startswith(_SHARED_THREAD_PREFIX):
+        return [func() for func in funcs]
+    executor = _get_shared_executor()
+    futures = [executor.submit(contextvars.copy_context().run, func) for func in funcs]
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+def map_with_deadline(
+    func: Callable[[T], R], items: Iterable[T], max_workers: int, timeout: float, default: R
+) -> List[R]:
+    """Same as `map_concurrently`, but calls that didn't finish within `timeout` seconds, or that
+    raised an exception, return `default`. Late calls are left running in the background."""
+    items = list(items)
+    if not items:
+        return []
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(items)))
+    futures = [executor.submit(contextvars.copy_context().run, func, item) for item in items]
+    done, _ = wait(futures, timeout=timeout)
+    executor.shutdown(wait=False)
+    results = []
+    for item, future in zip(items, futures):
+        if future not in done:
+            future.cancel()
+            logging.warning(f"Processing of {item} didn't finish within {timeout}s.")
+            results.append(default)
+        elif future.exception() is not None:
+            logging.error(f"Processing of {item} failed.", exc_info=future.exception())
+            results.append(default)
+        else:
+            results.append(future.result())
+    return results
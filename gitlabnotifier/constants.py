@@ -6,7 +6,123 @@ GITLAB_TOKEN = os.environ.get('GITLAB_TOKEN')
 GITLAB_HEADERS = {'Private-Token': GITLAB_TOKEN}
 
 SLACK_API_TOKEN = os.environ.get('SLACK_API_TOKEN')
+# e.g. to use a stand-in of Slack during benchmarks
+SLACK_API_URL = os.environ.get('SLACK_API_URL', 'https://www.slack.com/api/')
 
 GLOBAL_CHANEL = '#_gitlab'
 DEV_CHANEL = '#_gitlab_debug'
 FLASK_ENV = os.environ.get('FLASK_ENV')
+
+# When enabled, events are acknowledged right away and processed by a pool of background workers
+ASYNC_PROCESSING = os.environ.get('ASYNC_PROCESSING', 'false').lower() in ('1', 'true', 'yes')
+WORKER_COUNT = int(os.environ.get('WORKER_COUNT', 4))
+QUEUE_SIZE = int(os.environ.get('QUEUE_SIZE', 1000))
+# maximum number of queued events of a same MR or pipeline
+PARTITION_QUEUE_SIZE = int(os.environ.get('PARTITION_QUEUE_SIZE', 100))
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', 30))
+
+# file where the warm state (Slack directory, caches) is saved, to start serving from it after a restart
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH')
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', 300))  # seconds
+
+# `gitlabnotifier serve`: number of worker processes, and of threads handling requests per process
+SERVE_HOST = os.environ.get('SERVE_HOST', '0.0.0.0')
+SERVE_PORT = int(os.environ.get('SERVE_PORT', 5000))
+# each worker has its own queue of events, see `ASYNC_PROCESSING`: the events of a MR are only
+# processed in order by a single worker
+SERVE_WORKERS = int(os.environ.get('SERVE_WORKERS', 1))
+SERVE_THREADS = int(os.environ.get('SERVE_THREADS', 32))
+
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 2000))
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 3600))  # seconds
+USER_CACHE_NEGATIVE_TTL = float(os.environ.get('USER_CACHE_NEGATIVE_TTL', 300))  # seconds
+
+GITLAB_POOL_SIZE = int(os.environ.get('GITLAB_POOL_SIZE', 20))
+GITLAB_CONNECT_TIMEOUT = float(os.environ.get('GITLAB_CONNECT_TIMEOUT', 5))  # seconds
+GITLAB_READ_TIMEOUT = float(os.environ.get('GITLAB_READ_TIMEOUT', 30))  # seconds
+GITLAB_MAX_RETRIES = int(os.environ.get('GITLAB_MAX_RETRIES', 3))
+GITLAB_RETRY_BACKOFF = float(os.environ.get('GITLAB_RETRY_BACKOFF', 0.5))  # seconds
+# the concurrent calls to GitLab are limited between these bounds, depending on their latency
+GITLAB_MIN_CONCURRENCY = int(os.environ.get('GITLAB_MIN_CONCURRENCY', 2))
+GITLAB_MAX_CONCURRENCY = int(os.environ.get('GITLAB_MAX_CONCURRENCY', GITLAB_POOL_SIZE))
+GITLAB_LATENCY_TARGET = float(os.environ.get('GITLAB_LATENCY_TARGET', 2))  # seconds
+# calls wait for the reset of the rate limit of GitLab once at most this many requests remain
+GITLAB_RATE_LIMIT_RESERVE = int(os.environ.get('GITLAB_RATE_LIMIT_RESERVE', 10))
+
+# the circuit of GitLab or Slack opens after this many consecutive failures, and a call is tried again
+# after `CIRCUIT_RESET_TIMEOUT`
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 30))  # seconds
+# seconds after which the calls of low priority events (comments) waiting for an overloaded GitLab are
+# given up
+LOW_PRIORITY_MAX_WAIT = float(os.environ.get('LOW_PRIORITY_MAX_WAIT', 5))
+
+# number of MRs whose attributes are kept from the webhooks, to avoid fetching them from GitLab
+MR_STORE_SIZE = int(os.environ.get('MR_STORE_SIZE', 10000))
+
+# number of discussions whose participants are kept from the webhooks
+DISCUSSION_INDEX_SIZE = int(os.environ.get('DISCUSSION_INDEX_SIZE', 10000))
+# seconds after which a discussion is fetched again, to see the comments processed by other processes
+DISCUSSION_INDEX_TTL = float(os.environ.get('DISCUSSION_INDEX_TTL', 600)) or None
+
+# maximum number of concurrent GitLab lookups of the users of an event (formerly limited to the users
+# mentionned in a comment, hence the fallback)
+USER_LOOKUP_CONCURRENCY = int(
+    os.environ.get('USER_LOOKUP_CONCURRENCY', os.environ.get('MENTION_LOOKUP_CONCURRENCY', 8))
+)
+# "graphql" resolves the users of an event with a single GraphQL query, falling back to the REST API
+# for the users without a public email, "rest" looks them up one by one with the REST API
+GITLAB_USER_RESOLUTION = os.environ.get('GITLAB_USER_RESOLUTION', 'rest')
+GITLAB_GRAPHQL_BATCH_SIZE = int(os.environ.get('GITLAB_GRAPHQL_BATCH_SIZE', 100))
+
+SLACK_RATE_LIMIT = float(os.environ.get('SLACK_RATE_LIMIT', 5))  # messages per second
+SLACK_RATE_LIMIT_BURST = int(os.environ.get('SLACK_RATE_LIMIT_BURST', 30))
+SLACK_MAX_RETRIES = int(os.environ.get('SLACK_MAX_RETRIES', 3))
+SLACK_DELIVERY_CONCURRENCY = int(os.environ.get('SLACK_DELIVERY_CONCURRENCY', 10))
+
+SLACK_USERS_PAGE_SIZE = int(os.environ.get('SLACK_USERS_PAGE_SIZE', 200))
+# seconds between two refreshes of the Slack directory, 0 to disable
+SLACK_DIRECTORY_REFRESH_INTERVAL = float(os.environ.get('SLACK_DIRECTORY_REFRESH_INTERVAL', 3600))
+# seconds during which lookups wait for the Slack directory when starting without a snapshot
+SLACK_DIRECTORY_LOAD_TIMEOUT = float(os.environ.get('SLACK_DIRECTORY_LOAD_TIMEOUT', 30))
+# verifies the `user_change` and `team_join` events sent by Slack to update the Slack directory
+SLACK_SIGNING_SECRET = os.environ.get('SLACK_SIGNING_SECRET')
+# JSON file where the IDs of the DM channels opened with the users are kept across restarts
+SLACK_DM_CHANNELS_PATH = os.environ.get('SLACK_DM_CHANNELS_PATH')
+
+# job traces are streamed by chunks of `TRACE_CHUNK_SIZE` bytes
+TRACE_CHUNK_SIZE = int(os.environ.get('TRACE_CHUNK_SIZE', 64 * 1024))
+TRACE_MAX_LINE_BYTES = int(os.environ.get('TRACE_MAX_LINE_BYTES', 16 * 1024))
+# maximum size of the error details of a failed job that are sent to Slack
+TRACE_MAX_DETAIL_LINES = int(os.environ.get('TRACE_MAX_DETAIL_LINES', 200))
+TRACE_MAX_DETAIL_BYTES = int(os.environ.get('TRACE_MAX_DETAIL_BYTES', 32 * 1024))
+# the traces of the failed jobs of a pipeline are processed concurrently, within a deadline
+TRACE_FETCH_CONCURRENCY = int(os.environ.get('TRACE_FETCH_CONCURRENCY', 8))
+PIPELINE_TRACE_DEADLINE = float(os.environ.get('PIPELINE_TRACE_DEADLINE', 30))  # seconds
+# JSON list of {"stage": glob, "name": glob, "rules": [rule sets]}, see `trace_extractors.py`
+TRACE_EXTRACTORS = os.environ.get('TRACE_EXTRACTORS')
+
+# path of the SQLite database storing the received events, they aren't stored if not set
+EVENT_STORE_PATH = os.environ.get('EVENT_STORE_PATH')
+EVENT_STORE_BATCH_SIZE = int(os.environ.get('EVENT_STORE_BATCH_SIZE', 100))
+EVENT_STORE_LEASE = float(os.environ.get('EVENT_STORE_LEASE', 300))  # seconds
+EVENT_STORE_RETENTION = float(os.environ.get('EVENT_STORE_RETENTION', 86400))  # seconds
+EVENT_STORE_MAINTENANCE_INTERVAL = float(os.environ.get('EVENT_STORE_MAINTENANCE_INTERVAL', 60))
+EVENT_MAX_ATTEMPTS = int(os.environ.get('EVENT_MAX_ATTEMPTS', 3))
+# seconds before the first retry of a failed event, doubled at each retry
+EVENT_RETRY_DELAY = float(os.environ.get('EVENT_RETRY_DELAY', 30))
+
+# events slower than this many seconds are kept with their spans for `/debug/slow-events`, 0 to disable
+SLOW_EVENT_THRESHOLD = float(os.environ.get('SLOW_EVENT_THRESHOLD', 5))
+SLOW_EVENT_BUFFER_SIZE = int(os.environ.get('SLOW_EVENT_BUFFER_SIZE', 100))
+# the spans of this ratio of the events, and of the slow ones, are exported to the OTLP/HTTP collector
+# (e.g. http://localhost:4318/v1/traces) or else to the file, if set
+TRACING_SAMPLE_RATE = float(os.environ.get('TRACING_SAMPLE_RATE', 0.01))
+TRACING_OTLP_URL = os.environ.get('TRACING_OTLP_URL')
+TRACING_EXPORT_PATH = os.environ.get('TRACING_EXPORT_PATH')
+
+# seconds during which the notifications about a MR are coalesced per recipient, 0 to disable
+DIGEST_WINDOW = float(os.environ.get('DIGEST_WINDOW', 0))
+DIGEST_MAX_DELAY = float(os.environ.get('DIGEST_MAX_DELAY', 300))  # seconds
+# comma separated object kinds that are always notified right away
+DIGEST_IMMEDIATE_KINDS = os.environ.get('DIGEST_IMMEDIATE_KINDS', 'pipeline').split(',')
@@ -0,0 +1,166 @@
+"""Coalescing of the notifications sent to a person about a same MR.
+
+A review session produces a burst of comments on a MR, each one notifying all the participants.
+When enabled, the messages about a MR are buffered per recipient, and sent as a single message once no
+new message came for `window` seconds, or at the latest `max_delay` seconds after the first one.
+
+An event buffered in a digest isn't processed yet: see `DigestBuffer.ack`, so that the event store
+processes it again after a restart rather than losing its notifications.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from gitlabnotifier.concurrency import map_concurrently
+
+MAX_ATTACHMENTS = 100  # Slack doesn't accept more attachments in a message
+
+
+def get_digest_key(event: Dict, immediate_kinds: List[str]) -> Optional[Tuple]:
+    """The MR an event is about, None if its notifications must be sent right away."""
+    if event['object_kind'] in immediate_kinds:
+        return None
+    if event['object_kind'] == 'note' and 'merge_request' in event:
+        return event['project_id'], event['merge_request']['iid']
+    if event['object_kind'] == 'merge_request':
+        return event['project']['id'], event['object_attributes']['iid']
+    return None
+
+
+def combine_messages(messages: List[Dict]) -> Dict:
+    if len(messages) == 1:
+        return messages[0]
+    attachments = [
+        attachment for message in messages for attachment in message.get('attachments', [])
+    ]
+    return {
+        "text": "\n".join(message['text'] for message in messages),
+        "attachments": attachments[-MAX_ATTACHMENTS:],
+    }
+
+
+class _Digest:
+
+    def __init__(self, now: float):
+        self.messages: List[Dict] = []
+        # of the events of the messages
+        self.event_ids: List[Hashable] = []
+        self.first_at = now
+        self.last_at = now
+
+
+class DigestBuffer:
+
+    def __init__(
+        self,
+        send: Callable[[Dict, str], Dict],
+        window: float,
+        max_delay: float,
+        concurrency: int = 10
+    ):
+        """`send(message, channel)` sends a message to Slack."""
+        self.send = send
+        self.window = window
+        self.max_delay = max_delay
+        self.concurrency = concurrency
+        self.buffered_count = 0
+        self.sent_count = 0
+        self._digests: Dict[Tuple[str, Hashable], _Digest] = {}
+        # number of digests not sent yet with messages of an event, and callbacks of `ack`
+        self._event_digest_counts: Dict[Hashable, int] = {}
+        self._on_sent: Dict[Hashable, Callable[[], None]] = {}
+        self._condition = threading.Condition()
+        self._pid = None
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._digests)
+
+    def _deadline(self, digest: _Digest) -> float:
+        return min(digest.last_at + self.window, digest.first_at + self.max_delay)
+
+    def add(self, channel: str, key: Hashable, message: Dict, event_id: Optional[Hashable] = None):
+        self._start()
+        with self._condition:
+            now = time.monotonic()
+            digest = self._digests.setdefault((channel, key), _Digest(now))
+            digest.messages.append(message)
+            if event_id is not None and event_id not in digest.event_ids:
+                digest.event_ids.append(event_id)
+                self._event_digest_counts[event_id] = self._event_digest_counts.get(event_id, 0) + 1
+            digest.last_at = now
+            self.buffered_count += 1
+            self._condition.notify()
+
+    def ack(self, event_id: Hashable, callback: Callable[[], None]):
+        """Call `callback` once the digests with messages of the event were sent, or failed to be
+        sent, right away if there are none."""
+        with self._condition:
+            if self._event_digest_counts.get(event_id):
+                self._on_sent[event_id] = callback
+                return
+        callback()
+
+    def _digest_sent(self, event_ids: List[Hashable]):
+        callbacks = []
+        with self._condition:
+            for event_id in event_ids:
+                self._event_digest_counts[event_id] -= 1
+                if not self._event_digest_counts[event_id]:
+                    del self._event_digest_counts[event_id]
+                    if event_id in self._on_sent:
+                        callbacks.append(self._on_sent.pop(event_id))
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Failed to acknowledge an event sent in a digest.")
+
+    def flush(self, force: bool = False):
+        """Send the digests whose deadline passed, or all of them if `force` is True."""
+        with self._condition:
+            now = time.monotonic()
+            due = [
+                item for item in self._digests.items() if force or self._deadline(item[1]) <= now
+            ]
+            for channel_key, _ in due:
+                del self._digests[channel_key]
+        self._send(due)
+
+    def _send(self, digests: List[Tuple[Tuple[str, Hashable], _Digest]]):
+
+        def send(item):
+            (channel, _), digest = item
+            try:
+                res = self.send(combine_messages(digest.messages), channel)
+                if not res['ok']:
+                    logging.error(f"Failed to send a digest to {channel}: {res}")
+            except Exception:  # pylint: disable=broad-except
+                logging.exception(f"Failed to send a digest to {channel}")
+            finally:
+                self._digest_sent(digest.event_ids)
+
+        map_concurrently(send, digests, max_workers=self.concurrency)
+        self.sent_count += len(digests)
+
+    def _start(self):
+        """Start the thread sending the digests. Threads don't survive a fork, so it is started again
+        in a forked process."""
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="gitlabnotifier-digest", daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._digests:
+                    next_deadline = min(map(self._deadline, self._digests.values()))
+                    self._condition.wait(max(0., next_deadline - time.monotonic()))
+                else:
+                    self._condition.wait()
+            self.flush()
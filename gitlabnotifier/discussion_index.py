@@ -0,0 +1,85 @@
+"""Participants of the MR discussions, kept up to date from the comment webhooks.
+
+A reply in a discussion only adds its author to the known participants, instead of fetching the
+whole discussion from GitLab again: long review threads have hundreds of notes. A discussion is only
+fetched when the notifier doesn't know it yet, e.g. after a restart or once it was evicted, and
+again after a while: each process of the notifier only sees the comments it processes itself.
+"""
+
+import threading
+import time
+from typing import Callable, FrozenSet, Hashable, Iterable, Optional
+
+from gitlabnotifier.cache import TTLCache
+from gitlabnotifier.constants import (DISCUSSION_INDEX_SIZE,
+                                      DISCUSSION_INDEX_TTL)
+
+
+class DiscussionIndex:
+    """Bounded index of the author IDs of the notes of each discussion, the least recently active
+    discussions are evicted first."""
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        """A discussion is fetched again `ttl` seconds after it was fetched, never if it is None."""
+        self.ttl = ttl
+        # (time of the fetch, participants) by discussion
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # held for the read-modify-write of the participants of a discussion
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    @property
+    def hits(self) -> int:
+        return self._cache.hits
+
+    @property
+    def misses(self) -> int:
+        return self._cache.misses
+
+    @property
+    def hit_ratio(self) -> float:
+        return self._cache.hit_ratio
+
+    def get_participants(
+        self,
+        key: Hashable,
+        note_author_id: Optional[int],
+        fetch_author_ids: Callable[[], Iterable[int]],
+    ) -> FrozenSet[int]:
+        """The authors of the notes of a discussion, including the author of a new note.
+        `fetch_author_ids()` gets the authors of the discussion from GitLab, it is only called when
+        the discussion isn't known, or when the author of the new note isn't known."""
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and note_author_id is not None:
+                fetched_at, participants = entry
+                participants = participants | {note_author_id}
+                # adding a note doesn't delay the next fetch
+                self._cache.set(
+                    key, (fetched_at, participants), ttl=self._remaining_ttl(fetched_at)
+                )
+                return participants
+        fetched_at = time.monotonic()
+        # fetched outside of the lock, not to block the other discussions
+        fetched = frozenset(fetch_author_ids())
+        with self._lock:
+            # notes received during the fetch are kept
+            _, participants = self._cache.get(key, default=(None, frozenset()), count=False)
+            participants |= fetched
+            if note_author_id is not None:
+                participants |= {note_author_id}
+            self._cache.set(key, (fetched_at, participants), ttl=self._remaining_ttl(fetched_at))
+        return participants
+
+    def _remaining_ttl(self, fetched_at: float) -> Optional[float]:
+        if self.ttl is None:
+            return None
+        return max(0., fetched_at + self.ttl - time.monotonic())
+
+    def invalidate(self, key: Hashable):
+        self._cache.invalidate(key)
+
+
+discussion_index = DiscussionIndex(DISCUSSION_INDEX_SIZE, DISCUSSION_INDEX_TTL)
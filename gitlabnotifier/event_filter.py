@@ -0,0 +1,101 @@
+"""Rejection of the events which don't produce notifications, before decoding their JSON.
+
+Most of the webhooks received are job events, pipelines which succeeded or are running, and updates
+of MRs. They are recognized from the `X-Gitlab-Event` header, or else from a partial parse of the
+payload: its `object_kind`, and its `object_attributes` (e.g. the `status` of a pipeline or the
+`action` on a MR), which are decoded alone. When in doubt, an event is kept.
+"""
+
+import json
+import re
+from typing import Dict, Optional
+
+from gitlabnotifier.metrics import counter
+from gitlabnotifier.mr_store import mr_store
+from gitlabnotifier.process_gitlab_notif import (HANDLED_OBJECT_KINDS,
+                                                 get_event_handlers)
+
+# https://docs.gitlab.com/ee/user/project/integrations/webhook_events.html
+HEADER_OBJECT_KINDS = {
+    "Push Hook": "push",
+    "Tag Push Hook": "tag_push",
+    "Issue Hook": "issue",
+    "Confidential Issue Hook": "issue",
+    "Note Hook": "note",
+    "Confidential Note Hook": "note",
+    "Merge Request Hook": "merge_request",
+    "Wiki Page Hook": "wiki_page",
+    "Pipeline Hook": "pipeline",
+    "Job Hook": "build",
+    "Deployment Hook": "deployment",
+    "Feature Flag Hook": "feature_flag",
+    "Release Hook": "release",
+}
+
+# an unescaped quote can't be part of a JSON string, so these are keys of the payload
+OBJECT_KIND_REGEX = re.compile(rb'"object_kind"\s*:\s*"([a-z_]+)"')
+OBJECT_ATTRIBUTES_REGEX = re.compile(rb'"object_attributes"\s*:\s*')
+
+_decoder = json.JSONDecoder()
+
+DROPPED_EVENTS = counter(
+    "gitlabnotifier_events_dropped_total",
+    "Events dropped before decoding their payload, by object kind and reason.",
+    ("object_kind", "reason"),
+)
+
+
+def get_object_kind(header: Optional[str], body: bytes) -> Optional[str]:
+    if header in HEADER_OBJECT_KINDS:
+        return HEADER_OBJECT_KINDS[header]
+    match = OBJECT_KIND_REGEX.search(body)
+    return match.group(1).decode() if match else None
+
+
+def get_object_attributes(body: bytes) -> Optional[dict]:
+    """Decode the `object_attributes` of the payload only, None if it can't be found."""
+    match = OBJECT_ATTRIBUTES_REGEX.search(body)
+    if match is None:
+        return None
+    try:
+        # the payload is UTF-8, decoding from a key keeps the characters whole
+        attributes, _ = _decoder.raw_decode(body[match.end():].decode('utf-8'))
+    except ValueError:
+        return None
+    return attributes if isinstance(attributes, dict) else None
+
+
+def get_drop_reason(object_kind: Optional[str], attributes: Optional[Dict]) -> Optional[str]:
+    """Why an event won't produce notifications, None if it may. `object_kind` and `attributes` are
+    None when they couldn't be read from the payload."""
+    if object_kind is None:
+        return None
+    if object_kind not in HANDLED_OBJECT_KINDS:
+        return "object_kind"
+    if attributes is None:
+        return None
+    handlers = get_event_handlers(object_kind, attributes.get('action'))
+    if not handlers:
+        return "action"
+    for handler in handlers:
+        try:
+            if handler.precondition is None or handler.precondition(attributes):
+                return None
+        except (KeyError, TypeError):
+            # the full processing will tell what is wrong with the event
+            return None
+    return "attributes"
+
+
+def should_drop(header: Optional[str], body: bytes) -> bool:
+    object_kind = get_object_kind(header, body)
+    attributes = get_object_attributes(body) if object_kind in HANDLED_OBJECT_KINDS else None
+    reason = get_drop_reason(object_kind, attributes)
+    if reason is None:
+        return False
+    if object_kind == 'merge_request' and attributes is not None:
+        mr_store.update_from_event({'object_kind': object_kind, 'object_attributes': attributes})
+    if object_kind not in HEADER_OBJECT_KINDS.values():
+        object_kind = "other"  # not to create a metric per value sent to the webhook
+    DROPPED_EVENTS.labels(object_kind, reason).inc()
+    return True
@@ -0,0 +1,246 @@
+"""Durable store of the received events, so that they are processed at least once.
+
+Events are written to a SQLite database (in WAL mode) before GitLab gets its response. They are
+identified by the `X-Gitlab-Event-UUID` header, so that a webhook delivered again is ignored.
+
+All the writes go through a single writer thread, which commits them by batches: a burst of events
+costs a few commits instead of one per event. Each event is owned by the process which received it.
+If the process dies before the event is processed, the event is claimed again by a process (possibly
+the same one, restarted) once its lease expires. The process renews the leases of its events while
+they wait to be processed, at each maintenance, so `maintenance_interval` must be shorter than
+`lease`.
+"""
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid as uuid_lib
+from typing import Callable, List, Optional, Set, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT NOT NULL UNIQUE,
+    payload BLOB NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_status ON events (status, updated_at);
+"""
+
+PROCESSING = 'processing'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class _Write:
+
+    def __init__(self, sql: str, params: Tuple):
+        self.sql = sql
+        self.params = params
+        self.row_id: Optional[int] = None
+        self.error: Optional[Exception] = None
+        self.committed = threading.Event()
+
+
+class EventStore:
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 100,
+        lease: float = 300.,
+        retention: float = 86400.,
+        maintenance_interval: float = 60.,
+        on_recovered: Callable[[int, bytes], None] = None,
+    ):
+        """`lease`: seconds after which an event still being processed is considered lost.
+        `retention`: seconds during which processed events are kept, to ignore redeliveries.
+        `on_recovered(event_id, payload)` is called for each lost event claimed by this process."""
+        self.path = path
+        self.batch_size = batch_size
+        self.lease = lease
+        self.retention = retention
+        self.maintenance_interval = maintenance_interval
+        self.on_recovered = on_recovered
+        self.owner = uuid_lib.uuid4().hex
+        self._writes = queue.Queue()
+        # events of this process which are not processed yet, whose leases are renewed
+        self._in_flight: Set[int] = set()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._closed = False
+        with sqlite3.connect(self.path) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+        connection.close()
+
+    def start(self):
+        """Start the writer thread. Threads don't survive a fork, so it is started again in a forked
+        process, which then owns its own events."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.owner = uuid_lib.uuid4().hex
+            self._writes = queue.Queue()
+            self._in_flight = set()
+            threading.Thread(target=self._run, name="gitlabnotifier-event-store",
+                             daemon=True).start()
+
+    def add(self, uuid: str, payload: bytes) -> Optional[int]:
+        """Store a received event, once committed. Returns its ID, or None if an event with the same
+        UUID was already received."""
+        now = time.time()
+        write = self._write(
+            "INSERT OR IGNORE INTO events (uuid, payload, status, owner, received_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)", (uuid, payload, PROCESSING, self.owner, now, now)
+        )
+        write.committed.wait()
+        if write.error is not None:
+            raise write.error
+        if write.row_id is not None:
+            with self._lock:
+                self._in_flight.add(write.row_id)
+        return write.row_id
+
+    def _forget(self, event_id: int):
+        with self._lock:
+            self._in_flight.discard(event_id)
+
+    def done(self, event_id: int):
+        self._forget(event_id)
+        self._write(
+            "UPDATE events SET status = ?, updated_at = ? WHERE id = ?",
+            (DONE, time.time(), event_id)
+        )
+
+    def failed(self, event_id: int):
+        """The event won't be processed again, it is kept for investigation until the retention."""
+        self._forget(event_id)
+        self._write(
+            "UPDATE events SET status = ?, updated_at = ? WHERE id = ?",
+            (FAILED, time.time(), event_id)
+        )
+
+    def discard(self, event_id: int):
+        """Forget an event, e.g. when it can't be processed now, so that its redelivery is accepted."""
+        self._forget(event_id)
+        self._write("DELETE FROM events WHERE id = ?", (event_id,))
+
+    def close(self, timeout: float = None):
+        """Commit the pending writes and stop the writer thread."""
+        if self._pid != os.getpid() or self._closed:
+            return
+        self._closed = True
+        write = self._write(None, ())
+        write.committed.wait(timeout)
+
+    def _write(self, sql: Optional[str], params: Tuple) -> _Write:
+        self.start()
+        write = _Write(sql, params)
+        self._writes.put(write)
+        return write
+
+    def _run(self):
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        # in WAL mode, commits are durable across application crashes with NORMAL
+        connection.execute("PRAGMA synchronous=NORMAL")
+        next_maintenance = time.monotonic()
+        while True:
+            if time.monotonic() >= next_maintenance:
+                self._maintain(connection)
+                next_maintenance = time.monotonic() + self.maintenance_interval
+            try:
+                writes = [self._writes.get(timeout=max(0., next_maintenance - time.monotonic()))]
+            except queue.Empty:
+                continue
+            while len(writes) < self.batch_size:
+                try:
+                    writes.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            stop = self._commit(connection, writes)
+            if stop:
+                connection.close()
+                return
+
+    def _commit(self, connection: sqlite3.Connection, writes: List[_Write]) -> bool:
+        stop = False
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for write in writes:
+                if write.sql is None:
+                    stop = True
+                    continue
+                cursor = connection.execute(write.sql, write.params)
+                write.row_id = cursor.lastrowid if cursor.rowcount == 1 else None
+            connection.execute("COMMIT")
+        except sqlite3.Error as e:
+            logging.exception("Failed to write events.")
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            for write in writes:
+                write.error = e
+        for write in writes:
+            write.committed.set()
+        return stop
+
+    def _maintain(self, connection: sqlite3.Connection):
+        """Renew the leases of the events of this process, claim the lost events, delete the old
+        processed events and truncate the WAL."""
+        now = time.time()
+        with self._lock:
+            in_flight = set(self._in_flight)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "UPDATE events SET updated_at = ? WHERE id = ? AND status = ? AND owner = ?",
+                [(now, event_id, PROCESSING, self.owner) for event_id in in_flight]
+            )
+            lost_events = [
+                (event_id, payload) for event_id, payload in connection.execute(
+                    "SELECT id, payload FROM events WHERE status = ? AND updated_at < ?",
+                    (PROCESSING, now - self.lease)
+                ) if event_id not in in_flight
+            ]
+            connection.executemany(
+                "UPDATE events SET owner = ?, updated_at = ? WHERE id = ?",
+                [(self.owner, now, event_id) for event_id, _ in lost_events]
+            )
+            connection.execute(
+                "DELETE FROM events WHERE status IN (?, ?) AND updated_at < ?",
+                (DONE, FAILED, now - self.retention)
+            )
+            connection.execute("COMMIT")
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error:
+            logging.exception("Failed to maintain the event store.")
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            return
+        if not lost_events:
+            return
+        logging.warning(f"Recovered {len(lost_events)} events that were not processed.")
+        with self._lock:
+            self._in_flight.update(event_id for event_id, _ in lost_events)
+        if self.on_recovered is not None:
+            # e.g. waiting for room in the queue of the workers must not delay the writes
+            threading.Thread(
+                target=self._recover,
+                args=(lost_events,),
+                name="gitlabnotifier-event-recovery",
+                daemon=True
+            ).start()
+
+    def _recover(self, lost_events: List[Tuple[int, bytes]]):
+        for event_id, payload in lost_events:
+            try:
+                self.on_recovered(event_id, payload)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception(f"Failed to recover event {event_id}.")
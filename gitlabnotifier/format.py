@@ -1,7 +1,7 @@
 import re
 from typing import Dict
 
-from gitlabnotifier.slack_api import EMAIL_TO_SLACK_NAME
+from gitlabnotifier.slack_api import EMAIL_TO_SLACK_ID
 
 
 def format_slack_link(link: str, name: str):
@@ -30,11 +30,10 @@ def format_project_name(event: Dict) -> str:
 def format_author_name(event: Dict) -> str:
     author_name = event['user']['name']
     author_email = event['user']['email']
-    slack_name = EMAIL_TO_SLACK_NAME.get(author_email)
+    slack_id = EMAIL_TO_SLACK_ID.get(author_email)
     author_name = format_slack_text(author_name)
-    if slack_name:
-        slack_name = format_slack_text(slack_name)
-        return f"<{slack_name}> ({author_name})"
+    if slack_id:
+        return f"<@{slack_id}> ({author_name})"
     return author_name
 
 
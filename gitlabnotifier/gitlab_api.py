@@ -1,38 +1,350 @@
 """Wrapper for the GitLab API. Official documentation can be found here: https://docs.gitlab.com/ee/api/README.html"""
 
+import logging
 import os
-from typing import Dict
+import time
+from contextlib import ExitStack, contextmanager
+from typing import Dict, Iterable, Iterator, List
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from gitlabnotifier.constants import GITLAB_BASE_URL, GITLAB_HEADERS
+from gitlabnotifier.cache import TTLCache
+from gitlabnotifier.concurrency import map_concurrently
+from gitlabnotifier.constants import (CIRCUIT_FAILURE_THRESHOLD,
+                                      CIRCUIT_RESET_TIMEOUT, GITLAB_BASE_URL,
+                                      GITLAB_CONNECT_TIMEOUT,
+                                      GITLAB_GRAPHQL_BATCH_SIZE,
+                                      GITLAB_HEADERS, GITLAB_LATENCY_TARGET,
+                                      GITLAB_MAX_CONCURRENCY,
+                                      GITLAB_MAX_RETRIES,
+                                      GITLAB_MIN_CONCURRENCY, GITLAB_POOL_SIZE,
+                                      GITLAB_RATE_LIMIT_RESERVE,
+                                      GITLAB_READ_TIMEOUT,
+                                      GITLAB_RETRY_BACKOFF,
+                                      GITLAB_USER_RESOLUTION,
+                                      LOW_PRIORITY_MAX_WAIT, TRACE_CHUNK_SIZE,
+                                      TRACE_MAX_LINE_BYTES,
+                                      USER_CACHE_NEGATIVE_TTL, USER_CACHE_SIZE,
+                                      USER_CACHE_TTL, USER_LOOKUP_CONCURRENCY)
+from gitlabnotifier.metrics import (GITLAB_CALL_DURATION, GITLAB_TRACE_BYTES,
+                                    timed)
+from gitlabnotifier.resilience import (AdaptiveLimiter, CircuitBreaker,
+                                       RateLimitGate)
+from gitlabnotifier.tracing import span
+
+# users are looked up by ID and by username for every event, these lookups are cached
+_users_by_id = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_users_by_username = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def _create_session() -> requests.Session:
+    """The session keeps the connections to GitLab alive. It is shared by all threads: its pool is
+    thread-safe, and nothing else in the session is modified after its creation."""
+    retries = Retry(
+        total=GITLAB_MAX_RETRIES,
+        backoff_factor=GITLAB_RETRY_BACKOFF,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=GITLAB_POOL_SIZE, pool_maxsize=GITLAB_POOL_SIZE, max_retries=retries
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_session = _create_session()
+
+# downloads of job traces are much slower than the other calls, and can fail on their own (e.g. when
+# archived traces are read from the object storage), so they have their own circuit and limit
+gitlab_breaker = CircuitBreaker("gitlab", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+gitlab_traces_breaker = CircuitBreaker(
+    "gitlab_traces", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT
+)
+gitlab_limiter = AdaptiveLimiter(
+    "gitlab", GITLAB_MIN_CONCURRENCY, GITLAB_MAX_CONCURRENCY, GITLAB_LATENCY_TARGET,
+    LOW_PRIORITY_MAX_WAIT
+)
+gitlab_traces_limiter = AdaptiveLimiter(
+    "gitlab_traces", GITLAB_MIN_CONCURRENCY, GITLAB_MAX_CONCURRENCY, GITLAB_LATENCY_TARGET,
+    LOW_PRIORITY_MAX_WAIT
+)
+# the rate limit applies to all the requests of our token
+gitlab_rate_limit = RateLimitGate(
+    "gitlab", GITLAB_RATE_LIMIT_RESERVE, low_priority_max_wait=LOW_PRIORITY_MAX_WAIT
+)
+
+# errors of the connection, while sending the request or reading a streamed response
+_NETWORK_ERRORS = (
+    requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError
+)
+
+
+@contextmanager
+def _gitlab_call(method: str,
+                 url: str,
+                 stream: bool = False,
+                 **kwargs) -> Iterator[requests.Response]:
+    """Send a request to GitLab through its circuit breaker and concurrency limit, see
+    `resilience.py`. Both are held until the context exits: streamed responses, the downloads of
+    job traces, are read within it, so that the errors of the download count as failures and that
+    the limit counts the downloads in progress. The latency of a streamed response is the time to
+    its headers though, a long download isn't a slow GitLab. Server errors and rate limiting, once
+    the retries are exhausted, count as failures of GitLab."""
+    breaker, limiter = (gitlab_traces_breaker,
+                        gitlab_traces_limiter) if stream else (gitlab_breaker, gitlab_limiter)
+    with span("gitlab", method=method, path=urlparse(url).path) as request_span, \
+            breaker.guard() as call:
+        gitlab_rate_limit.wait()
+        with limiter.slot() as slot:
+            try:
+                start = time.perf_counter()
+                response = _session.request(
+                    method,
+                    url,
+                    headers=GITLAB_HEADERS,
+                    timeout=(GITLAB_CONNECT_TIMEOUT, GITLAB_READ_TIMEOUT),
+                    stream=stream,
+                    **kwargs
+                )
+                gitlab_rate_limit.update(response.headers)
+                request_span.set_attribute("status_code", response.status_code)
+                if response.status_code >= 500 or response.status_code == 429:
+                    call.failed()
+                else:
+                    call.succeeded()
+                if stream:
+                    slot.latency = time.perf_counter() - start
+                # errors of the caller, e.g. an HTTP error, aren't a sign of overload
+                slot.succeeded()
+                yield response
+            except _NETWORK_ERRORS:
+                call.failed()
+                slot.failed()
+                raise
+
+
+def _request(method: str, url: str, **kwargs) -> requests.Response:
+    with _gitlab_call(method, url, **kwargs) as response:
+        return response
 
 
 def _call_api(suffix: str):
-    url = os.path.join(GITLAB_BASE_URL, "api/v4", suffix)
-    response = requests.get(url, headers=GITLAB_HEADERS)
+    response = _request("GET", os.path.join(GITLAB_BASE_URL, "api/v4", suffix))
     response.raise_for_status()
     return response
 
 
+@timed(GITLAB_CALL_DURATION)
 def get_user(user_id: str):
     """https://docs.gitlab.com/ee/api/users.html#for-user"""
-    return _call_api(f"users/{user_id}").json()
+    user = _users_by_id.get(str(user_id))
+    return _get_user(str(user_id)) if user is None else user
+
 
+def _get_user(user_id: str) -> Dict:
+    user = _call_api(f"users/{user_id}").json()
+    _users_by_id.set(user_id, user)
+    return user
 
+
+@timed(GITLAB_CALL_DURATION)
 def get_user_by_username(username: str):
     """https://docs.gitlab.com/ee/api/users.html#for-user"""
-    return _call_api(f"users?username={username}").json()
+    users = _users_by_username.get(username)
+    return _get_user_by_username(username) if users is None else users
+
+
+def _get_user_by_username(username: str) -> List[Dict]:
+    users = _call_api(f"users?username={username}").json()
+    # unknown usernames (e.g. a "@" in a comment that isn't a mention) are cached for less time,
+    # so that a newly created user is found quickly
+    _users_by_username.set(
+        username, users, ttl=USER_CACHE_TTL if users else USER_CACHE_NEGATIVE_TTL
+    )
+    return users
+
+
+# https://docs.gitlab.com/ee/api/graphql/reference/#queryusers
+USERS_QUERY = """
+query($ids: [ID!], $usernames: [String!], $first: Int) {
+  users(ids: $ids, usernames: $usernames, first: $first) {
+    nodes { id username publicEmail }
+  }
+}
+"""
+
+
+def _query_users(ids: List[str] = None, usernames: List[str] = None) -> List[Dict]:
+    """The users with these IDs or usernames, from a single GraphQL query. The users are returned in
+    the format of the REST API, without the users that don't have a public email: the email of the
+    GraphQL API is the public one, which may not be set."""
+    variables = {"first": len(ids or usernames)}
+    if ids is not None:
+        variables["ids"] = [f"gid://gitlab/User/{user_id}" for user_id in ids]
+    if usernames is not None:
+        variables["usernames"] = usernames
+    response = _request(
+        "POST",
+        os.path.join(GITLAB_BASE_URL, "api/graphql"),
+        json={
+            "query": USERS_QUERY,
+            "variables": variables
+        },
+    )
+    response.raise_for_status()
+    body = response.json()
+    if body.get("errors"):
+        raise ValueError(f"GraphQL query of the users failed: {body['errors']}")
+    return [
+        {
+            "id": int(node["id"].rsplit("/", 1)[-1]),
+            "username": node["username"],
+            "email": node["publicEmail"]
+        } for node in body["data"]["users"]["nodes"] if node.get("publicEmail")
+    ]
+
+
+def _query_users_in_batches(variable: str, values: List[str]) -> List[Dict]:
+    """`_query_users` by batches of `GITLAB_GRAPHQL_BATCH_SIZE`, the size of a page of the GraphQL
+    API, `variable` being "ids" or "usernames". If GraphQL isn't available, no user is returned: they
+    are then looked up with the REST API."""
+    users = []
+    try:
+        with GITLAB_CALL_DURATION.labels("query_users").time():
+            for i in range(0, len(values), GITLAB_GRAPHQL_BATCH_SIZE):
+                users.extend(_query_users(**{variable: values[i:i + GITLAB_GRAPHQL_BATCH_SIZE]}))
+    except (requests.RequestException, ValueError, KeyError, TypeError):
+        logging.exception("Failed to query the users with GraphQL, falling back to the REST API.")
+    return users
+
+
+@timed(GITLAB_CALL_DURATION)
+def get_users(user_ids: Iterable) -> Dict[str, Dict]:
+    """The users with these IDs, by ID as a string. Cached users aren't fetched again, the others are
+    fetched together (see `GITLAB_USER_RESOLUTION`)."""
+    user_ids = {str(user_id) for user_id in user_ids}
+    users = {}
+    for user_id in user_ids:
+        user = _users_by_id.get(user_id)
+        if user is not None:
+            users[user_id] = user
+    missing_ids = sorted(user_ids - users.keys())
+    if missing_ids and GITLAB_USER_RESOLUTION == "graphql":
+        for user in _query_users_in_batches("ids", missing_ids):
+            _users_by_id.set(str(user["id"]), user)
+            users[str(user["id"])] = user
+        missing_ids = [user_id for user_id in missing_ids if user_id not in users]
+    # the REST API is called concurrently, without the cache lookup of `get_user`
+    fetched = map_concurrently(_get_user, missing_ids, max_workers=USER_LOOKUP_CONCURRENCY)
+    users.update(zip(missing_ids, fetched))
+    return users
+
+
+@timed(GITLAB_CALL_DURATION)
+def get_users_by_username(usernames: Iterable[str]) -> Dict[str, List[Dict]]:
+    """Same as `get_user_by_username` for several usernames: the users matching each username, an
+    empty list for the unknown ones."""
+    usernames = list(dict.fromkeys(usernames))
+    users_per_name = {}
+    for username in usernames:
+        users = _users_by_username.get(username)
+        if users is not None:
+            users_per_name[username] = users
+    missing_names = [username for username in usernames if username not in users_per_name]
+    if missing_names and GITLAB_USER_RESOLUTION == "graphql":
+        # usernames are case insensitive
+        names_by_lower = {username.lower(): username for username in missing_names}
+        for user in _query_users_in_batches("usernames", missing_names):
+            username = names_by_lower.get(user["username"].lower())
+            if username is not None:
+                _users_by_username.set(username, [user])
+                users_per_name[username] = [user]
+        missing_names = [username for username in missing_names if username not in users_per_name]
+    fetched = map_concurrently(
+        _get_user_by_username, missing_names, max_workers=USER_LOOKUP_CONCURRENCY
+    )
+    users_per_name.update(zip(missing_names, fetched))
+    return users_per_name
+
+
+def invalidate_user_cache(user_id: str = None, username: str = None):
+    """Forget a cached user, e.g. after a rename or an email change. Clear the whole cache if neither
+    `user_id` nor `username` are given."""
+    if user_id is None and username is None:
+        _users_by_id.clear()
+        _users_by_username.clear()
+        return
+    if user_id is not None:
+        user = _users_by_id.get(str(user_id), count=False)
+        _users_by_id.invalidate(str(user_id))
+        if user is not None:
+            _users_by_username.invalidate(user.get("username"))
+    if username is not None:
+        for user in _users_by_username.get(username, default=[], count=False):
+            _users_by_id.invalidate(str(user.get("id")))
+        _users_by_username.invalidate(username)
+
+
+def dump_user_cache() -> List:
+    """The cached users, in a JSON-serializable format, see `load_user_cache`."""
+    return [[user_id, user] for user_id, user in _users_by_id.items()]
+
+
+def load_user_cache(entries: List, age: float):
+    """Cache users dumped `age` seconds ago, until `USER_CACHE_TTL` seconds after they were dumped."""
+    ttl = USER_CACHE_TTL - age
+    if ttl <= 0:
+        return
+    for user_id, user in entries:
+        _users_by_id.set(user_id, user, ttl=ttl)
+
+
+def get_user_cache_stats() -> Dict[str, int]:
+    return {
+        "hits": _users_by_id.hits + _users_by_username.hits,
+        "misses": _users_by_id.misses + _users_by_username.misses,
+        "size": len(_users_by_id) + len(_users_by_username),
+    }
 
 
 def _call_project_api(project_id: str, suffix: str):
     return _call_api(os.path.join("projects", str(project_id), suffix))
 
 
+@timed(GITLAB_CALL_DURATION)
 def get_job_trace(project_id: str, job_id: str):
     return _call_project_api(project_id, f"jobs/{job_id}/trace").text
 
 
+def iter_job_trace_lines(project_id: str, job_id: str) -> Iterator[str]:
+    """Stream the trace of a job line by line, without loading it in memory: traces of test jobs can
+    weigh hundreds of MB. Lines longer than `TRACE_MAX_LINE_BYTES` are truncated. The connection,
+    and the slot of the download (see `_gitlab_call`), are released when the generator is closed,
+    so stop reading early with `contextlib.closing`."""
+    url = os.path.join(GITLAB_BASE_URL, "api/v4/projects", str(project_id), f"jobs/{job_id}/trace")
+    with ExitStack() as stack:
+        with GITLAB_CALL_DURATION.labels("iter_job_trace_lines").time():
+            response = stack.enter_context(_gitlab_call("GET", url, stream=True))
+        stack.callback(response.close)
+        response.raise_for_status()
+        pending = b""
+        for chunk in response.iter_content(chunk_size=TRACE_CHUNK_SIZE):
+            GITLAB_TRACE_BYTES.inc(len(chunk))
+            *lines, pending = (pending + chunk).split(b"\n")
+            for line in lines:
+                yield line[:TRACE_MAX_LINE_BYTES].decode("utf-8", errors="replace")
+            pending = pending[:TRACE_MAX_LINE_BYTES]
+        if pending:
+            yield pending.decode("utf-8", errors="replace")
+
+
 ## MR API
 
 
@@ -40,18 +352,21 @@ def _call_mr_api(project_id: str, mr_id: str, suffix: str):
     return _call_project_api(project_id, os.path.join(f"merge_requests/{mr_id}", suffix))
 
 
+@timed(GITLAB_CALL_DURATION)
 def get_mr(project_id: str, mr_id: str):
     """https://docs.gitlab.com/ee/api/merge_requests.html#get-single-mr"""
     response = _call_mr_api(project_id, mr_id, "")
     return response.json()
 
 
+@timed(GITLAB_CALL_DURATION)
 def get_mr_participants(project_id: str, mr_id: str):
     """https://docs.gitlab.com/ee/api/merge_requests.html#get-single-mr-participants"""
     response = _call_mr_api(project_id, mr_id, "participants")
     return response.json()
 
 
+@timed(GITLAB_CALL_DURATION)
 def get_mr_discussion(project_id: str, mr_id: str, discussion_id: str) -> Dict:
     """https://docs.gitlab.com/ee/api/discussions.html#get-single-merge-request-discussion-item"""
     response = _call_mr_api(project_id, mr_id, f"discussions/{discussion_id}")
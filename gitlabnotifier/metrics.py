@@ -0,0 +1,267 @@
+"""Metrics exposed in the Prometheus text format on the `/metrics` route.
+
+Metrics are updated on every event, so updating them must be cheap: the children of a metric (one
+per combination of label values) are created once and then reused, and each child has its own lock,
+held only for an addition.
+"""
+
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# latencies of HTTP calls and event processing, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str]) -> str:
+    if not label_names:
+        return ""
+    labels = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)
+    )
+    return "{" + labels + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *label_values: str):
+        """The child of the metric for these label values, created on first use."""
+        child = self._children.get(label_values)
+        if child is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError(f"{self.name} expects the labels {self.label_names}.")
+            with self._lock:
+                child = self._children.setdefault(label_values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for label_values, child in sorted(self._children.items()):
+            lines.extend(self._collect_child(label_values, child))
+        return lines
+
+    def _collect_child(self, label_values: Tuple[str, ...], child) -> List[str]:
+        raise NotImplementedError
+
+
+class _CounterChild:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1):
+        """Increment the counter of a metric without labels."""
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _collect_child(self, label_values, child):
+        labels = _format_labels(self.label_names, label_values)
+        return [f"{self.name}{labels} {_format_value(child.value)}"]
+
+
+class _HistogramChild:
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.bucket_counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of the block, even if it raises an exception."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float):
+        """Observe a value of a metric without labels."""
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _collect_child(self, label_values, child):
+        with child._lock:  # pylint: disable=protected-access
+            bucket_counts = list(child.bucket_counts)
+            total = child.sum
+        lines = []
+        cumulated_count = 0
+        for bound, count in zip(self.buckets + (float('inf'),), bucket_counts):
+            cumulated_count += count
+            labels = _format_labels(
+                self.label_names + ("le",), label_values + (_format_value(bound),)
+            )
+            lines.append(f"{self.name}_bucket{labels} {cumulated_count}")
+        labels = _format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulated_count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """A value read when the metrics are collected, e.g. the size of a queue."""
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, func: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.func = func
+        # a gauge has no labels, its only child is the function reading its value
+        self._children[()] = func
+
+    def _new_child(self):
+        return self.func
+
+    def _collect_child(self, label_values, child):
+        return [f"{self.name} {_format_value(child())}"]
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """Register a metric, replacing the metric with the same name if any."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        """All the metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.collect()) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, label_names))
+
+
+def histogram(
+    name: str,
+    documentation: str,
+    label_names: Sequence[str] = (),
+    buckets: Sequence[float] = DEFAULT_BUCKETS
+) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, label_names, buckets))
+
+
+def gauge(name: str, documentation: str, func: Callable[[], float]) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, func))
+
+
+def timed(metric: Histogram, *label_values: str):
+    """Decorator observing the duration of each call of a function."""
+
+    def decorator(func):
+        child = metric.labels(*label_values or (func.__name__,))
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with child.time():
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# metrics shared by several modules
+
+EVENTS = counter("gitlabnotifier_events_total", "Processed events.", ("object_kind", "status"))
+EVENT_DURATION = histogram(
+    "gitlabnotifier_event_duration_seconds", "Duration of the processing of an event.",
+    ("object_kind",)
+)
+GITLAB_CALL_DURATION = histogram(
+    "gitlabnotifier_gitlab_call_duration_seconds",
+    "Duration of the calls to the GitLab API wrappers, cache hits included.", ("function",)
+)
+GITLAB_TRACE_BYTES = counter(
+    "gitlabnotifier_gitlab_trace_bytes_total", "Bytes of job traces downloaded."
+)
+TRACE_PROCESSING_DURATION = histogram(
+    "gitlabnotifier_trace_processing_duration_seconds",
+    "Duration of the download and error extraction of a job trace."
+)
+SLACK_CALL_DURATION = histogram(
+    "gitlabnotifier_slack_call_duration_seconds",
+    "Duration of the calls to Slack, retries included.", ("method",)
+)
+SLACK_ERRORS = counter(
+    "gitlabnotifier_slack_errors_total", "Errors returned by Slack.", ("method", "error")
+)
+NOTIFICATIONS = counter(
+    "gitlabnotifier_notifications_total",
+    "Notifications by outcome: sent to the user, buffered in a digest, or unmatched (sent to the "
+    "global channel instead).", ("status",)
+)
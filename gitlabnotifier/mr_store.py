@@ -0,0 +1,85 @@
+"""Metadata of the MRs, kept up to date from the webhooks, to avoid calling GitLab for them.
+
+`merge_request` events contain the attributes of their MR, and `note` events the attributes of the
+MR they comment. Updates of MRs are dropped before being processed (see `event_filter.py`), but
+still feed the store.
+"""
+
+from typing import Any, Dict, Hashable, List, Optional
+
+from gitlabnotifier.cache import TTLCache
+from gitlabnotifier.constants import MR_STORE_SIZE
+
+# attributes of the MRs which are stored, the others (e.g. the description) aren't used
+FIELDS = ('author_id', 'title', 'url', 'state', 'updated_at')
+
+
+class MergeRequestStore:
+    """Bounded store of MR attributes by (project ID, MR iid), the least recently used MRs are
+    evicted first."""
+
+    def __init__(self, maxsize: int):
+        self._cache = TTLCache(maxsize=maxsize)
+        # lookups of attributes which were found, i.e. calls to GitLab which were saved
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    @staticmethod
+    def _key(project_id, mr_iid) -> Hashable:
+        return str(project_id), str(mr_iid)
+
+    def get(self, project_id, mr_iid, field: str) -> Optional[Any]:
+        """An attribute of a MR, None if it isn't known."""
+        value = self._cache.get(self._key(project_id, mr_iid), default={}).get(field)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def update(self, project_id, mr_iid, attributes: Dict):
+        """Store the known attributes of a MR. Attributes older than the stored ones are ignored:
+        webhooks aren't always received in order."""
+        key = self._key(project_id, mr_iid)
+        stored = self._cache.get(key, default={}, count=False)
+        updated_at = attributes.get('updated_at')
+        if updated_at and stored.get('updated_at') and updated_at < stored['updated_at']:
+            return
+        mr = dict(stored)
+        mr.update(
+            (field, attributes[field]) for field in FIELDS if attributes.get(field) is not None
+        )
+        # a new dict is stored, so that readers never see a partially updated one
+        self._cache.set(key, mr)
+
+    def dump(self) -> List:
+        """The stored MRs, in a JSON-serializable format, see `load`."""
+        return [[list(key), mr] for key, mr in self._cache.items()]
+
+    def load(self, entries: List):
+        for key, mr in entries:
+            self._cache.set(tuple(key), mr)
+
+    def update_from_event(self, event: Dict):
+        object_kind = event.get('object_kind')
+        if object_kind == 'merge_request':
+            attributes = event.get('object_attributes') or {}
+            project_id = attributes.get('target_project_id') or event.get('project', {}).get('id')
+        elif object_kind == 'note' and event.get('merge_request'):
+            attributes = event['merge_request']
+            project_id = attributes.get('target_project_id') or event.get('project_id')
+        else:
+            return
+        if project_id is not None and attributes.get('iid') is not None:
+            self.update(project_id, attributes['iid'], attributes)
+
+
+mr_store = MergeRequestStore(MR_STORE_SIZE)
@@ -1,20 +1,46 @@
-from typing import Dict, Set, Tuple
+import itertools
+import re
+import time
+from contextlib import closing
+from typing import (Callable, Dict, FrozenSet, Iterable, List, NamedTuple,
+                    Optional, Set, Tuple)
 
 from werkzeug.exceptions import HTTPException
 
-from gitlabnotifier.constants import GITLAB_BASE_URL
+from gitlabnotifier.concurrency import map_with_deadline, run_concurrently
+from gitlabnotifier.constants import (GITLAB_BASE_URL, PIPELINE_TRACE_DEADLINE,
+                                      TRACE_EXTRACTORS,
+                                      TRACE_FETCH_CONCURRENCY,
+                                      TRACE_MAX_DETAIL_BYTES,
+                                      TRACE_MAX_DETAIL_LINES)
+from gitlabnotifier.discussion_index import discussion_index
 from gitlabnotifier.format import (format_author_name, format_mr_title,
                                    format_project_name, format_slack_link,
                                    format_slack_text)
-from gitlabnotifier.gitlab_api import (get_job_trace, get_mr,
-                                       get_mr_discussion, get_mr_participants,
-                                       get_user, get_user_by_username)
+from gitlabnotifier.gitlab_api import (get_mr, get_mr_discussion,
+                                       get_mr_participants, get_users,
+                                       get_users_by_username,
+                                       iter_job_trace_lines)
+from gitlabnotifier.metrics import TRACE_PROCESSING_DURATION
+from gitlabnotifier.mr_store import mr_store
+from gitlabnotifier.resilience import HIGH, LOW, NORMAL
+from gitlabnotifier.trace_extractors import load_registry
+from gitlabnotifier.tracing import span
+
+# statuses of the pipelines which aren't notified
+SILENT_PIPELINE_STATUSES = ['success', 'running', 'pending', 'canceled']
 
 
 def status_requires_notification(event):
-    attributes = event['object_attributes']
-    status = attributes['status']
-    return status not in ['success', 'running', 'pending', 'canceled']
+    return pipeline_attributes_require_notification(event['object_attributes'])
+
+
+def pipeline_attributes_require_notification(attributes: Dict) -> bool:
+    return attributes['status'] not in SILENT_PIPELINE_STATUSES
+
+
+def attributes_have_assignee(attributes: Dict) -> bool:
+    return attributes.get("assignee_id") is not None
 
 
 def event_is_assignement(event: Dict):
@@ -29,40 +55,109 @@ def event_is_assignement(event: Dict):
            } != {user["username"] for user in assignees_change.get("previous", [])}
 
 
+class EventHandler(NamedTuple):
+    generate_message: Callable[[Dict], Dict]
+    get_users_emails: Callable[[Dict], Set[str]]
+    # cheap check on the `object_attributes` of the event only, see `event_filter.py`
+    precondition: Optional[Callable[[Dict], bool]] = None
+    # check on the whole event, after the precondition
+    condition: Optional[Callable[[Dict], bool]] = None
+
+
+def get_event_handlers(object_kind: str, action: Optional[str]) -> List[EventHandler]:
+    """The handlers which may apply to an event, the first one whose conditions are met applies."""
+    handlers = EVENT_HANDLERS.get((object_kind, action))
+    if handlers is None:
+        handlers = EVENT_HANDLERS.get((object_kind, None), [])
+    return handlers
+
+
 def get_messages_and_emails_from_event(event: Dict) -> Tuple[Dict, Set[str]]:
-    if event['object_kind'] == 'pipeline' and status_requires_notification(event):
-        return generate_pipeline_message(event), {event['user']['email']}
-    if event['object_kind'] == 'note':
-        return generate_note_message(event), get_users_emails_from_event_note(event)
-    if event['object_kind'] == 'merge_request':
-        if event["object_attributes"].get("action") == "approved":
-            return generate_approval_message(event), get_users_emails_from_event_approval(event)
-        if event["object_attributes"].get("action") == "merge":
-            return generate_merge_message(event), get_users_emails_from_event_merge(event)
-        if event_is_assignement(event):
-            return generate_assignee_message(event), get_users_emails_from_event_assignee(event)
+    attributes = event.get('object_attributes', {})
+    with span("dispatch", object_kind=event['object_kind']) as dispatch_span:
+        for handler in get_event_handlers(event['object_kind'], attributes.get('action')):
+            if handler.precondition is not None and not handler.precondition(attributes):
+                continue
+            if handler.condition is not None and not handler.condition(event):
+                continue
+            dispatch_span.set_attribute("handler", handler.generate_message.__name__)
+            with span("generate_message"):
+                message = handler.generate_message(event)
+            with span("get_users_emails"):
+                emails = handler.get_users_emails(event)
+            return message, emails
     return {}, set()
 
 
-# PIPELINE
-
+def get_partition_key(event: Dict) -> Optional[Tuple]:
+    """Events with the same key are processed in order (see `worker.py`): the events of a MR, its
+    comments and its pipelines, or else the events of a pipeline. None for the other events."""
+    object_kind = event.get('object_kind')
+    if object_kind == 'merge_request':
+        return event.get('project', {}).get('id'), 'mr', event.get('object_attributes',
+                                                                   {}).get('iid')
+    if object_kind == 'note' and event.get('merge_request'):
+        return event.get('project_id'), 'mr', event['merge_request'].get('iid')
+    if object_kind == 'pipeline':
+        project_id = event.get('project', {}).get('id')
+        if event.get('merge_request'):
+            return project_id, 'mr', event['merge_request'].get('iid')
+        return project_id, 'pipeline', event.get('object_attributes', {}).get('id')
+    return None
+
+
+def get_event_priority(event: Dict) -> int:
+    """When GitLab is overloaded, the calls for the events of low priority are shed first (see
+    `resilience.py`): pipeline failures matter more than comments."""
+    object_kind = event.get('object_kind')
+    if object_kind == 'pipeline':
+        return HIGH
+    if object_kind == 'note':
+        return LOW
+    return NORMAL
 
-def extract_lint_errors(trace):
-    for line in trace.split('\n'):
-        if "[E" in line:
-            yield line.rstrip()
 
+# PIPELINE
 
-def extract_pytest_fails(trace):
-    failures_block = False
-    for line in trace.split('\n'):
-        if line.startswith('=================================== FAILURES'):
-            failures_block = True
-            continue
-        elif failures_block and line.startswith('======================'):
-            failures_block = False
-        if failures_block:
-            yield line
+trace_extractor_registry = load_registry(TRACE_EXTRACTORS)
+
+
+def collect_error_details(errors: Iterable[str]) -> str:
+    """Join the extracted errors, keeping at most `TRACE_MAX_DETAIL_LINES` lines and
+    `TRACE_MAX_DETAIL_BYTES` characters."""
+    details = []
+    size = 0
+    for error in itertools.islice(errors, TRACE_MAX_DETAIL_LINES):
+        size += len(error) + 1
+        if size > TRACE_MAX_DETAIL_BYTES:
+            break
+        details.append(error)
+    return "\n".join(details)
+
+
+def get_job_error_details(project_id: str, build: Dict, deadline: float = None) -> str:
+    """Download the trace of a job and extract its errors. Stop reading the trace after `deadline`,
+    a `time.monotonic()` value."""
+    extractor = trace_extractor_registry.get_extractor(build)
+    with span("job_trace", job_id=build['id']), TRACE_PROCESSING_DURATION.time(), closing(
+        iter_job_trace_lines(project_id, build['id'])
+    ) as lines:
+        if deadline is not None:
+            lines = itertools.takewhile(lambda _: time.monotonic() < deadline, lines)
+        return collect_error_details(extractor.extract(lines))
+
+
+def get_jobs_error_details(project_id: str, builds: List[Dict]) -> List[str]:
+    """Get the error details of several jobs concurrently. The jobs whose trace isn't processed
+    within `PIPELINE_TRACE_DEADLINE` seconds have no details, not to delay the notification."""
+    deadline = time.monotonic() + PIPELINE_TRACE_DEADLINE
+    return map_with_deadline(
+        lambda build: get_job_error_details(project_id, build, deadline),
+        builds,
+        max_workers=TRACE_FETCH_CONCURRENCY,
+        timeout=PIPELINE_TRACE_DEADLINE,
+        default="(no details)"
+    )
 
 
 def generate_pipeline_message(j):
@@ -76,27 +171,29 @@ def generate_pipeline_message(j):
     commit_url = j['commit']['url']
     pipeline_url = f"{project_url}/pipelines/{pipeline_id}"
 
+    failed_builds = [build for build in j['builds'] if build['status'] == "failed"]
+    traced_builds = [
+        build for build in failed_builds
+        if trace_extractor_registry.get_extractor(build) is not None
+    ]
+    error_details_per_job = dict(
+        zip(
+            [build['id'] for build in traced_builds],
+            get_jobs_error_details(project_id, traced_builds)
+        )
+    )
+
     failures = []
-    for build in j['builds']:
-        if build['status'] == "failed":
-            job_id = build['id']
-            if build['stage'] in ['lint', 'test']:
-                trace = get_job_trace(project_id, job_id)
-                if build['stage'] == 'lint':
-                    errors = list(extract_lint_errors(trace))
-                    error_details = "\n".join(errors)
-                else:
-                    errors = list(extract_pytest_fails(trace))
-                    error_details = "\n".join(errors)
-            else:
-                error_details = "(no details)"
-            pretext = "Job %s failed" % build['name']
-            failure = {
-                "pretext": pretext,
-                "text": format_slack_text(error_details),
-                "link": "%s/%s/-/jobs/%d" % (GITLAB_BASE_URL, project_name, job_id)
-            }
-            failures.append(failure)
+    for build in failed_builds:
+        job_id = build['id']
+        error_details = error_details_per_job.get(job_id, "(no details)")
+        pretext = "Job %s failed" % build['name']
+        failure = {
+            "pretext": pretext,
+            "text": format_slack_text(error_details),
+            "link": "%s/%s/-/jobs/%d" % (GITLAB_BASE_URL, project_name, job_id)
+        }
+        failures.append(failure)
 
     main_message = f"{format_project_name(j)} > {format_slack_link(commit_url, commit_id[:6])} > " \
                    f"Pipeline {format_slack_link(pipeline_url, f'#{pipeline_id}')} ran with status {status}"
@@ -117,9 +214,35 @@ def generate_pipeline_message(j):
     }
 
 
+def get_users_emails_from_event_pipeline(event: Dict) -> Set[str]:
+    return {event['user']['email']}
+
+
+def get_emails_of_users(user_ids: Iterable) -> Set[str]:
+    """The emails of several users, resolved together."""
+    return {user["email"] for user in get_users(user_ids).values()}
+
+
+# MERGE REQUEST
+
+
+def get_mr_author_id(project_id: str, mr_iid: str):
+    """The ID of the author of a MR, from the MR store, or else from GitLab."""
+    author_id = mr_store.get(project_id, mr_iid, 'author_id')
+    if author_id is None:
+        author_id = get_mr(project_id, mr_iid)["author"]["id"]
+        mr_store.update(project_id, mr_iid, {'author_id': author_id})
+    return author_id
+
+
 # MERGE REQUEST COMMENT
 
 
+def note_is_on_merge_request(attributes: Dict) -> bool:
+    # comments on commits, issues and snippets aren't notified
+    return attributes.get('noteable_type', 'MergeRequest') == 'MergeRequest'
+
+
 def generate_note_message(j):
     attributes = j['object_attributes']
     comment = attributes['description']
@@ -136,39 +259,72 @@ def generate_note_message(j):
 
 
 def get_users_emails_from_event_note(event: Dict) -> Set[str]:
-    mr = get_mr(event["project_id"], event["merge_request"]["iid"])
-    user_id = mr["author"]["id"]
-    discussion = get_mr_discussion(
-        event["project_id"], event["merge_request"]["iid"],
-        event["object_attributes"]["discussion_id"]
+    # the author of the MR, the discussion and the mentions are looked up independently
+    user_id, discussion_user_ids, mentionned_user_emails = run_concurrently(
+        lambda: get_mr_author_id(event["project_id"], event["merge_request"]["iid"]),
+        lambda: get_discussion_participant_ids(event),
+        lambda: get_mentionned_user_emails(event),
     )
-    in_discussion_user_ids = {note["author"]["id"] for note in discussion["notes"]}
+    in_discussion_user_ids = set(discussion_user_ids)
     in_discussion_user_ids.add(user_id)  # we add the author of the MR if he isn't in the discussion
-    user_emails = {get_user(user_id)["email"] for user_id in in_discussion_user_ids}
+    user_emails = get_emails_of_users(in_discussion_user_ids)
     # we don't want to notify the person who triggered the comment even if he's in the discussion
     # we have to remove it by email and not by ID,
     # because the ID isn't available in event["user"]["email"]
-    user_emails.remove(event["user"]["email"])
-    user_emails.update(get_mentionned_user_emails(event))
+    user_emails.discard(event["user"]["email"])
+    user_emails.update(mentionned_user_emails)
     return user_emails
 
 
+def get_discussion_participant_ids(event: Dict) -> FrozenSet:
+    """The IDs of the authors of the notes of the discussion of a comment, the discussion is only
+    fetched from GitLab if it isn't in the discussion index."""
+    project_id = event["project_id"]
+    mr_iid = event["merge_request"]["iid"]
+    discussion_id = event["object_attributes"]["discussion_id"]
+
+    def fetch_author_ids():
+        discussion = get_mr_discussion(project_id, mr_iid, discussion_id)
+        return [note["author"]["id"] for note in discussion["notes"]]
+
+    note_author_id = event["object_attributes"].get("author_id") or event["user"].get("id")
+    return discussion_index.get_participants(
+        (str(project_id), discussion_id), note_author_id, fetch_author_ids
+    )
+
+
+# code blocks (fenced or inline) are removed from comments before looking for mentions
+CODE_REGEX = re.compile(r"```.*?(```|$)|`[^`\n]*`", re.DOTALL)
+# GitLab usernames contain letters, digits, "_", "-" and ".", but don't start with "-" or "." nor
+# end with ".". A "@" preceded by one of these characters is part of an email address, not a mention.
+MENTION_REGEX = re.compile(r"(?<![\w.+-])@([A-Za-z0-9_](?:[A-Za-z0-9_.-]*[A-Za-z0-9_-])?)")
+
+
+def extract_mentionned_user_names(comment: str) -> List[str]:
+    """Return the distinct usernames mentionned in a comment, in order of appearance."""
+    if "@" not in comment:
+        return []
+    user_names = {}
+    for user_name in MENTION_REGEX.findall(CODE_REGEX.sub(" ", comment)):
+        # GitLab usernames are case insensitive
+        user_names.setdefault(user_name.lower(), user_name)
+    return list(user_names.values())
+
+
 def get_mentionned_user_emails(event: Dict) -> Set[str]:
-    user_emails = set()
     comment = event['object_attributes']['description']
-    if "@" in comment:
-        mentionned_user_names = [x.split(" ")[0] for x in comment.split("@")[1:]]
-        mentionned_user_names = [user_name for user_name in mentionned_user_names if user_name]
-        for user_name in mentionned_user_names:
-            users = get_user_by_username(user_name)
-            if len(users) == 0:
-                print(f"No user found with user name {user_name}")
-                continue
-            if len(users) > 1:
-                raise ValueError(
-                    f"Multiple users found with user name {user_name}. How is this possible ?"
-                )
-            user_emails.add(users[0]["email"])
+    mentionned_user_names = extract_mentionned_user_names(comment)
+    users_per_name = get_users_by_username(mentionned_user_names)
+    user_emails = set()
+    for user_name, users in users_per_name.items():
+        if len(users) == 0:
+            print(f"No user found with user name {user_name}")
+            continue
+        if len(users) > 1:
+            raise ValueError(
+                f"Multiple users found with user name {user_name}. How is this possible ?"
+            )
+        user_emails.add(users[0]["email"])
     return user_emails
 
 
@@ -186,9 +342,8 @@ def generate_approval_message(event: Dict) -> Dict[str, str]:
 
 
 def get_users_emails_from_event_approval(event: Dict) -> Set[str]:
-    mr = get_mr(event["project"]["id"], event["object_attributes"]["iid"])
-    user_id = mr["author"]["id"]
-    return {get_user(user_id)["email"]}
+    user_id = get_mr_author_id(event["project"]["id"], event["object_attributes"]["iid"])
+    return get_emails_of_users([user_id])
 
 
 # MERGE REQUEST MERGED
@@ -209,7 +364,7 @@ def get_users_emails_from_event_merge(event: Dict) -> Set[str]:
         user["id"]
         for user in get_mr_participants(event["project"]["id"], event["object_attributes"]["iid"])
     ]
-    mr_participant_emails = {get_user(user_id)["email"] for user_id in mr_participant_ids}
+    mr_participant_emails = get_emails_of_users(mr_participant_ids)
     # we used to remove the email of the person who merged the MR because it seemed useless to notify him
     # nonetheless, it is useful since we often use the feature "Merge when pipeline succeeds"
     return mr_participant_emails
@@ -228,4 +383,42 @@ def generate_assignee_message(event: Dict) -> Dict[str, str]:
 
 
 def get_users_emails_from_event_assignee(event: Dict) -> Set[str]:
-    return {get_user(event['object_attributes']["assignee_id"])["email"]} - {event["user"]["email"]}
+    return get_emails_of_users([event['object_attributes']["assignee_id"]]
+                              ) - {event["user"]["email"]}
+
+
+# DISPATCH
+
+# handlers by (object_kind, action), (object_kind, None) applies to the actions that aren't listed
+EVENT_HANDLERS: Dict[Tuple[str, Optional[str]], List[EventHandler]] = {
+    ('pipeline', None): [
+        EventHandler(
+            generate_pipeline_message,
+            get_users_emails_from_event_pipeline,
+            precondition=pipeline_attributes_require_notification
+        )
+    ],
+    ('note', None): [
+        EventHandler(
+            generate_note_message,
+            get_users_emails_from_event_note,
+            precondition=note_is_on_merge_request
+        )
+    ],
+    ('merge_request', 'approved'): [
+        EventHandler(generate_approval_message, get_users_emails_from_event_approval)
+    ],
+    ('merge_request', 'merge'): [
+        EventHandler(generate_merge_message, get_users_emails_from_event_merge)
+    ],
+    ('merge_request', None): [
+        EventHandler(
+            generate_assignee_message,
+            get_users_emails_from_event_assignee,
+            precondition=attributes_have_assignee,
+            condition=event_is_assignement
+        )
+    ],
+}  # yapf: disable
+
+HANDLED_OBJECT_KINDS = {object_kind for object_kind, _ in EVENT_HANDLERS}
@@ -0,0 +1,37 @@
+"""Client-side rate limiting of the calls to external APIs."""
+
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """Allow `rate` calls per second on average, with bursts of at most `capacity` calls."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self, tokens: float = 1, timeout: Optional[float] = None) -> bool:
+        """Wait until `tokens` are available and consume them. Returns False if they were not
+        available within `timeout` seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            # sleep outside of the lock, so that other threads can check the bucket meanwhile
+            time.sleep(wait)
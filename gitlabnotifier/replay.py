@@ -0,0 +1,214 @@
+"""Replay of archived webhook payloads, e.g. after an outage: `gitlabnotifier replay events.ndjson`.
+
+The file has a payload per line. It is read line by line, and the events are processed by a
+`WorkerPool`, so the events of a MR are still processed in order. The pool's queue is bounded, so the
+file is never loaded in memory.
+
+The checkpoint is the position before which all the lines were processed. It is saved periodically
+and at the end, so that an interrupted replay resumes from it.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import IO, Callable, Dict, Iterator, Optional, Tuple
+
+from gitlabnotifier.event_filter import should_drop
+from gitlabnotifier.mr_store import mr_store
+from gitlabnotifier.process_gitlab_notif import (
+    get_event_priority, get_messages_and_emails_from_event, get_partition_key)
+from gitlabnotifier.resilience import priority
+from gitlabnotifier.worker import WorkerPool
+
+
+def parse_time(value: str) -> datetime:
+    """Parse the times of the payloads, e.g. "2019-05-15 14:44:56 UTC" or
+    "2019-05-15T14:44:56.123Z". Times without a timezone are in UTC."""
+    value = value.strip()
+    if value.endswith(" UTC"):
+        value = value[:-len(" UTC")] + "+00:00"
+    elif value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.fromisoformat(value)
+    return parsed if parsed.tzinfo is not None else parsed.replace(tzinfo=timezone.utc)
+
+
+def get_event_time(event: Dict) -> Optional[datetime]:
+    """When the object of the event was last updated, None if the payload doesn't tell."""
+    attributes = event.get('object_attributes') or {}
+    for key in ('updated_at', 'finished_at', 'created_at'):
+        if attributes.get(key):
+            try:
+                return parse_time(attributes[key])
+            except ValueError:
+                return None
+    return None
+
+
+def load_checkpoint(path: str, input_path: str) -> Tuple[int, int]:
+    """The number and the offset of the first line to replay, (1, 0) if there is no checkpoint."""
+    if not os.path.exists(path):
+        return 1, 0
+    with open(path, encoding='utf-8') as f:
+        checkpoint = json.load(f)
+    if checkpoint["input"] != os.path.abspath(input_path):
+        raise ValueError(f"The checkpoint {path} is the one of {checkpoint['input']}.")
+    return checkpoint["line"], checkpoint["offset"]
+
+
+def save_checkpoint(path: str, input_path: str, line_number: int, offset: int):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"input": os.path.abspath(input_path), "line": line_number, "offset": offset}, f)
+    os.replace(tmp_path, path)
+
+
+def iter_lines(f: IO[bytes], line_number: int, offset: int) -> Iterator[Tuple[int, int, bytes]]:
+    """(number, offset after the line, line) of the lines of a binary file, from `offset`."""
+    f.seek(offset)
+    while True:
+        line = f.readline()
+        if not line:
+            return
+        offset += len(line)
+        yield line_number, offset, line
+        line_number += 1
+
+
+class _Progress:
+    """The lines being processed, to know the position before which all the lines were processed."""
+
+    def __init__(self, line_number: int, offset: int):
+        # offsets of the lines being processed, by number
+        self._pending: Dict[int, int] = {}
+        self._next = (line_number, offset)
+        self._lock = threading.Lock()
+
+    def read(self, line_number: int, offset: int, next_offset: int, pending: bool):
+        with self._lock:
+            if pending:
+                self._pending[line_number] = offset
+            self._next = (line_number + 1, next_offset)
+
+    def done(self, line_number: int):
+        with self._lock:
+            del self._pending[line_number]
+
+    @property
+    def position(self) -> Tuple[int, int]:
+        with self._lock:
+            if self._pending:
+                line_number = min(self._pending)
+                return line_number, self._pending[line_number]
+            return self._next
+
+
+def replay_events(
+    input_path: str,
+    handler: Callable[[Dict], None],
+    concurrency: int,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    checkpoint_path: Optional[str] = None,
+    checkpoint_interval: int = 1000,
+) -> Dict[str, float]:
+    """Process the events of the file with `handler(event)`, and return the counts of the events by
+    outcome. Events whose time isn't within [`since`, `until`) are skipped, as well as events
+    without a time if one of them is given."""
+    line_number, offset = (
+        1, 0
+    ) if checkpoint_path is None else load_checkpoint(checkpoint_path, input_path)
+    stats = {"read": 0, "dropped": 0, "invalid": 0, "out_of_range": 0, "processed": 0, "failed": 0}
+    stats_lock = threading.Lock()
+    progress = _Progress(line_number, offset)
+
+    def count(outcome: str):
+        with stats_lock:
+            stats[outcome] += 1
+
+    def process(item: Tuple[int, Dict]):
+        number, event = item
+        try:
+            handler(event)
+            count("processed")
+        except Exception:  # pylint: disable=broad-except
+            logging.exception(f"Failed to replay the event of line {number}.")
+            count("failed")
+        finally:
+            progress.done(number)
+
+    pool = WorkerPool(
+        process,
+        worker_count=concurrency,
+        queue_size=concurrency * 10,
+        partition_key=lambda item: get_partition_key(item[1]),
+    )
+    start = time.perf_counter()
+    with open(input_path, 'rb') as f:
+        for number, next_offset, line in iter_lines(f, line_number, offset):
+            event, outcome = _read_event(line, since, until)
+            count("read")
+            if outcome is not None:
+                count(outcome)
+            progress.read(number, next_offset - len(line), next_offset, pending=event is not None)
+            if event is not None:
+                pool.submit((number, event), block=True)
+            if checkpoint_path is not None and stats["read"] % checkpoint_interval == 0:
+                save_checkpoint(checkpoint_path, input_path, *progress.position)
+    pool.shutdown()
+    if checkpoint_path is not None:
+        save_checkpoint(checkpoint_path, input_path, *progress.position)
+    stats["duration"] = time.perf_counter() - start
+    return stats
+
+
+def _read_event(line: bytes, since: Optional[datetime],
+                until: Optional[datetime]) -> Tuple[Optional[Dict], Optional[str]]:
+    """The event of a line, or None and the reason why it is skipped, None for blank lines."""
+    if not line.strip():
+        return None, None
+    if should_drop(None, line):
+        return None, "dropped"
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None, "invalid"
+    if not isinstance(event, dict):
+        return None, "invalid"
+    if since is not None or until is not None:
+        event_time = get_event_time(event)
+        if (
+            event_time is None or (since is not None and event_time < since) or
+            (until is not None and event_time >= until)
+        ):
+            return None, "out_of_range"
+    return event, None
+
+
+class MessageRecorder:
+    """Handler of the dry runs: writes the messages that would be sent, and their recipients, to a
+    file instead of sending them."""
+
+    def __init__(self, output: IO[str]):
+        self.output = output
+        self._lock = threading.Lock()
+
+    def __call__(self, event: Dict):
+        # as when the events are received, see `app.handle_event`
+        mr_store.update_from_event(event)
+        with priority(get_event_priority(event)):
+            message, emails = get_messages_and_emails_from_event(event)
+        if not message:
+            return
+        record = json.dumps(
+            {
+                "object_kind": event.get('object_kind'),
+                "message": message,
+                "emails": sorted(emails)
+            }
+        )
+        with self._lock:
+            self.output.write(record + "\n")
@@ -0,0 +1,288 @@
+"""Protection of the notifier, and of GitLab and Slack, when one of them slows down or fails.
+
+- a circuit breaker per upstream stops calling it after consecutive failures, so that events fail
+  fast instead of each waiting for its timeouts. After `reset_timeout` seconds, a single call probes
+  the upstream, and closes the circuit if it succeeds.
+- an adaptive limit of the concurrent calls to GitLab: it decreases when the latency of the calls
+  exceeds a target, and slowly increases again while it is below, so that a slow GitLab isn't sent
+  more requests than it can answer.
+- the calls waiting for a slot are served by priority, the priority of the event being processed
+  (see `priority`): low priority calls, e.g. for comments, are shed after waiting
+  `low_priority_max_wait` seconds, so that pipeline failures are notified first.
+"""
+
+import contextvars
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Mapping, Optional
+
+from gitlabnotifier.metrics import counter
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+# propagated to the threads of `concurrency.py`
+_priority = contextvars.ContextVar('priority', default=NORMAL)
+
+CIRCUIT_TRANSITIONS = counter(
+    "gitlabnotifier_circuit_transitions_total", "State changes of the circuit breakers.",
+    ("upstream", "state")
+)
+SHED_CALLS = counter(
+    "gitlabnotifier_shed_calls_total", "Calls given up because their upstream was overloaded.",
+    ("upstream", "priority")
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open."""
+
+
+class OverloadedError(Exception):
+    """Raised when a call waited too long for its upstream."""
+
+
+@contextmanager
+def priority(value: int):
+    """Set the priority of the calls made by the current thread, and by the threads it starts."""
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def get_priority() -> int:
+    return _priority.get()
+
+
+class _Call:
+    """Outcome of a call, reported by the caller: a call reported neither as a success nor as a
+    failure, e.g. because it wasn't made, doesn't change the state of the circuit."""
+
+    def __init__(self):
+        self.success: Optional[bool] = None
+        # reported to an `AdaptiveLimiter` instead of the duration of the call, e.g. the time to the
+        # first byte of a streamed response, whose download can be long
+        self.latency: Optional[float] = None
+
+    def succeeded(self):
+        self.success = True
+
+    def failed(self):
+        self.success = False
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failure_count = 0
+        self._opened_at = 0.
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.state != self.CLOSED
+
+    @contextmanager
+    def guard(self) -> Iterator[_Call]:
+        """Raise a `CircuitOpenError` if the circuit is open, else yield the call, whose outcome the
+        caller reports with `succeeded()` or `failed()`."""
+        probe = self._before_call()
+        call = _Call()
+        try:
+            yield call
+        finally:
+            self._after_call(probe, call.success)
+
+    def _before_call(self) -> bool:
+        """Returns whether the call is the probe of a half-open circuit."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+        raise CircuitOpenError(f"The circuit of {self.name} is open.")
+
+    def _after_call(self, probe: bool, success: Optional[bool]):
+        with self._lock:
+            if probe:
+                self._probing = False
+            if success is None:
+                return
+            if success:
+                self._failure_count = 0
+                if probe:
+                    self._set_state(self.CLOSED)
+                return
+            self._failure_count += 1
+            if probe or (
+                self.state == self.CLOSED and self._failure_count >= self.failure_threshold
+            ):
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        if state == self.OPEN:
+            logging.warning(
+                f"Opening the circuit of {self.name} after {self._failure_count} "
+                "failures."
+            )
+        elif state == self.CLOSED:
+            logging.info(f"Closing the circuit of {self.name}.")
+        self.state = state
+        CIRCUIT_TRANSITIONS.labels(self.name, state).inc()
+
+
+class AdaptiveLimiter:
+    """Limit of the concurrent calls to an upstream, between `min_limit` and `max_limit`. The limit is
+    multiplied by `backoff` when a call is slower than `latency_target` or fails, and increases by 1
+    every `limit` calls faster than it (additive increase, multiplicative decrease)."""
+
+    def __init__(
+        self,
+        name: str,
+        min_limit: int,
+        max_limit: int,
+        latency_target: float,
+        low_priority_max_wait: Optional[float] = None,
+        backoff: float = 0.9,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.low_priority_max_wait = low_priority_max_wait
+        self.backoff = backoff
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        # (priority, arrival) of the waiting calls
+        self._waiters: List = []
+        self._arrivals = itertools.count()
+        self._condition = threading.Condition()
+
+    @property
+    def waiting_count(self) -> int:
+        return len(self._waiters)
+
+    @contextmanager
+    def slot(self, call_priority: Optional[int] = None) -> Iterator[_Call]:
+        """Wait for a slot, the highest priority first. Low priority calls raise an
+        `OverloadedError` if they waited more than `low_priority_max_wait` seconds. Yield the call,
+        whose outcome and latency the caller may report, else the call failed if the block raised,
+        and its latency is the duration of the block."""
+        call_priority = get_priority() if call_priority is None else call_priority
+        self._acquire(call_priority)
+        start = time.perf_counter()
+        call = _Call()
+        try:
+            yield call
+        except BaseException:
+            if call.success is None:
+                call.failed()
+            raise
+        finally:
+            latency = time.perf_counter() - start if call.latency is None else call.latency
+            self._release(latency, call.success is not False)
+
+    def _acquire(self, call_priority: int):
+        with self._condition:
+            if not self._waiters and self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return
+            waiter = (call_priority, next(self._arrivals))
+            heapq.heappush(self._waiters, waiter)
+            deadline = None
+            if call_priority >= LOW and self.low_priority_max_wait is not None:
+                deadline = time.monotonic() + self.low_priority_max_wait
+            while self._waiters[0] != waiter or self.in_flight >= int(self.limit):
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+                    self._condition.notify_all()
+                    SHED_CALLS.labels(self.name, PRIORITY_NAMES.get(call_priority, "low")).inc()
+                    raise OverloadedError(
+                        f"No call to {self.name} could be made within {self.low_priority_max_wait}s."
+                    )
+                self._condition.wait(timeout)
+            heapq.heappop(self._waiters)
+            self.in_flight += 1
+            self._condition.notify_all()
+
+    def _release(self, latency: float, success: bool):
+        with self._condition:
+            self.in_flight -= 1
+            if not success or latency > self.latency_target:
+                self.limit = max(float(self.min_limit), self.limit * self.backoff)
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class RateLimitGate:
+    """Client-side throttling from the `RateLimit-Remaining` and `RateLimit-Reset` headers of GitLab:
+    once at most `reserve` requests remain, calls wait for the reset of the quota rather than being
+    answered with a 429. Low priority calls are shed instead of waiting more than
+    `low_priority_max_wait` seconds."""
+
+    def __init__(
+        self,
+        name: str,
+        reserve: int,
+        max_delay: float = 60,
+        low_priority_max_wait: Optional[float] = None
+    ):
+        self.name = name
+        self.reserve = reserve
+        self.max_delay = max_delay
+        self.low_priority_max_wait = low_priority_max_wait
+        self._resume_at = 0.
+
+    def wait(self, call_priority: Optional[int] = None):
+        delay = min(self._resume_at - time.time(), self.max_delay)
+        if delay <= 0:
+            return
+        call_priority = get_priority() if call_priority is None else call_priority
+        if (
+            call_priority >= LOW and self.low_priority_max_wait is not None and
+            delay > self.low_priority_max_wait
+        ):
+            SHED_CALLS.labels(self.name, PRIORITY_NAMES.get(call_priority, "low")).inc()
+            raise OverloadedError(f"The rate limit of {self.name} resets in {delay:.0f}s.")
+        time.sleep(delay)
+
+    def update(self, headers: Mapping[str, str]):
+        """`RateLimit-Reset` is a Unix timestamp, see
+        https://docs.gitlab.com/ee/user/admin_area/settings/user_and_ip_rate_limits.html"""
+        try:
+            remaining = int(headers['RateLimit-Remaining'])
+            reset = float(headers['RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return
+        if remaining <= self.reserve:
+            if self._resume_at < time.time():
+                logging.warning(
+                    f"{remaining} requests to {self.name} remain until {reset:.0f}, "
+                    "throttling."
+                )
+            self._resume_at = reset
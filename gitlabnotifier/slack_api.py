@@ -1,35 +1,326 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, Iterator, Optional
+
 from slack import WebClient
+from slack.errors import SlackApiError
 
-from gitlabnotifier.constants import FLASK_ENV, SLACK_API_TOKEN
+from gitlabnotifier.concurrency import map_concurrently
+from gitlabnotifier.constants import (CIRCUIT_FAILURE_THRESHOLD,
+                                      CIRCUIT_RESET_TIMEOUT, FLASK_ENV,
+                                      SLACK_API_TOKEN, SLACK_API_URL,
+                                      SLACK_DELIVERY_CONCURRENCY,
+                                      SLACK_DIRECTORY_LOAD_TIMEOUT,
+                                      SLACK_DM_CHANNELS_PATH,
+                                      SLACK_MAX_RETRIES, SLACK_RATE_LIMIT,
+                                      SLACK_RATE_LIMIT_BURST,
+                                      SLACK_USERS_PAGE_SIZE)
+from gitlabnotifier.metrics import SLACK_CALL_DURATION, SLACK_ERRORS
+from gitlabnotifier.ratelimit import TokenBucket
+from gitlabnotifier.resilience import CircuitBreaker
+from gitlabnotifier.tracing import span
 
-slack_client = WebClient(token=SLACK_API_TOKEN) if SLACK_API_TOKEN is not None else None
+slack_client = WebClient(
+    token=SLACK_API_TOKEN, base_url=SLACK_API_URL
+) if SLACK_API_TOKEN is not None else None
 # during unit tests, `SLACK_API_TOKEN` is None
 
+slack_breaker = CircuitBreaker("slack", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+
+def _call_slack(method, bucket: TokenBucket = None, **kwargs):
+    """Call a method of the Slack client, retrying after the delay given by Slack when we are rate
+    limited. Other errors raise a `SlackApiError`, or a `CircuitOpenError` while Slack is failing:
+    server and network errors count as failures of Slack, other errors are answers of Slack."""
+    method_name = getattr(method, '__name__', 'unknown')
+    with span(f"slack.{method_name}"), SLACK_CALL_DURATION.labels(method_name).time(), \
+            slack_breaker.guard() as call:
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                res = method(**kwargs)
+                call.succeeded()
+                return res
+            except SlackApiError as e:
+                SLACK_ERRORS.labels(method_name, str(e.response.get('error'))).inc()
+                if e.response.status_code >= 500:
+                    call.failed()
+                    raise
+                call.succeeded()
+                if e.response.status_code != 429 or attempt >= SLACK_MAX_RETRIES:
+                    raise
+                retry_after = float(e.response.headers.get('Retry-After', 1))
+            except (OSError, ValueError):
+                # connection errors and timeouts of urllib, used by the client, are `OSError`s, and
+                # the HTML page of a server error can't be decoded
+                call.failed()
+                raise
+            attempt += 1
+            time.sleep(retry_after)
 
-def get_email_to_slack_name():
-    email_to_slack_name = {}
+
+def iter_slack_members() -> Iterator[Dict]:
+    """https://api.slack.com/methods/users.list, members already contain their profile"""
     if slack_client is None:
         raise ValueError("You must specify `SLACK_API_TOKEN` to access the Slack API.")
-    res = slack_client.users_list()
-    members = res['members']
-    for member in members:
-        res = slack_client.users_profile_get(user=member['id'])
-        email = res['profile'].get('email')
+    kwargs = {'limit': SLACK_USERS_PAGE_SIZE}
+    while True:
+        res = _call_slack(slack_client.users_list, **kwargs)
+        yield from res['members']
+        cursor = res.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return
+        kwargs['cursor'] = cursor
+
+
+def _get_member_email(member: Dict) -> Optional[str]:
+    if member.get('deleted'):
+        return None
+    return member.get('profile', {}).get('email') or None
+
+
+def get_email_to_slack_id() -> Dict[str, str]:
+    """The IDs of the Slack users by email. IDs don't change, unlike names which users can edit."""
+    email_to_slack_id = {}
+    for member in iter_slack_members():
+        email = _get_member_email(member)
         if email:
-            email_to_slack_name[email] = '@' + member['name']
-    return email_to_slack_name
+            email_to_slack_id[email] = member['id']
+    return email_to_slack_id
+
+
+def open_dm_channel(user_id: str) -> str:
+    """https://api.slack.com/methods/conversations.open, returns the ID of the DM channel of the bot
+    with a user. The channel is the same for every call."""
+    res = _call_slack(slack_client.conversations_open, users=user_id)
+    return res['channel']['id']
+
+
+class SlackDirectory:
+    """Read-only mapping of emails to Slack user IDs, which can be refreshed in the background.
+    A refresh builds a new map and swaps it in a single assignment, so that readers never see a
+    partially built map. Between two refreshes, the users changed on Slack are updated one by one
+    from the events sent by Slack, see `update_user`.
+
+    A directory created without a map is loaded from a snapshot (see `snapshot.py`) or by the first
+    background refresh. Lookups wait for it until `SLACK_DIRECTORY_LOAD_TIMEOUT` seconds after the
+    first lookup, then don't wait anymore, e.g. if Slack is unreachable.
+
+    The directory also keeps the DM channels opened with the users, saved to `dm_channels_path` if
+    given, so that they are opened once, and not on every restart."""
+
+    def __init__(self, email_to_slack_id: Dict[str, str] = None, dm_channels_path: str = None):
+        self._email_to_slack_id = dict(email_to_slack_id or {})
+        self._loaded = threading.Event()
+        # `time.monotonic()` after which lookups don't wait for the directory, set by the first one
+        self._load_deadline: Optional[float] = None
+        # False until the map is fetched from Slack, e.g. if it was loaded from a snapshot
+        self._fresh = email_to_slack_id is not None
+        if email_to_slack_id is not None:
+            self._loaded.set()
+        self._dm_channels_path = dm_channels_path
+        self._dm_channels: Dict[str, str] = self._load_dm_channels()
+        self._dm_channels_lock = threading.Lock()
+        self._refresh_pid = None
+        self._refresh_lock = threading.Lock()
+        self._update_lock = threading.Lock()
+
+    def __contains__(self, email: str) -> bool:
+        self._wait_loaded()
+        return email in self._email_to_slack_id
+
+    def __getitem__(self, email: str) -> str:
+        self._wait_loaded()
+        return self._email_to_slack_id[email]
+
+    def __len__(self) -> int:
+        return len(self._email_to_slack_id)
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the directory was fetched from Slack or loaded from a snapshot."""
+        return self._loaded.is_set()
+
+    def get(self, email: str, default: str = None) -> str:
+        self._wait_loaded()
+        return self._email_to_slack_id.get(email, default)
+
+    def _wait_loaded(self):
+        if self._loaded.is_set():
+            return
+        with self._refresh_lock:
+            if self._load_deadline is None:
+                self._load_deadline = time.monotonic() + SLACK_DIRECTORY_LOAD_TIMEOUT
+            timeout = self._load_deadline - time.monotonic()
+        if timeout > 0 and not self._loaded.wait(timeout):
+            logging.warning("The Slack directory isn't loaded yet, users won't be found.")
+
+    def refresh(self):
+        email_to_slack_id = get_email_to_slack_id()
+        with self._update_lock:
+            self._email_to_slack_id = email_to_slack_id
+        self._fresh = True
+        self._loaded.set()
+
+    def update_user(self, member: Dict):
+        """Update a single user, given as in users.list, e.g. from a `user_change` or `team_join`
+        event: the new map is swapped in like on a refresh, without fetching all the users."""
+        email = _get_member_email(member)
+        with self._update_lock:
+            # the previous email of the user, if it changed
+            email_to_slack_id = {
+                e: user_id
+                for e, user_id in self._email_to_slack_id.items()
+                if user_id != member['id']
+            }
+            if email:
+                email_to_slack_id[email] = member['id']
+            self._email_to_slack_id = email_to_slack_id
+
+    def dump(self) -> Dict:
+        """The directory and the DM channels, in a JSON-serializable format, see `load`."""
+        return {
+            "email_to_slack_id": self._email_to_slack_id,
+            "dm_channels": dict(self._dm_channels)
+        }
+
+    def load(self, state: Dict):
+        """Load a dumped directory, unless the directory was already fetched from Slack."""
+        if not self._fresh:
+            with self._update_lock:
+                self._email_to_slack_id = dict(state["email_to_slack_id"])
+            self._loaded.set()
+        with self._dm_channels_lock:
+            self._dm_channels = {**state["dm_channels"], **self._dm_channels}
+
+    def get_dm_channel(self, user_id: str) -> str:
+        """The ID of the DM channel with a user, opened on first use. If it can't be opened, the ID of
+        the user is returned: Slack then posts to the same channel, resolving it on each message."""
+        channel = self._dm_channels.get(user_id)
+        if channel is not None:
+            return channel
+        if slack_client is None:
+            return user_id
+        try:
+            channel = open_dm_channel(user_id)
+        except SlackApiError:
+            logging.exception(f"Failed to open a DM channel with {user_id}.")
+            return user_id
+        with self._dm_channels_lock:
+            self._dm_channels[user_id] = channel
+            self._save_dm_channels()
+        return channel
+
+    def _load_dm_channels(self) -> Dict[str, str]:
+        if not self._dm_channels_path or not os.path.exists(self._dm_channels_path):
+            return {}
+        try:
+            with open(self._dm_channels_path, encoding='utf-8') as f:
+                return json.load(f)
+        except ValueError:
+            logging.exception(f"Ignoring the invalid DM channels file {self._dm_channels_path}.")
+            return {}
+
+    def _save_dm_channels(self):
+        if not self._dm_channels_path:
+            return
+        # written to a temporary file then renamed, so that the file is never partially written
+        tmp_path = f"{self._dm_channels_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._dm_channels, f)
+            os.replace(tmp_path, self._dm_channels_path)
+        except OSError:
+            logging.exception(f"Failed to save the DM channels to {self._dm_channels_path}.")
+
+    def start_background_refresh(self, interval: float):
+        """Refresh the directory every `interval` seconds, and right away if it wasn't fetched from
+        Slack yet. Threads don't survive a fork, so the refresh is started again in a forked
+        process."""
+        with self._refresh_lock:
+            if self._refresh_pid == os.getpid() or (interval <= 0 and self._fresh):
+                return
+            self._refresh_pid = os.getpid()
+            threading.Thread(
+                target=self._refresh_forever,
+                args=(interval,),
+                name="gitlabnotifier-slack-directory",
+                daemon=True
+            ).start()
+
+    def _refresh_forever(self, interval: float):
+        retry_delay = 1
+        while not self._fresh:
+            # the snapshot is revalidated, or the directory is loaded for the first time
+            if not self.try_refresh():
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+        while interval > 0:
+            time.sleep(interval)
+            self.try_refresh()
+
+    def try_refresh(self) -> bool:
+        try:
+            self.refresh()
+            return True
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Failed to refresh the Slack directory, keeping the previous one.")
+            return False
 
 
 if FLASK_ENV == 'development' or slack_client is None:
-    # Hard-coded names for testing
-    EMAIL_TO_SLACK_NAME = {
-        "test@mycompany.com": "@test",
-    }
+    # Hard-coded IDs for testing
+    EMAIL_TO_SLACK_ID = SlackDirectory({
+        "test@mycompany.com": "UTEST",
+    })
 else:
-    EMAIL_TO_SLACK_NAME = get_email_to_slack_name()
+    # loaded by `start_background_tasks`, not to call Slack on import
+    EMAIL_TO_SLACK_ID = SlackDirectory(dm_channels_path=SLACK_DM_CHANNELS_PATH)
+
+# chat.postMessage has its own rate limit tier: about one message per second per channel,
+# with short bursts tolerated. Since we mostly send DMs, each to a different channel,
+# the limit is enforced globally, with a higher rate.
+post_message_bucket = TokenBucket(rate=SLACK_RATE_LIMIT, capacity=SLACK_RATE_LIMIT_BURST)
 
 
 def slack_message(message, channel):
-    return slack_client.chat_postMessage(
-        channel=channel, username='gitlabnotifier', icon_emoji=':gitlab:', **message
-    )
+    """Post a message, retrying after the delay given by Slack when we are rate limited.
+    Returns the response of Slack, check `response['ok']` to know if the message was sent."""
+    try:
+        return _call_slack(
+            slack_client.chat_postMessage,
+            bucket=post_message_bucket,
+            channel=channel,
+            username='gitlabnotifier',
+            icon_emoji=':gitlab:',
+            **message
+        )
+    except SlackApiError as e:
+        return e.response
+
+
+def slack_direct_message(message, user_id: str):
+    """Post a message to a Slack user, in the DM channel of the bot with the user."""
+    return slack_message(message, EMAIL_TO_SLACK_ID.get_dm_channel(user_id))
+
+
+def slack_direct_messages(message, user_ids: Iterable[str]) -> Dict:
+    """Post the same message to several users concurrently, returns the responses by user ID. A
+    message that couldn't be posted, e.g. while the circuit of Slack is open, gets a response that
+    isn't ok instead of failing the others: retrying the event would post them twice."""
+
+    def send(user_id: str) -> Dict:
+        try:
+            return slack_direct_message(message, user_id)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.exception(f"Failed to send a message to {user_id}.")
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+    user_ids = list(user_ids)
+    responses = map_concurrently(send, user_ids, max_workers=SLACK_DELIVERY_CONCURRENCY)
+    return dict(zip(user_ids, responses))
@@ -0,0 +1,102 @@
+"""Snapshot of the warm state of the notifier, to start serving right away after a restart.
+
+Without it, a new process has to fetch the whole Slack directory before notifying anyone, and the
+GitLab users and MRs of the first events. The Slack directory, the DM channels, the GitLab users and
+the MR store are saved periodically and on exit to a gzipped JSON file, loaded when the process
+starts, then revalidated in the background (see `SlackDirectory.start_background_refresh`). The
+discussion index isn't saved: the comments received while the notifier was down would be missed.
+"""
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from gitlabnotifier.gitlab_api import dump_user_cache, load_user_cache
+from gitlabnotifier.mr_store import mr_store
+from gitlabnotifier.slack_api import EMAIL_TO_SLACK_ID
+
+# incremented when the format changes, snapshots of another version are ignored
+SNAPSHOT_VERSION = 1
+
+
+def take_snapshot() -> Dict:
+    return {
+        "version": SNAPSHOT_VERSION,
+        "created_at": time.time(),
+        "slack_directory": EMAIL_TO_SLACK_ID.dump(),
+        "gitlab_users": dump_user_cache(),
+        "mr_store": mr_store.dump(),
+    }
+
+
+def restore_snapshot(snapshot: Dict):
+    age = max(0., time.time() - snapshot["created_at"])
+    EMAIL_TO_SLACK_ID.load(snapshot["slack_directory"])
+    load_user_cache(snapshot["gitlab_users"], age)
+    mr_store.load(snapshot["mr_store"])
+
+
+def save_snapshot(path: str):
+    """Write the snapshot to a temporary file then rename it, so that the file is never partially
+    written, even when several processes save it."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=1) as f:
+            json.dump(take_snapshot(), f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+    except OSError:
+        logging.exception(f"Failed to save the snapshot to {path}.")
+
+
+def load_snapshot(path: str) -> bool:
+    """Restore the snapshot saved to `path`, returns whether it was found and valid."""
+    if not os.path.exists(path):
+        return False
+    start = time.perf_counter()
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            logging.warning(f"Ignoring the snapshot {path} of version {snapshot.get('version')}.")
+            return False
+        restore_snapshot(snapshot)
+    except (OSError, ValueError, KeyError, TypeError):
+        logging.exception(f"Ignoring the invalid snapshot {path}.")
+        return False
+    logging.info(f"Loaded the snapshot {path} in {time.perf_counter() - start:.3f}s.")
+    return True
+
+
+class SnapshotSaver:
+    """Save the snapshot every `interval` seconds in a background thread, and on exit. Only the
+    processes which started the saver save the snapshot: the master process of `gitlabnotifier serve`
+    only has the state loaded on startup."""
+
+    def __init__(self, path: str, interval: float):
+        self.path = path
+        self.interval = interval
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Threads don't survive a fork, so the thread is started again in a forked process."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            if self.interval > 0:
+                threading.Thread(target=self._run, name="gitlabnotifier-snapshot",
+                                 daemon=True).start()
+
+    def save(self):
+        if self._pid == os.getpid():
+            save_snapshot(self.path)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.save()
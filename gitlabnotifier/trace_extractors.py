@@ -0,0 +1,189 @@
+"""Extraction of the errors of a job from its trace.
+
+A rule set describes the errors reported by a tool (pytest, flake8...), the registry maps the jobs,
+by stage and name, to the rule sets that apply to them. The rules of a job are combined into a single
+extractor, which scans the trace in a single pass whatever the number of rules.
+
+Running a regex on each line of a trace is slow, so each rule also gives the literals that any
+matching line contains. Lines are processed by batches, in which these literals are searched with
+`str.find`, and only the few lines containing one of them are matched against the regexes.
+"""
+
+import bisect
+import fnmatch
+import functools
+import itertools
+import json
+import re
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+BATCH_SIZE = 1024  # lines
+
+
+class Rule(NamedTuple):
+    """A line matching `pattern` is an error, such a line contains one of `literals`.
+    If `end_pattern` is given, the line starts a block of errors, ended by the next line matching
+    `end_pattern`, which contains `end_literal`: the lines of the block are errors."""
+    pattern: str
+    literals: Tuple[str, ...]
+    end_pattern: Optional[str] = None
+    end_literal: Optional[str] = None
+    # for tools reporting a single block of errors, there is no need to read the rest of the trace
+    stop_after_block: bool = False
+
+
+RULE_SETS: Dict[str, List[Rule]] = {
+    'pytest':
+        [
+            Rule(
+                r"^=+ FAILURES =+",
+                literals=(" FAILURES ",),
+                end_pattern=r"^={22}",
+                end_literal="=" * 22,
+                stop_after_block=True
+            )
+        ],
+    'flake8': [Rule(r"^\S+:\d+:\d+: [EF]\d+ ", literals=(": ",))],
+    'pylint':
+        [
+            Rule(r"\[E", literals=("[E",)),
+            Rule(r"^\S+:\d+:\d+: [EF]\d{4}: ", literals=(": ",)),
+        ],
+    'mypy': [Rule(r"^\S+:\d+(?::\d+)?: error: ", literals=(": error: ",))],
+    'generic':
+        [
+            Rule(r"^(?:ERROR|FATAL|Error)\b", literals=("ERROR", "FATAL", "Error")),
+            Rule(r"^Traceback \(most recent call last\)", literals=("Traceback",)),
+        ],
+}
+
+# (stage pattern, job name pattern, rule set names), the first matching entry applies
+DEFAULT_REGISTRY: List[Tuple[str, str, List[str]]] = [
+    ('lint', '*', ['pylint', 'flake8', 'mypy']),
+    ('test', '*', ['pytest']),
+]
+
+
+def _combine(patterns: Dict[int, str]) -> Optional[re.Pattern]:
+    """A single pattern with a named group per rule, to know which rule matched"""
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?P<r{i}>{pattern})" for i, pattern in patterns.items()))
+
+
+class Extractor:
+
+    def __init__(self, rules: List[Rule]):
+        self.rules = rules
+        # anchored patterns are tried at the start of lines only, which is much faster
+        self._anchored_pattern = _combine(
+            {
+                i: rule.pattern[1:] for i, rule in enumerate(rules) if rule.pattern.startswith("^")
+            }
+        )
+        self._floating_pattern = _combine(
+            {
+                i: rule.pattern for i, rule in enumerate(rules) if not rule.pattern.startswith("^")
+            }
+        )
+        self._end_patterns = [rule.end_pattern and re.compile(rule.end_pattern) for rule in rules]
+        self._literals = {literal for rule in rules for literal in rule.literals}
+        self._literals.update(rule.end_literal for rule in rules if rule.end_literal)
+
+    def _match(self, line: str) -> Optional[int]:
+        """Index of the rule matching the line, if any"""
+        match = self._anchored_pattern and self._anchored_pattern.match(line)
+        if not match:
+            match = self._floating_pattern and self._floating_pattern.search(line)
+        return int(match.lastgroup[1:]) if match else None
+
+    def _candidate_lines(self, batch: List[str]) -> List[int]:
+        """Indexes of the lines of the batch containing a literal"""
+        text = "\n".join(batch)
+        positions = [(literal, text.find(literal)) for literal in self._literals]
+        positions = [(literal, position) for literal, position in positions if position != -1]
+        if not positions:
+            # most of the batches, no need to locate the lines
+            return []
+        line_starts = [0]
+        line_starts.extend(itertools.accumulate(len(line) + 1 for line in batch))
+        candidates = set()
+        for literal, position in positions:
+            while position != -1:
+                line_index = bisect.bisect_right(line_starts, position) - 1
+                candidates.add(line_index)
+                position = text.find(literal, line_starts[line_index + 1])
+        return sorted(candidates)
+
+    def extract(self, lines: Iterable[str]) -> Iterator[str]:
+        lines = iter(lines)
+        end_pattern = None  # set while in a block
+        stop_after_block = False
+        while True:
+            batch = list(itertools.islice(lines, BATCH_SIZE))
+            if not batch:
+                return
+            block_start = 0
+            for line_index in self._candidate_lines(batch):
+                line = batch[line_index]
+                if end_pattern is not None:
+                    if end_pattern.match(line):
+                        yield from batch[block_start:line_index]
+                        if stop_after_block:
+                            return
+                        end_pattern = None
+                    continue
+                rule_index = self._match(line)
+                if rule_index is None:
+                    continue
+                if self._end_patterns[rule_index] is not None:
+                    end_pattern = self._end_patterns[rule_index]
+                    stop_after_block = self.rules[rule_index].stop_after_block
+                    block_start = line_index + 1
+                else:
+                    yield line.rstrip()
+            if end_pattern is not None:
+                yield from batch[block_start:]
+
+
+class ExtractorRegistry:
+
+    def __init__(self, entries: List[Tuple[str, str, List[str]]]):
+        self.entries = list(entries)
+
+    def register(self, rule_set_names: List[str], stage: str = '*', name: str = '*'):
+        """Apply rule sets to the jobs whose stage and name match the given glob patterns. Registered
+        entries take precedence over the previous ones."""
+        unknown_names = set(rule_set_names) - set(RULE_SETS)
+        if unknown_names:
+            raise ValueError(f"Unknown rule sets {unknown_names}, available: {list(RULE_SETS)}")
+        self.entries.insert(0, (stage, name, list(rule_set_names)))
+
+    def get_extractor(self, build: Dict) -> Optional[Extractor]:
+        """Return the extractor for a job of a pipeline event, None if its errors aren't extracted."""
+        for stage, name, rule_set_names in self.entries:
+            if not fnmatch.fnmatchcase(build['stage'], stage):
+                continue
+            if fnmatch.fnmatchcase(build['name'], name):
+                return _get_extractor(tuple(rule_set_names))
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_extractor(rule_set_names: Tuple[str, ...]) -> Extractor:
+    return Extractor(
+        [rule for rule_set_name in rule_set_names for rule in RULE_SETS[rule_set_name]]
+    )
+
+
+def load_registry(config: Optional[str]) -> ExtractorRegistry:
+    """`config` is a JSON list of `{"stage": ..., "name": ..., "rules": [...]}`, `stage` and `name`
+    being glob patterns defaulting to `*`. It replaces the default registry."""
+    if not config:
+        return ExtractorRegistry(DEFAULT_REGISTRY)
+    registry = ExtractorRegistry([])
+    for entry in reversed(json.loads(config)):
+        registry.register(
+            entry['rules'], stage=entry.get('stage', '*'), name=entry.get('name', '*')
+        )
+    return registry
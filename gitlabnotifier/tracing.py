@@ -0,0 +1,328 @@
+"""Spans of the processing of an event, to tell why a particular event was slow.
+
+`Tracer.trace` records the spans of an event: the dispatch to its handler, the calls to GitLab, the
+downloads of job traces, the building of the message and the calls to Slack (see `span`). Spans are
+cheap to record: they are kept in memory until the end of the event, and then:
+- a sample of the events, and all the slow ones, are exported in the OTLP/JSON format, to a file (in
+  the format of the `otlpjsonfile` receiver of the OpenTelemetry collector) or to a collector
+- the events slower than `slow_threshold` are kept, with their spans and their redacted payload, in
+  a ring buffer read from the `/debug/slow-events` route
+
+The current span is a context variable, which `concurrency.py` propagates to its threads.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+import requests
+
+from gitlabnotifier.constants import (SLOW_EVENT_BUFFER_SIZE,
+                                      SLOW_EVENT_THRESHOLD,
+                                      TRACING_EXPORT_PATH, TRACING_OTLP_URL,
+                                      TRACING_SAMPLE_RATE)
+from gitlabnotifier.metrics import counter
+
+# values of the keys of a payload or of span attributes that aren't kept with a slow event nor
+# exported: personal data, secrets and free text (comments, descriptions, titles, commit messages)
+REDACTED_KEYS_REGEX = re.compile(
+    r"email|^name$|username|token|password|secret|private|^note$|description|^body$|title|message"
+)
+REDACTED = "[redacted]"
+
+SLOW_EVENTS = counter(
+    "gitlabnotifier_slow_events_total", "Events slower than `SLOW_EVENT_THRESHOLD`.",
+    ("object_kind",)
+)
+DROPPED_SPANS = counter(
+    "gitlabnotifier_spans_dropped_total", "Spans not exported because the export queue was full."
+)
+
+_current_span = contextvars.ContextVar('span', default=None)
+
+
+class _Trace:
+
+    def __init__(self, sampled: bool):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.sampled = sampled
+        self.spans: List[Span] = []
+        self.finished = False
+
+
+class Span:
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, trace: _Trace, name: str, parent_id: Optional[str], attributes: Dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error: Optional[str] = None
+        self.start = time.time_ns()
+        self.end = self.start
+
+    @property
+    def duration(self) -> float:
+        """In seconds."""
+        return (self.end - self.start) / 1e9
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+
+class _NoopSpan:
+    """Yielded by `span` when the event isn't traced."""
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+@contextmanager
+def _enter(new_span: Span) -> Iterator[Span]:
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        new_span.end = time.time_ns()
+        _current_span.reset(token)
+        # spans of late threads, e.g. of `map_with_deadline`, are ignored
+        if not new_span.trace.finished:
+            new_span.trace.spans.append(new_span)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Record a span, child of the current one, if the current event is traced."""
+    parent = _current_span.get()
+    if parent is None:
+        yield _NOOP_SPAN
+        return
+    with _enter(Span(parent.trace, name, parent.span_id, attributes)) as new_span:
+        yield new_span
+
+
+def redact(value: Any) -> Any:
+    """A copy of a payload or of span attributes without the values of `REDACTED_KEYS_REGEX`."""
+    if isinstance(value, dict):
+        redacted = {}
+        for key, item in value.items():
+            redacted[key] = REDACTED if item and REDACTED_KEYS_REGEX.search(key) else redact(item)
+        return redacted
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+def get_span_tree(spans: List[Span], root: Span) -> Dict:
+    """The spans nested in their parent, with their start relative to the root, in seconds."""
+    children: Dict[Optional[str], List[Span]] = {}
+    for child in spans:
+        children.setdefault(child.parent_id, []).append(child)
+
+    def node(current: Span) -> Dict:
+        current_children = sorted(children.get(current.span_id, []), key=lambda child: child.start)
+        return {
+            "name": current.name,
+            "start": (current.start - root.start) / 1e9,
+            "duration": current.duration,
+            "attributes": redact(current.attributes),
+            "error": current.error,
+            "children": [node(child) for child in current_children],
+        }
+
+    return node(root)
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict) -> List[Dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+def to_otlp(spans: List[Span]) -> Dict:
+    """https://opentelemetry.io/docs/specs/otlp/#json-protobuf-encoding"""
+    otlp_spans = []
+    for exported in spans:
+        otlp_span = {
+            "traceId": exported.trace.trace_id,
+            "spanId": exported.span_id,
+            "name": exported.name,
+            "kind": 1,  # internal
+            "startTimeUnixNano": str(exported.start),
+            "endTimeUnixNano": str(exported.end),
+            "attributes": _otlp_attributes(redact(exported.attributes)),
+        }
+        if exported.parent_id is not None:
+            otlp_span["parentSpanId"] = exported.parent_id
+        if exported.error is not None:
+            otlp_span["status"] = {"code": 2, "message": exported.error}
+        otlp_spans.append(otlp_span)
+    resource = {"attributes": _otlp_attributes({"service.name": "gitlabnotifier"})}
+    scope_spans = {"scope": {"name": "gitlabnotifier"}, "spans": otlp_spans}
+    return {"resourceSpans": [{"resource": resource, "scopeSpans": [scope_spans]}]}
+
+
+class SpanExporter:
+    """Export the spans of the traces in a background thread, by batches. Traces are dropped if more
+    than `queue_size` wait to be exported."""
+
+    def __init__(self, queue_size: int = 1000, batch_size: int = 100):
+        self.batch_size = batch_size
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Span]):
+        self._start()
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            DROPPED_SPANS.inc(len(spans))
+
+    def _start(self):
+        """Threads don't survive a fork, so the thread is started again in a forked process."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="gitlabnotifier-tracing", daemon=True).start()
+
+    def _run(self):
+        while True:
+            spans = list(self._queue.get())
+            while len(spans) < self.batch_size:
+                try:
+                    spans.extend(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write(to_otlp(spans))
+            except Exception:  # pylint: disable=broad-except
+                logging.exception(f"Failed to export {len(spans)} spans.")
+
+    def write(self, otlp: Dict):
+        raise NotImplementedError
+
+
+class FileSpanExporter(SpanExporter):
+    """Append a line of OTLP/JSON per batch to a file."""
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+
+    def write(self, otlp: Dict):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(otlp, separators=(',', ':')) + "\n")
+
+
+class OtlpSpanExporter(SpanExporter):
+    """Send the spans to an OTLP/HTTP collector, e.g. http://localhost:4318/v1/traces"""
+
+    def __init__(self, url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self._session = requests.Session()
+
+    def write(self, otlp: Dict):
+        self._session.post(self.url, json=otlp, timeout=10).raise_for_status()
+
+
+class Tracer:
+
+    def __init__(
+        self,
+        slow_threshold: float,
+        sample_rate: float,
+        exporter: Optional[SpanExporter] = None,
+        slow_event_count: int = 100,
+    ):
+        """Events slower than `slow_threshold` seconds are kept, 0 to keep none, and a
+        `sample_rate` ratio of the events are exported to `exporter`."""
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self._slow_events = deque(maxlen=slow_event_count)
+        self._lock = threading.Lock()
+
+    def get_slow_events(self) -> List[Dict]:
+        """Latest first."""
+        with self._lock:
+            return list(reversed(self._slow_events))
+
+    @property
+    def enabled(self) -> bool:
+        return self.slow_threshold > 0 or (self.exporter is not None and self.sample_rate > 0)
+
+    @contextmanager
+    def trace(self, name: str, payload: Optional[Dict] = None, **attributes):
+        """Record the spans of an event, `payload` being kept if the event is slow."""
+        if not self.enabled:
+            yield _NOOP_SPAN
+            return
+        current_trace = _Trace(sampled=random.random() < self.sample_rate)
+        root = Span(current_trace, name, None, attributes)
+        try:
+            with _enter(root):
+                yield root
+        finally:
+            current_trace.finished = True
+            self._finish(current_trace, root, payload)
+
+    def _finish(self, current_trace: _Trace, root: Span, payload: Optional[Dict]):
+        slow = 0 < self.slow_threshold <= root.duration
+        if slow:
+            SLOW_EVENTS.labels(str(root.attributes.get("object_kind", root.name))).inc()
+            slow_event = {
+                "trace_id": current_trace.trace_id,
+                "started_at": datetime.fromtimestamp(root.start / 1e9, timezone.utc).isoformat(),
+                "duration": root.duration,
+                "spans": get_span_tree(current_trace.spans, root),
+                "payload": redact(payload),
+            }
+            with self._lock:
+                self._slow_events.append(slow_event)
+        if self.exporter is not None and (current_trace.sampled or slow):
+            self.exporter.export(current_trace.spans)
+
+
+def _create_exporter() -> Optional[SpanExporter]:
+    if TRACING_OTLP_URL:
+        return OtlpSpanExporter(TRACING_OTLP_URL)
+    if TRACING_EXPORT_PATH:
+        return FileSpanExporter(TRACING_EXPORT_PATH)
+    return None
+
+
+tracer = Tracer(
+    SLOW_EVENT_THRESHOLD,
+    TRACING_SAMPLE_RATE,
+    exporter=_create_exporter(),
+    slow_event_count=SLOW_EVENT_BUFFER_SIZE
+)
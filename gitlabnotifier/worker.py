@@ -0,0 +1,181 @@
+"""Background processing of GitLab events.
+
+The webhook route only validates and enqueues the event, a pool of worker threads then builds the
+messages and sends them to Slack. This way, GitLab gets its response before its webhook timeout.
+
+Events are partitioned, e.g. by MR: the events of a partition are processed one at a time, in the
+order they were received, so that a "merged" message isn't sent before the comments preceding the
+merge. Partitions are processed in parallel, and take turns: a worker processes one event of a
+partition, then moves to the next partition, so that a busy MR doesn't delay the others.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Set
+
+
+class WorkerPool:
+
+    def __init__(
+        self,
+        handler: Callable[[Any], None],
+        worker_count: int,
+        queue_size: int,
+        partition_key: Callable[[Any], Optional[Hashable]] = None,
+        partition_size: Optional[int] = None,
+    ):
+        """`partition_key(event)` is the partition of an event, None for events which don't need to
+        be ordered. At most `queue_size` events wait to be processed, and `partition_size` per
+        partition."""
+        self.handler = handler
+        self.worker_count = worker_count
+        self.queue_size = queue_size
+        self.partition_key = partition_key
+        self.partition_size = partition_size or queue_size
+        # events waiting by partition, a partition is removed once all its events are processed
+        self._partitions: Dict[Hashable, Deque[Any]] = {}
+        # partitions with waiting events, which aren't being processed by a worker
+        self._ready: Deque[Hashable] = deque()
+        # partitions being processed by a worker
+        self._processing: Set[Hashable] = set()
+        # partitions whose first event is a retry waiting for its delay, see `retry`
+        self._delayed: Set[Hashable] = set()
+        self._waiting_count = 0
+        self._condition = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._pid: Optional[int] = None
+        self._accepting = True
+        self._stopping = False
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting_count
+
+    @property
+    def partition_count(self) -> int:
+        """Number of partitions with events waiting or being processed."""
+        return len(self._partitions)
+
+    def start(self):
+        """Start the worker threads. Threads don't survive a fork, so they are started again in a
+        forked process."""
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = [
+                threading.Thread(target=self._run, name=f"gitlabnotifier-worker-{i}", daemon=True)
+                for i in range(self.worker_count)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def submit(self, event: Any, block: bool = False) -> bool:
+        """Enqueue an event, returns False if the queue or the partition of the event is full, or if
+        the pool is shutting down. If `block` is True, wait for a free slot instead."""
+        if not self._accepting:
+            return False
+        self.start()
+        key = self.partition_key(event) if self.partition_key is not None else None
+        if key is None:
+            key = object()  # a partition of its own
+        with self._condition:
+            while self._is_full(key):
+                if not block:
+                    return False
+                self._condition.wait()
+            partition = self._partitions.get(key)
+            if partition is None:
+                partition = self._partitions[key] = deque()
+                self._ready.append(key)
+            partition.append(event)
+            self._waiting_count += 1
+            self._condition.notify_all()
+        return True
+
+    def retry(self, event: Any, delay: float = 0.):
+        """Enqueue again an event that failed, from the handler: it goes back at the head of its
+        partition, so that it is still processed before the events received after it, in `delay`
+        seconds. The event was already counted in the queue, so it is never rejected. The delay is
+        skipped once the pool is shutting down."""
+        key = self.partition_key(event) if self.partition_key is not None else None
+        if key is None:
+            key = object()
+        with self._condition:
+            delayed = delay > 0 and not self._stopping
+            partition = self._partitions.get(key)
+            if partition is None:
+                partition = self._partitions[key] = deque()
+                if not delayed:
+                    self._ready.append(key)
+            # otherwise the partition is being processed by the current worker, which makes it ready
+            # again once the handler returns
+            partition.appendleft(event)
+            self._waiting_count += 1
+            if delayed:
+                self._delayed.add(key)
+                timer = threading.Timer(delay, self._resume, (key,))
+                timer.daemon = True
+                timer.start()
+            self._condition.notify_all()
+
+    def _resume(self, key: Hashable):
+        """End of the delay of a retry."""
+        with self._condition:
+            if key not in self._delayed:
+                return
+            self._delayed.remove(key)
+            if key not in self._processing:
+                self._ready.append(key)
+            self._condition.notify_all()
+
+    def _is_full(self, key: Hashable) -> bool:
+        partition_length = len(self._partitions.get(key, ()))
+        return self._waiting_count >= self.queue_size or partition_length >= self.partition_size
+
+    def shutdown(self, timeout: Optional[float] = None):
+        """Stop accepting events, wait for the queued ones to be processed and stop the workers."""
+        self._accepting = False
+        if self._pid != os.getpid():
+            return
+        with self._condition:
+            self._stopping = True
+            # the retries waiting for their delay are processed right away
+            for key in self._delayed:
+                if key not in self._processing:
+                    self._ready.append(key)
+            self._delayed.clear()
+            self._condition.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0., deadline - time.monotonic()))
+            if thread.is_alive():
+                logging.warning(f"Worker {thread.name} did not finish within {timeout}s.")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._ready:
+                    if self._stopping and self._waiting_count == 0:
+                        return
+                    self._condition.wait()
+                key = self._ready.popleft()
+                event = self._partitions[key].popleft()
+                self._waiting_count -= 1
+                self._processing.add(key)
+            try:
+                self.handler(event)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Failed to process an event.")
+            finally:
+                with self._condition:
+                    self._processing.remove(key)
+                    if not self._partitions[key]:
+                        del self._partitions[key]
+                    elif key not in self._delayed:
+                        # the partition goes back at the end of the line
+                        self._ready.append(key)
+                    self._condition.notify_all()
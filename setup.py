@@ -12,4 +12,5 @@ setup(
     description='Notify users on Slack when a change in GitLab concern them.',
     packages=["gitlabnotifier"],
     install_requires=required,
+    entry_points={"console_scripts": ["gitlabnotifier=gitlabnotifier.cli:main"]},
 )
@@ -0,0 +1,98 @@
+from unittest import mock
+
+from gitlabnotifier import gitlab_api
+from gitlabnotifier.cache import TTLCache
+
+
+def test_ttl_cache_lru_eviction():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "a" is now the most recently used
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_expiration():
+    cache = TTLCache(maxsize=10, ttl=60)
+    with mock.patch("gitlabnotifier.cache.time.monotonic", return_value=1000.):
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=10)
+    with mock.patch("gitlabnotifier.cache.time.monotonic", return_value=1030.):
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+    with mock.patch("gitlabnotifier.cache.time.monotonic", return_value=1070.):
+        assert cache.get("a") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def _mock_call_api(suffix):
+    response = mock.Mock()
+    if suffix == "users?username=unknown":
+        response.json.return_value = []
+    elif suffix.startswith("users?username="):
+        username = suffix.split("=")[1]
+        response.json.return_value = [{"id": 1, "username": username, "email": "a@b.c"}]
+    else:
+        response.json.return_value = {"id": 1, "username": "alice", "email": "a@b.c"}
+    return response
+
+
+@mock.patch("gitlabnotifier.gitlab_api._call_api", side_effect=_mock_call_api)
+def test_user_lookups_are_cached(mock_call_api):
+    gitlab_api.invalidate_user_cache()
+    for _ in range(3):
+        assert gitlab_api.get_user(1)["email"] == "a@b.c"
+        assert gitlab_api.get_user_by_username("alice")[0]["email"] == "a@b.c"
+        assert gitlab_api.get_user_by_username("unknown") == []
+    assert mock_call_api.call_count == 3
+
+    gitlab_api.invalidate_user_cache(user_id=1)
+    gitlab_api.get_user(1)
+    gitlab_api.get_user_by_username("alice")
+    assert mock_call_api.call_count == 5
+
+    gitlab_api.invalidate_user_cache(username="unknown")
+    gitlab_api.get_user_by_username("unknown")
+    assert mock_call_api.call_count == 6
+
+
+@mock.patch("gitlabnotifier.gitlab_api._call_api", side_effect=_mock_call_api)
+def test_user_system_hooks_invalidate_the_cache(mock_call_api):
+    from gitlabnotifier.app import \
+        app  # pylint: disable=import-outside-toplevel
+    gitlab_api.invalidate_user_cache()
+    assert gitlab_api.get_user_by_username("unknown") == []
+    gitlab_api.get_user(1)
+    client = app.test_client()
+    res = client.post(
+        "/",
+        json={
+            "event_name": "user_create",
+            "user_id": 2,
+            "username": "unknown"
+        },
+        headers={"X-Gitlab-Event": "System Hook"}
+    )
+    assert res.status_code == 200
+    gitlab_api.get_user_by_username("unknown")
+    assert mock_call_api.call_count == 3
+
+    client.post(
+        "/",
+        json={
+            "event_name": "user_rename",
+            "user_id": 1,
+            "username": "bob",
+            "old_username": "alice"
+        },
+        headers={"X-Gitlab-Event": "System Hook"}
+    )
+    gitlab_api.get_user(1)
+    assert mock_call_api.call_count == 4
+
+    assert client.post("/admin/user-cache/invalidate", json={"user_id": 1}).status_code == 200
+    gitlab_api.get_user(1)
+    assert mock_call_api.call_count == 5
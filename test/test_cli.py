@@ -0,0 +1,46 @@
+import json
+import socket
+import subprocess
+import sys
+
+import requests
+from api import wait_for_port
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def test_serve():
+    port = _free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "gitlabnotifier", "serve", "--host", "localhost", "--port",
+            str(port), "--workers", "2", "--threads", "2"
+        ]
+    )
+    try:
+        wait_for_port(port, timeout=30)
+        for _ in range(4):
+            requests.get(f"http://localhost:{port}/").raise_for_status()
+        assert "gitlabnotifier_queue_depth" in requests.get(f"http://localhost:{port}/metrics").text
+    finally:
+        server.terminate()
+    assert server.wait(timeout=30) == 0
+
+
+def test_replay_dry_run(tmp_path):
+    path = tmp_path / "events.ndjson"
+    path.write_text('{"object_kind": "push"}\nnot json\n')
+    result = subprocess.run(
+        [sys.executable, "-m", "gitlabnotifier", "replay",
+         str(path), "--dry-run"],
+        capture_output=True,
+        timeout=60,
+        check=True,
+    )
+    stats = json.loads(result.stderr.decode().strip().splitlines()[-1])
+    assert stats["read"] == 2 and stats["dropped"] == 1 and stats["invalid"] == 1
+    assert result.stdout == b""
@@ -0,0 +1,39 @@
+import threading
+import time
+
+import pytest
+
+from gitlabnotifier.concurrency import run_concurrently
+
+
+def test_run_concurrently_returns_results_in_order():
+    start = time.monotonic()
+    results = run_concurrently(
+        lambda: time.sleep(0.05) or 1,
+        lambda: time.sleep(0.05) or 2,
+        lambda: time.sleep(0.05) or 3,
+    )
+    assert results == [1, 2, 3]
+    assert time.monotonic() - start < 0.14
+
+
+def test_run_concurrently_reuses_its_threads():
+    names = set()
+    for _ in range(10):
+        names.update(run_concurrently(*[lambda: threading.current_thread().name] * 2))
+    assert len(names) <= 4
+
+
+def test_run_concurrently_nested_calls_run_in_the_calling_thread():
+
+    def nested():
+        current_thread = threading.current_thread()
+        inner_threads = run_concurrently(threading.current_thread, threading.current_thread)
+        return inner_threads == [current_thread, current_thread]
+
+    assert run_concurrently(nested, nested) == [True, True]
+
+
+def test_run_concurrently_reraises():
+    with pytest.raises(ValueError):
+        run_concurrently(lambda: 1, lambda: int("x"))
@@ -0,0 +1,99 @@
+import threading
+import time
+
+from gitlabnotifier.digest import DigestBuffer, get_digest_key
+
+
+def _note_event(iid):
+    return {'object_kind': 'note', 'project_id': 1, 'merge_request': {'iid': iid}}
+
+
+class _Slack:
+
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send(self, message, channel):
+        with self.lock:
+            self.sent.append((channel, message))
+        return {'ok': True}
+
+
+def test_digest_coalesces_burst():
+    slack = _Slack()
+    digests = DigestBuffer(slack.send, window=0.2, max_delay=10)
+    for i in range(20):
+        for channel in ['@alice', '@bob']:
+            digests.add(
+                channel, get_digest_key(_note_event(1), ['pipeline']), {"text": f"comment {i}"}
+            )
+    digests.add('@alice', get_digest_key(_note_event(2), ['pipeline']), {"text": "other MR"})
+    assert slack.sent == []
+    time.sleep(0.5)
+    assert sorted(channel for channel, _ in slack.sent) == ['@alice', '@alice', '@bob']
+    texts = [message['text'] for channel, message in slack.sent if channel == '@bob']
+    assert texts == ["\n".join(f"comment {i}" for i in range(20))]
+    assert digests.buffered_count == 41 and digests.sent_count == 3
+
+
+def test_digest_max_delay():
+    slack = _Slack()
+    digests = DigestBuffer(slack.send, window=0.2, max_delay=0.5)
+    start = time.monotonic()
+    # a message every 0.1s never leaves a quiet window
+    while not slack.sent and time.monotonic() - start < 2:
+        digests.add('@alice', (1, 1), {"text": "comment"})
+        time.sleep(0.1)
+    assert len(slack.sent) == 1
+    assert 0.5 <= time.monotonic() - start < 1
+
+
+def test_digest_force_flush():
+    slack = _Slack()
+    digests = DigestBuffer(slack.send, window=10, max_delay=10)
+    digests.add('@alice', (1, 1), {"text": "a", "attachments": [{"text": "1"}]})
+    digests.add('@alice', (1, 1), {"text": "b", "attachments": [{"text": "2"}]})
+    digests.flush(force=True)
+    assert slack.sent == [
+        ('@alice', {
+            "text": "a\nb",
+            "attachments": [{
+                "text": "1"
+            }, {
+                "text": "2"
+            }]
+        })
+    ]
+
+
+def test_digest_key():
+    assert get_digest_key(_note_event(3), ['pipeline']) == (1, 3)
+    assert get_digest_key({'object_kind': 'pipeline'}, ['pipeline']) is None
+    mr_event = {
+        'object_kind': 'merge_request',
+        'project': {
+            'id': 1
+        },
+        'object_attributes': {
+            'iid': 3
+        }
+    }
+    assert get_digest_key(mr_event, ['pipeline']) == (1, 3)
+    assert get_digest_key(mr_event, ['merge_request', 'pipeline']) is None
+
+
+def test_digest_acks_events_once_sent():
+    slack = _Slack()
+    digests = DigestBuffer(slack.send, window=10, max_delay=10)
+    acked = []
+    digests.add('@alice', (1, 1), {"text": "a"}, event_id=1)
+    digests.add('@bob', (1, 1), {"text": "a"}, event_id=1)
+    digests.add('@alice', (1, 1), {"text": "b"}, event_id=2)
+    digests.ack(1, lambda: acked.append(1))
+    digests.ack(2, lambda: acked.append(2))
+    digests.ack(3, lambda: acked.append(3))
+    # events without digests are acknowledged right away
+    assert acked == [3]
+    digests.flush(force=True)
+    assert sorted(acked) == [1, 2, 3]
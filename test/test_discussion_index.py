@@ -0,0 +1,64 @@
+import time
+from unittest import mock
+
+from gitlabnotifier.discussion_index import DiscussionIndex
+from gitlabnotifier.process_gitlab_notif import get_discussion_participant_ids
+
+
+def _note_event(discussion_id, author_id):
+    return {
+        "object_kind": "note",
+        "project_id": 1,
+        "user": {"id": author_id, "email": f"user{author_id}@example.com"},
+        "merge_request": {"iid": 2},
+        "object_attributes": {"discussion_id": discussion_id, "author_id": author_id},
+    }  # yapf: disable
+
+
+def test_discussion_index_updates_from_notes():
+    index = DiscussionIndex(maxsize=10)
+    fetch = mock.Mock(return_value=[11, 12])
+    assert index.get_participants("d1", 12, fetch) == {11, 12}
+    # replies only add their author
+    assert index.get_participants("d1", 13, fetch) == {11, 12, 13}
+    assert index.get_participants("d1", 11, fetch) == {11, 12, 13}
+    assert fetch.call_count == 1
+    assert (index.hits, index.misses) == (2, 1)
+    # without the author of the note, the discussion is fetched again
+    assert index.get_participants("d1", None, fetch) == {11, 12, 13}
+    assert fetch.call_count == 2
+
+
+def test_discussion_index_evicts_least_recently_active():
+    index = DiscussionIndex(maxsize=2)
+    fetch = mock.Mock(return_value=[])
+    index.get_participants("d1", 11, fetch)
+    index.get_participants("d2", 12, fetch)
+    index.get_participants("d1", 13, fetch)
+    index.get_participants("d3", 14, fetch)
+    assert len(index) == 2
+    assert fetch.call_count == 3
+    assert index.get_participants("d2", 15, fetch) == {15}
+    assert fetch.call_count == 4
+
+
+@mock.patch('gitlabnotifier.process_gitlab_notif.discussion_index', DiscussionIndex(maxsize=10))
+@mock.patch('gitlabnotifier.process_gitlab_notif.get_mr_discussion')
+def test_get_discussion_participant_ids(get_mr_discussion):
+    get_mr_discussion.return_value = {"notes": [{"author": {"id": 11}}, {"author": {"id": 12}}]}
+    assert get_discussion_participant_ids(_note_event("d1", 12)) == {11, 12}
+    assert get_discussion_participant_ids(_note_event("d1", 13)) == {11, 12, 13}
+    get_mr_discussion.assert_called_once_with(1, 2, "d1")
+
+
+def test_discussion_index_fetches_again_after_ttl():
+    index = DiscussionIndex(maxsize=10, ttl=0.2)
+    fetch = mock.Mock(return_value=[11])
+    index.get_participants("d1", 12, fetch)
+    time.sleep(0.1)
+    # adding a note doesn't delay the next fetch
+    assert index.get_participants("d1", 13, fetch) == {11, 12, 13}
+    time.sleep(0.15)
+    fetch.return_value = [11, 12, 13, 14]  # 14 commented through another process
+    assert index.get_participants("d1", 15, fetch) == {11, 12, 13, 14, 15}
+    assert fetch.call_count == 2
@@ -0,0 +1,93 @@
+import json
+from unittest import mock
+
+import pytest
+
+from gitlabnotifier.event_filter import (get_drop_reason,
+                                         get_object_attributes,
+                                         get_object_kind, should_drop)
+from gitlabnotifier.mr_store import mr_store
+
+
+def _pipeline(status):
+    return {
+        "object_kind": "pipeline",
+        "object_attributes": {"id": 1, "status": status, "detailed_status": "x"},
+        "builds": [{"id": i, "status": "failed", "name": '"status": "failed"'} for i in range(3)],
+    }  # yapf: disable
+
+
+def _merge_request(action, assignee_id=None):
+    return {
+        "object_kind": "merge_request",
+        "object_attributes": {
+            "action": action, "assignee_id": assignee_id, "description": 'say "action": "merge"'
+        },
+    }  # yapf: disable
+
+
+@pytest.mark.parametrize(
+    "header,event,expected", [
+        ("Job Hook", {"object_kind": "build", "build_status": "failed"}, ("build", "object_kind")),
+        (None, {"object_kind": "build"}, ("build", "object_kind")),
+        ("Pipeline Hook", _pipeline("success"), ("pipeline", "attributes")),
+        ("Pipeline Hook", _pipeline("running"), ("pipeline", "attributes")),
+        ("Pipeline Hook", _pipeline("failed"), ("pipeline", None)),
+        ("Merge Request Hook", _merge_request("update"), ("merge_request", "attributes")),
+        ("Merge Request Hook", _merge_request("update", assignee_id=2), ("merge_request", None)),
+        ("Merge Request Hook", _merge_request("approved"), ("merge_request", None)),
+        ("Merge Request Hook", _merge_request("merge"), ("merge_request", None)),
+        ("Note Hook", {"object_kind": "note", "object_attributes": {"noteable_type": "Issue"}},
+         ("note", "attributes")),
+        ("Note Hook", {"object_kind": "note", "object_attributes": {"noteable_type": "MergeRequest"}},
+         ("note", None)),
+        # when in doubt, events are kept
+        (None, {"kind": "note"}, (None, None)),
+        ("Pipeline Hook", {"object_kind": "pipeline", "object_attributes": {}}, ("pipeline", None)),
+        ("Pipeline Hook", {"object_kind": "pipeline"}, ("pipeline", None)),
+    ]
+)  # yapf: disable
+def test_get_drop_reason(header, event, expected):
+    assert _get_drop_reason(header, json.dumps(event).encode()) == expected
+
+
+def _get_drop_reason(header, body):
+    object_kind = get_object_kind(header, body)
+    return object_kind, get_drop_reason(object_kind, get_object_attributes(body))
+
+
+def test_get_drop_reason_malformed_payload():
+    assert _get_drop_reason(None, b'{"object_kind": "pipeline", "object_attributes": {"st') == \
+        ("pipeline", None)
+
+
+def test_dropped_merge_request_updates_feed_mr_store():
+    event = _merge_request("update")
+    event["object_attributes"].update(target_project_id=7, iid=3, author_id=12, title="Feature")
+    assert should_drop("Merge Request Hook", json.dumps(event).encode())
+    assert mr_store.get(7, 3, 'author_id') == 12
+
+
+@mock.patch("gitlabnotifier.app.worker_pool")
+@mock.patch("gitlabnotifier.app.event_store")
+@mock.patch("gitlabnotifier.app.handle_event")
+def test_dropped_events_reach_neither_the_store_nor_the_handler(
+    mock_handle_event, mock_event_store, mock_worker_pool
+):
+    from gitlabnotifier.app import \
+        app  # pylint: disable=import-outside-toplevel
+    event = _pipeline("success")
+    event["builds"] = [dict(build, id=i) for i in range(300) for build in event["builds"][:1]]
+    body = json.dumps(event).encode()
+    client = app.test_client()
+    for _ in range(100):
+        res = client.post(
+            "/",
+            data=body,
+            content_type="application/json",
+            headers={"X-Gitlab-Event": "Pipeline Hook"}
+        )
+        assert res.get_data(as_text=True) == "Event ignored."
+    mock_event_store.add.assert_not_called()
+    mock_worker_pool.submit.assert_not_called()
+    mock_handle_event.assert_not_called()
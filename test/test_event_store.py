@@ -0,0 +1,133 @@
+import sqlite3
+import threading
+import time
+
+from gitlabnotifier.event_store import EventStore
+
+
+def _statuses(path):
+    with sqlite3.connect(path) as connection:
+        return dict(connection.execute("SELECT uuid, status FROM events").fetchall())
+
+
+def test_event_store_ignores_redeliveries(tmp_path):
+    store = EventStore(str(tmp_path / "events.db"))
+    event_id = store.add("uuid-1", b'{"object_kind": "note"}')
+    assert event_id is not None
+    assert store.add("uuid-1", b'{"object_kind": "note"}') is None
+    assert store.add("uuid-2", b'{"object_kind": "note"}') not in (None, event_id)
+    store.close()
+
+
+def test_event_store_statuses(tmp_path):
+    path = str(tmp_path / "events.db")
+    store = EventStore(path)
+    store.done(store.add("uuid-1", b'{}'))
+    store.failed(store.add("uuid-2", b'{}'))
+    store.discard(store.add("uuid-3", b'{}'))
+    store.add("uuid-4", b'{}')
+    store.close()
+    assert _statuses(path) == {"uuid-1": "done", "uuid-2": "failed", "uuid-4": "processing"}
+    # a discarded event can be received again
+    store = EventStore(path)
+    assert store.add("uuid-3", b'{}') is not None
+    store.close()
+
+
+def test_event_store_recovers_lost_events(tmp_path):
+    path = str(tmp_path / "events.db")
+    store = EventStore(path)
+    lost_event_id = store.add("uuid-1", b'{"object_kind": "note"}')
+    store.done(store.add("uuid-2", b'{}'))
+    store.close()
+
+    recovered = []
+    store = EventStore(
+        path, lease=0, retention=0, on_recovered=lambda *args: recovered.append(args)
+    )
+    store.start()
+    store.close()
+    _wait_for(lambda: recovered)
+    assert recovered == [(lost_event_id, b'{"object_kind": "note"}')]
+    # the processed event was deleted after the retention
+    assert _statuses(path) == {"uuid-1": "processing"}
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_event_store_renews_the_leases_of_its_events(tmp_path):
+    recovered = []
+    store = EventStore(
+        str(tmp_path / "events.db"),
+        lease=0.3,
+        maintenance_interval=0.05,
+        on_recovered=lambda *args: recovered.append(args)
+    )
+    event_id = store.add("uuid-1", b'{}')
+    time.sleep(1)
+    assert recovered == []
+    store.done(event_id)
+    store.close()
+
+
+def test_event_store_recovery_does_not_block_writes(tmp_path):
+    path = str(tmp_path / "events.db")
+    store = EventStore(path)
+    store.add("uuid-1", b'{}')
+    store.close()
+
+    unblock = threading.Event()
+    store = EventStore(
+        path, lease=0, maintenance_interval=0.05, on_recovered=lambda *args: unblock.wait(5)
+    )
+    start = time.monotonic()
+    assert store.add("uuid-2", b'{}') is not None
+    assert time.monotonic() - start < 1
+    unblock.set()
+    store.close()
+
+
+def test_event_store_concurrent_writes(tmp_path):
+    store = EventStore(str(tmp_path / "events.db"))
+    event_ids = []
+
+    def receive(thread_index):
+        for i in range(100):
+            event_id = store.add(f"uuid-{i}", b'{"object_kind": "note"}')
+            if event_id is not None:
+                event_ids.append(event_id)
+                store.done(event_id)
+
+    threads = [threading.Thread(target=receive, args=(i,)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    store.close()
+    # each event was received by all the threads, but only stored once
+    assert len(event_ids) == len(set(event_ids)) == 100
+
+
+def test_invalid_events_are_not_stored(tmp_path, monkeypatch):
+    from gitlabnotifier import \
+        app as app_module  # pylint: disable=import-outside-toplevel
+    path = str(tmp_path / "events.db")
+    store = EventStore(path)
+    monkeypatch.setattr(app_module, "event_store", store)
+    client = app_module.app.test_client()
+    res = client.post(
+        "/",
+        data=b'{"object_kind": ',
+        content_type="application/json",
+        headers={"X-Gitlab-Event": "Note Hook"}
+    )
+    assert res.status_code == 400
+    # an invalid event stored before this check is marked as failed instead of being recovered
+    app_module.recover_event(store.add("uuid-1", b'{"object_kind": '), b'{"object_kind": ')
+    store.close()
+    assert _statuses(path) == {"uuid-1": "failed"}
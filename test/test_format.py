@@ -1,4 +1,8 @@
-from gitlabnotifier.format import format_slack_link, format_slack_text
+from unittest import mock
+
+from gitlabnotifier.format import (format_author_name, format_slack_link,
+                                   format_slack_text)
+from gitlabnotifier.slack_api import SlackDirectory
 
 
 def test_format_slack_link():
@@ -14,3 +18,13 @@ def test_format_slack_text():
     expected_text = "&amp; test &lt; &lt;yes|no&amp;&gt; &gt;&amp; &amp;amtest"
     formatted_text = format_slack_text(text)
     assert formatted_text == expected_text
+
+
+@mock.patch(
+    "gitlabnotifier.format.EMAIL_TO_SLACK_ID", SlackDirectory({"alice@mycompany.com": "UALICE"})
+)
+def test_format_author_name():
+    event = {'user': {'name': 'Alice <A>', 'email': 'alice@mycompany.com'}}
+    assert format_author_name(event) == "<@UALICE> (Alice &lt;A&gt;)"
+    event = {'user': {'name': 'Bob', 'email': 'bob@mycompany.com'}}
+    assert format_author_name(event) == "Bob"
@@ -0,0 +1,235 @@
+import json
+import time
+from unittest import mock
+
+import pytest
+import requests
+import stub
+
+from gitlabnotifier import gitlab_api
+from gitlabnotifier.resilience import (LOW, AdaptiveLimiter, CircuitBreaker,
+                                       CircuitOpenError, OverloadedError,
+                                       RateLimitGate, priority)
+
+
+def test_call_api_retries_on_server_errors():
+    calls = []
+
+    def handler(method, path, body):
+        calls.append(path)
+        if len(calls) == 1:
+            return 429, {'Retry-After': '0'}, {"message": "Too many requests"}
+        if len(calls) == 2:
+            return 502, {}, {"message": "Bad gateway"}
+        return 200, {}, {"id": 12}
+
+    with stub.serve(handler) as url, mock.patch("gitlabnotifier.gitlab_api.GITLAB_BASE_URL", url):
+        assert gitlab_api.get_mr(1, 12) == {"id": 12}
+    assert calls == ["/api/v4/projects/1/merge_requests/12/"] * 3
+
+
+def test_call_api_does_not_retry_client_errors():
+    calls = []
+
+    def handler(method, path, body):
+        calls.append(path)
+        return 404, {}, {"message": "Not found"}
+
+    with stub.serve(handler) as url, mock.patch("gitlabnotifier.gitlab_api.GITLAB_BASE_URL", url):
+        with pytest.raises(requests.HTTPError):
+            gitlab_api.get_mr(1, 12)
+    assert len(calls) == 1
+
+
+def test_call_api_opens_the_circuit_on_server_errors():
+    calls = []
+
+    def handler(method, path, body):
+        calls.append(path)
+        return 503, {}, {"message": "Unavailable"}
+
+    breaker = CircuitBreaker("gitlab", failure_threshold=2, reset_timeout=60)
+    with stub.serve(handler) as url, mock.patch("gitlabnotifier.gitlab_api.GITLAB_BASE_URL", url), \
+            mock.patch("gitlabnotifier.gitlab_api._session", requests.Session()), \
+            mock.patch("gitlabnotifier.gitlab_api.gitlab_breaker", breaker):
+        for _ in range(2):
+            with pytest.raises(requests.HTTPError):
+                gitlab_api.get_mr(1, 12)
+        with pytest.raises(CircuitOpenError):
+            gitlab_api.get_mr(1, 12)
+        # traces have their own circuit
+        with pytest.raises(requests.HTTPError):
+            list(gitlab_api.iter_job_trace_lines(1, 2))
+    assert len(calls) == 3
+
+
+def test_call_api_honours_the_rate_limit_headers():
+    calls = []
+
+    def handler(method, path, body):
+        calls.append(path)
+        return 200, {'RateLimit-Remaining': '0', 'RateLimit-Reset': '9999999999'}, {"id": 12}
+
+    gate = RateLimitGate("gitlab", reserve=0, max_delay=0.1, low_priority_max_wait=0.05)
+    with stub.serve(handler) as url, mock.patch("gitlabnotifier.gitlab_api.GITLAB_BASE_URL", url), \
+            mock.patch("gitlabnotifier.gitlab_api.gitlab_rate_limit", gate):
+        assert gitlab_api.get_mr(1, 12) == {"id": 12}
+        with priority(LOW), pytest.raises(OverloadedError):
+            gitlab_api.get_mr(1, 12)
+        start = time.monotonic()
+        assert gitlab_api.get_mr(1, 12) == {"id": 12}
+        assert time.monotonic() - start >= 0.1
+    assert len(calls) == 2
+
+
+def test_iter_job_trace_lines_streams_lines():
+    trace = b"first line\nsecond line\r\n" + b"x" * 100 + b"\nlast line"
+
+    def handler(method, path, body):
+        assert path == "/api/v4/projects/1/jobs/2/trace"
+        return 200, {}, trace
+
+    with stub.serve(handler) as url, mock.patch("gitlabnotifier.gitlab_api.GITLAB_BASE_URL", url), \
+            mock.patch("gitlabnotifier.gitlab_api.TRACE_CHUNK_SIZE", 7), \
+            mock.patch("gitlabnotifier.gitlab_api.TRACE_MAX_LINE_BYTES", 20):
+        lines = list(gitlab_api.iter_job_trace_lines(1, 2))
+    assert lines == ["first line", "second line\r", "x" * 20, "last line"]
+
+
+def test_iter_job_trace_lines_holds_the_circuit_during_the_download():
+    response = mock.Mock(status_code=200, headers={})
+    response.iter_content.side_effect = requests.exceptions.ChunkedEncodingError("truncated")
+    session = mock.Mock()
+    session.request.return_value = response
+    breaker = CircuitBreaker("gitlab_traces", failure_threshold=1, reset_timeout=60)
+    limiter = AdaptiveLimiter("gitlab_traces", min_limit=1, max_limit=4, latency_target=60)
+    with mock.patch("gitlabnotifier.gitlab_api.GITLAB_BASE_URL", "http://gitlab"), \
+            mock.patch("gitlabnotifier.gitlab_api._session", session), \
+            mock.patch("gitlabnotifier.gitlab_api.gitlab_traces_breaker", breaker), \
+            mock.patch("gitlabnotifier.gitlab_api.gitlab_traces_limiter", limiter):
+        lines = gitlab_api.iter_job_trace_lines(1, 2)
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            list(lines)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert limiter.limit < 4
+    assert limiter.in_flight == 0
+    response.close.assert_called_once()
+
+
+def test_iter_job_trace_lines_latency_is_the_time_to_the_first_byte():
+
+    def slow_download(chunk_size):
+        for _ in range(3):
+            time.sleep(0.02)
+            yield b"line\n"
+
+    response = mock.Mock(status_code=200, headers={})
+    response.iter_content.side_effect = slow_download
+    session = mock.Mock()
+    session.request.return_value = response
+    limiter = AdaptiveLimiter("gitlab_traces", min_limit=1, max_limit=4, latency_target=0.01)
+    with mock.patch("gitlabnotifier.gitlab_api.GITLAB_BASE_URL", "http://gitlab"), \
+            mock.patch("gitlabnotifier.gitlab_api._session", session), \
+            mock.patch("gitlabnotifier.gitlab_api.gitlab_traces_limiter", limiter):
+        for _ in range(5):
+            assert list(gitlab_api.iter_job_trace_lines(1, 2)) == ["line"] * 3
+    # the downloads are longer than the target, but GitLab answered right away
+    assert limiter.limit == 4
+
+
+USERS = {
+    1: {
+        "id": 1,
+        "username": "alice",
+        "email": "alice@mycompany.com"
+    },
+    2: {
+        "id": 2,
+        "username": "bob",
+        "email": "bob@mycompany.com"
+    },
+    3: {
+        "id": 3,
+        "username": "carol",
+        "email": "carol@mycompany.com"
+    },
+}
+# carol has no public email, so she isn't returned by GraphQL
+PUBLIC_EMAILS = {1: "alice@mycompany.com", 2: "bob@mycompany.com"}
+
+
+def _users_handler(calls):
+
+    def handler(method, path, body):
+        calls.append((method, path))
+        if path == "/api/graphql":
+            variables = json.loads(body)["variables"]
+            if "ids" in variables:
+                ids = [int(gid.rsplit("/", 1)[-1]) for gid in variables["ids"]]
+            else:
+                usernames = {username.lower() for username in variables["usernames"]}
+                ids = [user_id for user_id, user in USERS.items() if user["username"] in usernames]
+            nodes = [
+                {
+                    "id": f"gid://gitlab/User/{user_id}",
+                    "username": USERS[user_id]["username"],
+                    "publicEmail": PUBLIC_EMAILS.get(user_id, ""),
+                } for user_id in ids if user_id in USERS
+            ]
+            return 200, {}, {"data": {"users": {"nodes": nodes}}}
+        if path.startswith("/api/v4/users?username="):
+            username = path.split("=")[1].lower()
+            return 200, {}, [user for user in USERS.values() if user["username"] == username]
+        return 200, {}, USERS[int(path.rsplit("/", 1)[-1])]
+
+    return handler
+
+
+@pytest.mark.parametrize("resolution", ["graphql", "rest"])
+def test_get_users(resolution):
+    gitlab_api.invalidate_user_cache()
+    calls = []
+    with stub.serve(_users_handler(calls)) as url, \
+            mock.patch("gitlabnotifier.gitlab_api.GITLAB_BASE_URL", url), \
+            mock.patch("gitlabnotifier.gitlab_api.GITLAB_USER_RESOLUTION", resolution):
+        assert gitlab_api.get_users([1, "2", 3]) == {"1": USERS[1], "2": USERS[2], "3": USERS[3]}
+        assert gitlab_api.get_users_by_username(["Alice", "carol", "unknown"]) == {
+            "Alice": [USERS[1]],
+            "carol": [USERS[3]],
+            "unknown": []
+        }
+        # cached users aren't fetched again
+        assert gitlab_api.get_users([2, 3]) == {"2": USERS[2], "3": USERS[3]}
+        assert gitlab_api.get_user(1) == USERS[1]
+    if resolution == "graphql":
+        assert calls[:3] == [
+            ("POST", "/api/graphql"), ("GET", "/api/v4/users/3"), ("POST", "/api/graphql")
+        ]
+        # the usernames which weren't found are looked up concurrently
+        assert sorted(calls[3:]) == [
+            ("GET", "/api/v4/users?username=carol"), ("GET", "/api/v4/users?username=unknown")
+        ]
+    else:
+        assert sorted(calls) == sorted(
+            [("GET", f"/api/v4/users/{user_id}") for user_id in (1, 2, 3)] +
+            [("GET", f"/api/v4/users?username={name}") for name in ("Alice", "carol", "unknown")]
+        )
+
+
+def test_get_users_falls_back_to_rest():
+    gitlab_api.invalidate_user_cache()
+    calls = []
+    handler = _users_handler(calls)
+
+    def graphql_unavailable(method, path, body):
+        if path == "/api/graphql":
+            calls.append((method, path))
+            return 404, {}, {"message": "Not found"}
+        return handler(method, path, body)
+
+    with stub.serve(graphql_unavailable) as url, \
+            mock.patch("gitlabnotifier.gitlab_api.GITLAB_BASE_URL", url), \
+            mock.patch("gitlabnotifier.gitlab_api.GITLAB_USER_RESOLUTION", "graphql"):
+        assert gitlab_api.get_users([1, 2]) == {"1": USERS[1], "2": USERS[2]}
+    assert calls[0] == ("POST", "/api/graphql")
+    assert sorted(calls[1:]) == [("GET", "/api/v4/users/1"), ("GET", "/api/v4/users/2")]
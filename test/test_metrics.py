@@ -0,0 +1,69 @@
+import threading
+import time
+
+from gitlabnotifier.metrics import Counter, Gauge, Histogram, Registry, timed
+
+
+def test_metrics_rendering():
+    registry = Registry()
+    events = registry.register(Counter("events_total", "Events.", ("object_kind",)))
+    duration = registry.register(Histogram("duration_seconds", "Duration.", buckets=(0.1, 1.)))
+    registry.register(Gauge("queue_depth", "Queue depth.", lambda: 3))
+    events.labels("note").inc()
+    events.labels("note").inc(2)
+    events.labels('pi"pe').inc()
+    duration.observe(0.05)
+    duration.observe(0.5)
+    duration.observe(5)
+    assert registry.render().split("\n") == [
+        "# HELP events_total Events.",
+        "# TYPE events_total counter",
+        'events_total{object_kind="note"} 3',
+        'events_total{object_kind="pi\\"pe"} 1',
+        "# HELP duration_seconds Duration.",
+        "# TYPE duration_seconds histogram",
+        'duration_seconds_bucket{le="0.1"} 1',
+        'duration_seconds_bucket{le="1.0"} 2',
+        'duration_seconds_bucket{le="+Inf"} 3',
+        "duration_seconds_sum 5.55",
+        "duration_seconds_count 3",
+        "# HELP queue_depth Queue depth.",
+        "# TYPE queue_depth gauge",
+        "queue_depth 3",
+        "",
+    ]
+
+
+def test_gauge_reads_its_value_on_collection():
+    values = iter([1, 2])
+    queue_depth = Gauge("queue_depth", "Queue depth.", lambda: next(values))
+    assert queue_depth.collect()[-1] == "queue_depth 1"
+    assert queue_depth.labels()() == 2
+
+
+def test_timed_decorator():
+    duration = Histogram("call_duration_seconds", "Duration.", ("function",))
+
+    @timed(duration)
+    def slow_function():
+        time.sleep(0.01)
+        return 42
+
+    assert slow_function() == 42
+    child = duration.labels("slow_function")
+    assert sum(child.bucket_counts) == 1 and child.sum >= 0.01
+
+
+def test_counter_concurrent_increments():
+    events = Counter("events_total", "Events.", ("object_kind",))
+
+    def increment():
+        for _ in range(10000):
+            events.labels("note").inc()
+
+    threads = [threading.Thread(target=increment) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert events.labels("note").value == 80000
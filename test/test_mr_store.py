@@ -0,0 +1,59 @@
+from unittest import mock
+
+from gitlabnotifier.mr_store import MergeRequestStore
+from gitlabnotifier.process_gitlab_notif import get_mr_author_id
+
+
+def _merge_request_event(iid, author_id, updated_at, title="Feature"):
+    return {
+        "object_kind": "merge_request",
+        "project": {"id": 1},
+        "object_attributes": {
+            "iid": iid, "author_id": author_id, "title": title, "updated_at": updated_at,
+            "description": "not stored"
+        },
+    }  # yapf: disable
+
+
+def test_mr_store_updates():
+    store = MergeRequestStore(maxsize=10)
+    store.update_from_event(_merge_request_event(2, 12, "2020-01-01 10:00:00 UTC"))
+    store.update_from_event(
+        {
+            "object_kind": "note",
+            "project_id": 1,
+            "merge_request": {
+                "iid": 3,
+                "author_id": 13,
+                "title": "Fix"
+            }
+        }
+    )
+    assert store.get(1, 2, 'author_id') == 12
+    assert store.get("1", "3", 'title') == "Fix"
+    assert store.get(1, 2, 'description') is None
+    assert store.get(1, 4, 'author_id') is None
+    assert (store.hits, store.misses) == (2, 2)
+
+    # webhooks may be received out of order
+    store.update_from_event(_merge_request_event(2, 12, "2020-01-01 11:00:00 UTC", title="New"))
+    store.update_from_event(_merge_request_event(2, 12, "2020-01-01 09:00:00 UTC", title="Old"))
+    assert store.get(1, 2, 'title') == "New"
+
+
+def test_mr_store_evicts_least_recently_used():
+    store = MergeRequestStore(maxsize=2)
+    store.update(1, 1, {"author_id": 1})
+    store.update(1, 2, {"author_id": 2})
+    store.get(1, 1, 'author_id')
+    store.update(1, 3, {"author_id": 3})
+    assert len(store) == 2
+    assert store.get(1, 2, 'author_id') is None
+    assert store.get(1, 1, 'author_id') == 1
+
+
+@mock.patch("gitlabnotifier.process_gitlab_notif.get_mr", return_value={"author": {"id": 21}})
+def test_get_mr_author_id_falls_back_to_gitlab(mock_get_mr):
+    assert get_mr_author_id(1000, 1) == 21
+    assert get_mr_author_id(1000, 1) == 21
+    assert mock_get_mr.call_count == 1
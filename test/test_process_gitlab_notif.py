@@ -1,10 +1,17 @@
+import time
 from contextlib import ExitStack
 from unittest import mock
 
 import pytest
 
-from gitlabnotifier.process_gitlab_notif import \
-    get_messages_and_emails_from_event
+from gitlabnotifier.discussion_index import DiscussionIndex
+from gitlabnotifier.mr_store import MergeRequestStore
+from gitlabnotifier.process_gitlab_notif import (
+    extract_mentionned_user_names, generate_pipeline_message,
+    get_event_priority, get_mentionned_user_emails,
+    get_messages_and_emails_from_event, get_partition_key,
+    get_users_emails_from_event_note)
+from gitlabnotifier.resilience import HIGH, LOW, NORMAL
 
 
 def mock_get_mr_discussion(project_id, mr_id, discussion_id, **kwargs):
@@ -47,6 +54,14 @@ def mock_get_user_by_username(username, **kwargs):
     return []
 
 
+def mock_get_users(user_ids, **kwargs):
+    return {str(user_id): mock_get_user(user_id) for user_id in user_ids}
+
+
+def mock_get_users_by_username(usernames, **kwargs):
+    return {username: mock_get_user_by_username(username) for username in usernames}
+
+
 def mock_get_mr(project_id, mr_id, **kwargs):
     if mr_id == 2:
         return {"author": {"id": "test1"}}
@@ -249,10 +264,10 @@ def mock_get_mr_participants(project_id, mr_id, **kwargs):
 @mock.patch(
     "gitlabnotifier.process_gitlab_notif.get_mr_discussion", side_effect=mock_get_mr_discussion
 )
-@mock.patch("gitlabnotifier.process_gitlab_notif.get_user", side_effect=mock_get_user)
+@mock.patch("gitlabnotifier.process_gitlab_notif.get_users", side_effect=mock_get_users)
 @mock.patch(
-    "gitlabnotifier.process_gitlab_notif.get_user_by_username",
-    side_effect=mock_get_user_by_username
+    "gitlabnotifier.process_gitlab_notif.get_users_by_username",
+    side_effect=mock_get_users_by_username
 )
 @mock.patch("gitlabnotifier.process_gitlab_notif.get_mr", side_effect=mock_get_mr)
 @mock.patch(
@@ -262,8 +277,189 @@ def test_get_user_emails_from_event(
     _mock1, _mock2, _mock3, _mock4, _mock5, event, expected_message, expected_user_emails
 ):
     with ExitStack() as context:
+        # fresh stores for each case, a decorator would share them between the cases
+        context.enter_context(
+            mock.patch(
+                "gitlabnotifier.process_gitlab_notif.mr_store", MergeRequestStore(maxsize=10)
+            )
+        )
+        context.enter_context(
+            mock.patch(
+                "gitlabnotifier.process_gitlab_notif.discussion_index", DiscussionIndex(maxsize=10)
+            )
+        )
         if expected_message is None:
             context.enter_context(pytest.raises(ValueError))
         message, user_emails = get_messages_and_emails_from_event(event)
         assert message == expected_message
         assert user_emails == expected_user_emails
+
+
+@pytest.mark.parametrize(
+    "comment,expected_user_names", [
+        ("no mention", []),
+        ("@test2 tata", ["test2"]),
+        ("cc @alice, @bob.smith and @carol-x.", ["alice", "bob.smith", "carol-x"]),
+        ("@alice @Alice @alice: again", ["alice"]),
+        ("mail me at alice@mycompany.com", []),
+        ("see `@decorator` and\n```python\n@pytest.fixture\n```\n@bob", ["bob"]),
+        ("(@alice)", ["alice"]),
+    ]
+)
+def test_extract_mentionned_user_names(comment, expected_user_names):
+    assert extract_mentionned_user_names(comment) == expected_user_names
+
+
+@mock.patch(
+    "gitlabnotifier.process_gitlab_notif.get_users_by_username",
+    side_effect=mock_get_users_by_username
+)
+def test_get_mentionned_user_emails_dedupes_lookups(mock_lookup):
+    event = {'object_attributes': {'description': '@test2 @Test4 @test2 @test2 @unknown'}}
+    assert get_mentionned_user_emails(event) == {"foobar2@heuri.fr", "test4@gmail.com"}
+    mock_lookup.assert_called_once_with(["test2", "Test4", "unknown"])
+
+
+PYTEST_TRACE = """\
+collected 3 items
+test_foo.py F..
+=================================== FAILURES ===================================
+___________________________________ test_foo ___________________________________
+    def test_foo():
+>       assert 1 == 2
+E       assert 1 == 2
+=========================== short test summary info ============================
+FAILED test_foo.py::test_foo - assert 1 == 2
+"""
+
+LINT_TRACE = """\
+$ pylint gitlabnotifier
+gitlabnotifier/app.py:12:0: E0401: Unable to import 'flask' (import-error) [E0401]
+gitlabnotifier/app.py:13:0: C0116: Missing function docstring [C0116]
+"""
+
+
+def mock_iter_job_trace_lines(project_id, job_id):
+    yield from {1: LINT_TRACE, 2: PYTEST_TRACE}[job_id].split("\n")
+
+
+@mock.patch(
+    "gitlabnotifier.process_gitlab_notif.iter_job_trace_lines",
+    side_effect=mock_iter_job_trace_lines
+)
+def test_pipeline_message(_mock):
+    event = {
+        'object_kind': 'pipeline',
+        'user': {'name': 'test3', 'email': 'hello_there@mycompany.com'},
+        'project': {'id': 7, 'path_with_namespace': 'mycompany/myproject', 'web_url': 'https://project'},
+        'commit': {'id': '0123456789', 'url': 'https://commit'},
+        'object_attributes': {'id': 42, 'status': 'failed'},
+        'builds': [
+            {'id': 1, 'stage': 'lint', 'name': 'pylint', 'status': 'failed'},
+            {'id': 2, 'stage': 'test', 'name': 'pytest', 'status': 'failed'},
+            {'id': 3, 'stage': 'build', 'name': 'docker', 'status': 'failed'},
+            {'id': 4, 'stage': 'test', 'name': 'pytest-2', 'status': 'success'},
+        ],
+    }  # yapf: disable
+    message, user_emails = get_messages_and_emails_from_event(event)
+    assert user_emails == {'hello_there@mycompany.com'}
+    assert message['text'] == (
+        '<https://project|mycompany/myproject> > <https://commit|012345> > '
+        'Pipeline <https://project/pipelines/42|#42> ran with status failed'
+    )
+    assert [(attachment['title'], attachment['text']) for attachment in message['attachments']] == [
+        ('Job pylint failed',
+         "gitlabnotifier/app.py:12:0: E0401: Unable to import 'flask' (import-error) [E0401]"),
+        ('Job pytest failed',
+         "___________________________________ test_foo ___________________________________\n"
+         "    def test_foo():\n&gt;       assert 1 == 2\nE       assert 1 == 2"),
+        ('Job docker failed', '(no details)'),
+    ]  # yapf: disable
+
+
+def mock_iter_slow_job_trace_lines(project_id, job_id):
+    if job_id == 1:
+        time.sleep(2)
+    yield from PYTEST_TRACE.split("\n")
+
+
+@mock.patch("gitlabnotifier.process_gitlab_notif.PIPELINE_TRACE_DEADLINE", 0.2)
+@mock.patch(
+    "gitlabnotifier.process_gitlab_notif.iter_job_trace_lines",
+    side_effect=mock_iter_slow_job_trace_lines
+)
+def test_pipeline_message_with_slow_trace(_mock):
+    builds = [
+        {
+            'id': job_id,
+            'stage': 'test',
+            'name': f'pytest-{job_id}',
+            'status': 'failed'
+        } for job_id in range(1, 11)
+    ]
+    event = {
+        'project': {'id': 7, 'path_with_namespace': 'mycompany/myproject', 'web_url': 'https://project'},
+        'commit': {'id': '0123456789', 'url': 'https://commit'},
+        'object_attributes': {'id': 42, 'status': 'failed'},
+        'builds': builds,
+    }  # yapf: disable
+    start = time.perf_counter()
+    message = generate_pipeline_message(event)
+    assert time.perf_counter() - start < 1
+    texts = [attachment['text'] for attachment in message['attachments']]
+    assert texts[0] == '(no details)'
+    assert all('assert 1 == 2' in text for text in texts[1:])
+
+
+def _slow(func):
+
+    def wrapper(*args, **kwargs):
+        time.sleep(0.3)
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+@mock.patch("gitlabnotifier.process_gitlab_notif.mr_store", MergeRequestStore(maxsize=10))
+@mock.patch("gitlabnotifier.process_gitlab_notif.discussion_index", DiscussionIndex(maxsize=10))
+@mock.patch(
+    "gitlabnotifier.process_gitlab_notif.get_mr_discussion",
+    side_effect=_slow(mock_get_mr_discussion)
+)
+@mock.patch("gitlabnotifier.process_gitlab_notif.get_mr", side_effect=_slow(mock_get_mr))
+@mock.patch(
+    "gitlabnotifier.process_gitlab_notif.get_users_by_username",
+    side_effect=_slow(mock_get_users_by_username)
+)
+@mock.patch("gitlabnotifier.process_gitlab_notif.get_users", side_effect=mock_get_users)
+def test_note_lookups_run_concurrently(_mock1, _mock2, _mock3, _mock4):
+    event = {
+        'project_id': 119,
+        'user': {'id': 'test3', 'email': 'hello_there@mycompany.com'},
+        'object_attributes': {'discussion_id': 'good', 'description': 'cc @Test4'},
+        'merge_request': {'iid': 2},
+    }  # yapf: disable
+    start = time.perf_counter()
+    assert get_users_emails_from_event_note(event) == {
+        "test1@gmail.com", "foobar2@heuri.fr", "test4@gmail.com"
+    }
+    assert time.perf_counter() - start < 0.6
+
+
+def test_get_partition_key():
+    merge = {'object_kind': 'merge_request', 'project': {'id': 1}, 'object_attributes': {'iid': 2}}
+    note = {'object_kind': 'note', 'project_id': 1, 'merge_request': {'iid': 2}}
+    mr_pipeline = {
+        'object_kind': 'pipeline', 'project': {'id': 1}, 'merge_request': {'iid': 2},
+        'object_attributes': {'id': 42}
+    }  # yapf: disable
+    pipeline = {'object_kind': 'pipeline', 'project': {'id': 1}, 'object_attributes': {'id': 42}}
+    assert get_partition_key(merge) == get_partition_key(note) == get_partition_key(mr_pipeline)
+    assert get_partition_key(pipeline) == (1, 'pipeline', 42)
+    assert get_partition_key({'object_kind': 'push'}) is None
+
+
+def test_get_event_priority():
+    assert get_event_priority({'object_kind': 'pipeline'}) == HIGH
+    assert get_event_priority({'object_kind': 'merge_request'}) == NORMAL
+    assert get_event_priority({'object_kind': 'note'}) == LOW
@@ -0,0 +1,123 @@
+import json
+import threading
+from datetime import datetime, timezone
+from unittest import mock
+
+from gitlabnotifier.replay import (MessageRecorder, get_event_time, parse_time,
+                                   replay_events)
+
+
+def _note(mr_iid, note_id, updated_at="2024-03-01 10:00:00 UTC"):
+    return {
+        'object_kind': 'note',
+        'project_id': 1,
+        'merge_request': {
+            'iid': mr_iid
+        },
+        'object_attributes':
+            {
+                'id': note_id,
+                'noteable_type': 'MergeRequest',
+                'updated_at': updated_at
+            },
+    }
+
+
+def _write_events(path, lines):
+    with open(path, 'a') as f:
+        for line in lines:
+            f.write((line if isinstance(line, str) else json.dumps(line)) + "\n")
+
+
+def test_parse_time():
+    expected = datetime(2024, 3, 1, 10, 0, tzinfo=timezone.utc)
+    assert parse_time("2024-03-01 10:00:00 UTC") == expected
+    assert parse_time("2024-03-01T10:00:00.000Z") == expected
+    assert parse_time("2024-03-01T11:00:00+01:00") == expected
+    assert parse_time("2024-03-01T10:00") == expected
+    assert get_event_time({'object_kind': 'push'}) is None
+
+
+def test_replay_keeps_the_order_of_a_mr(tmp_path):
+    path = tmp_path / "events.ndjson"
+    _write_events(
+        path, [_note(mr_iid=i % 3, note_id=i) for i in range(60)] +
+        ["", "not json", json.dumps({'object_kind': 'push'})]
+    )
+    processed = []
+    lock = threading.Lock()
+
+    def handler(event):
+        with lock:
+            processed.append((event['merge_request']['iid'], event['object_attributes']['id']))
+
+    stats = replay_events(str(path), handler, concurrency=4)
+    assert stats["read"] == 63
+    assert stats["processed"] == 60
+    assert stats["invalid"] == 1
+    assert stats["dropped"] == 1
+    for mr_iid in range(3):
+        note_ids = [note_id for iid, note_id in processed if iid == mr_iid]
+        assert note_ids == list(range(mr_iid, 60, 3))
+
+
+def test_replay_filters_by_time(tmp_path):
+    path = tmp_path / "events.ndjson"
+    _write_events(
+        path, [
+            _note(1, 1, "2024-03-01 09:59:59 UTC"),
+            _note(1, 2, "2024-03-01 10:00:00 UTC"),
+            _note(1, 3, "2024-03-01T10:30:00Z"),
+            _note(1, 4, "2024-03-01 11:00:00 UTC"),
+        ]
+    )
+    processed = []
+    stats = replay_events(
+        str(path),
+        lambda event: processed.append(event['object_attributes']['id']),
+        concurrency=1,
+        since=parse_time("2024-03-01T10:00:00Z"),
+        until=parse_time("2024-03-01T11:00:00Z"),
+    )
+    assert processed == [2, 3]
+    assert stats["out_of_range"] == 2
+
+
+def test_replay_resumes_from_the_checkpoint(tmp_path):
+    path, checkpoint = tmp_path / "events.ndjson", str(tmp_path / "checkpoint.json")
+    _write_events(path, [_note(1, i) for i in range(10)])
+    processed = []
+
+    def handler(event):
+        if event['object_attributes']['id'] == 7:
+            raise ValueError("failed")
+        processed.append(event['object_attributes']['id'])
+
+    stats = replay_events(str(path), handler, concurrency=2, checkpoint_path=checkpoint)
+    assert stats["processed"] == 9 and stats["failed"] == 1
+    with open(checkpoint) as f:
+        assert json.load(f)["line"] == 11
+
+    _write_events(path, [_note(1, i) for i in range(10, 15)])
+    stats = replay_events(str(path), handler, concurrency=2, checkpoint_path=checkpoint)
+    assert stats["read"] == 5
+    assert sorted(processed) == [i for i in range(15) if i != 7]
+
+
+def test_message_recorder(tmp_path):
+    output = tmp_path / "messages.ndjson"
+    with open(output, 'w') as f, mock.patch(
+        "gitlabnotifier.replay.get_messages_and_emails_from_event", lambda event:
+        ({
+            "text": "hello"
+        }, {"b@mycompany.com", "a@mycompany.com"})
+    ):
+        MessageRecorder(f)(_note(1, 1))
+    with open(output) as f:
+        assert json.loads(f.read()) == {
+            "object_kind": "note",
+            "message": {
+                "text": "hello"
+            },
+            "emails": ["a@mycompany.com", "b@mycompany.com"],
+        }
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+from gitlabnotifier.concurrency import map_concurrently
+from gitlabnotifier.resilience import (HIGH, LOW, NORMAL, AdaptiveLimiter,
+                                       CircuitBreaker, CircuitOpenError,
+                                       OverloadedError, RateLimitGate,
+                                       get_priority, priority)
+
+
+def _call(breaker, success):
+    with breaker.guard() as call:
+        if success:
+            call.succeeded()
+        else:
+            call.failed()
+
+
+def test_circuit_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=60)
+    _call(breaker, False)
+    _call(breaker, False)
+    _call(breaker, True)  # a success resets the count
+    _call(breaker, False)
+    _call(breaker, False)
+    assert breaker.state == CircuitBreaker.CLOSED
+    _call(breaker, False)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        _call(breaker, True)
+
+
+def test_half_open_circuit_lets_a_single_probe_through():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+    _call(breaker, False)
+    time.sleep(0.06)
+    with breaker.guard() as probe:
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(CircuitOpenError):
+            _call(breaker, True)
+        probe.failed()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    with breaker.guard():
+        pass  # the probe wasn't made, e.g. it was shed: another probe is let through
+    _call(breaker, True)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_limit_decreases_with_latency_and_increases_again():
+    limiter = AdaptiveLimiter("test", min_limit=2, max_limit=10, latency_target=0.01)
+    for _ in range(30):
+        with limiter.slot():
+            time.sleep(0.02)
+    assert limiter.limit == 2
+    for _ in range(20):
+        with limiter.slot():
+            pass
+    assert 2 < limiter.limit < 10
+
+
+def test_waiting_calls_are_served_by_priority():
+    limiter = AdaptiveLimiter("test", min_limit=1, max_limit=1, latency_target=1)
+    served = []
+
+    def call(call_priority):
+        with limiter.slot(call_priority):
+            served.append(call_priority)
+
+    with limiter.slot(NORMAL):
+        threads = []
+        for call_priority in (LOW, NORMAL, HIGH):
+            threads.append(threading.Thread(target=call, args=(call_priority,)))
+            threads[-1].start()
+            while limiter.waiting_count < len(threads):
+                time.sleep(0.001)
+    for thread in threads:
+        thread.join(timeout=5)
+    assert served == [HIGH, NORMAL, LOW]
+
+
+def test_low_priority_calls_are_shed():
+    limiter = AdaptiveLimiter(
+        "test", min_limit=1, max_limit=1, latency_target=1, low_priority_max_wait=0.05
+    )
+    with limiter.slot(HIGH):
+        with pytest.raises(OverloadedError):
+            with limiter.slot(LOW):
+                pass
+        assert limiter.waiting_count == 0
+    with limiter.slot(LOW):
+        pass
+
+
+def test_rate_limit_gate_waits_for_the_reset():
+    gate = RateLimitGate("test", reserve=1, low_priority_max_wait=0.5)
+    gate.update({'RateLimit-Remaining': '5', 'RateLimit-Reset': str(time.time() + 60)})
+    gate.wait(LOW)
+    gate.update({'RateLimit-Remaining': '1', 'RateLimit-Reset': str(time.time() + 0.1)})
+    start = time.monotonic()
+    gate.wait(HIGH)
+    assert time.monotonic() - start >= 0.05
+    gate.update({'RateLimit-Remaining': '0', 'RateLimit-Reset': str(time.time() + 60)})
+    with pytest.raises(OverloadedError):
+        gate.wait(LOW)
+
+
+def test_priority_is_propagated_to_concurrent_calls():
+    assert get_priority() == NORMAL
+    with priority(LOW):
+        assert map_concurrently(lambda _: get_priority(), range(4), max_workers=4) == [LOW] * 4
+    assert get_priority() == NORMAL
@@ -0,0 +1,252 @@
+import json
+import threading
+import time
+from unittest import mock
+
+from slack.errors import SlackApiError
+from slack.signature import SignatureVerifier
+from slack.web.slack_response import SlackResponse
+
+from gitlabnotifier import slack_api
+from gitlabnotifier.ratelimit import TokenBucket
+from gitlabnotifier.resilience import CircuitBreaker
+
+
+def _slack_response(data, status_code=200, headers=None):
+    return SlackResponse(
+        client=None,
+        http_verb="POST",
+        api_url="https://slack.com/api/chat.postMessage",
+        req_args={},
+        data=data,
+        headers=headers or {},
+        status_code=status_code
+    )
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=100, capacity=5)
+    start = time.perf_counter()
+    for _ in range(15):
+        assert bucket.acquire()
+    # the 5 first calls are a burst, the 10 next ones need 0.1s
+    assert time.perf_counter() - start >= 0.09
+    assert not bucket.acquire(tokens=5, timeout=0.01)
+
+
+@mock.patch("gitlabnotifier.slack_api.time.sleep")
+@mock.patch("gitlabnotifier.slack_api.slack_client")
+def test_slack_message_retries_when_rate_limited(mock_client, mock_sleep):
+    data = {"ok": False, "error": "ratelimited"}
+    rate_limited = _slack_response(data, status_code=429, headers={"Retry-After": "3"})
+    mock_client.chat_postMessage.side_effect = [
+        SlackApiError("ratelimited", rate_limited),
+        _slack_response({"ok": True}),
+    ]
+    assert slack_api.slack_message({"text": "hello"}, "@test")["ok"]
+    mock_sleep.assert_called_once_with(3.)
+
+
+@mock.patch("gitlabnotifier.slack_api.slack_client")
+def test_slack_message_returns_errors(mock_client):
+    not_found = _slack_response({"ok": False, "error": "channel_not_found"})
+    mock_client.chat_postMessage.side_effect = SlackApiError("channel_not_found", not_found)
+    assert not slack_api.slack_message({"text": "hello"}, "@test")["ok"]
+    assert mock_client.chat_postMessage.call_count == 1
+
+
+@mock.patch("gitlabnotifier.slack_api.EMAIL_TO_SLACK_ID", slack_api.SlackDirectory())
+@mock.patch("gitlabnotifier.slack_api.slack_client")
+def test_slack_direct_messages_are_sent_concurrently(mock_client):
+    barrier = threading.Barrier(3, timeout=5)
+
+    def post_message(channel, **kwargs):
+        barrier.wait()  # fails unless the 3 messages are sent at the same time
+        return _slack_response({"ok": True, "channel": channel})
+
+    mock_client.conversations_open.side_effect = lambda users: {"channel": {"id": "D" + users}}
+    mock_client.chat_postMessage.side_effect = post_message
+    responses = slack_api.slack_direct_messages({"text": "hello"}, ["U1", "U2", "U3"])
+    assert {
+        user_id: res["channel"] for user_id, res in responses.items()
+    } == {
+        "U1": "DU1",
+        "U2": "DU2",
+        "U3": "DU3"
+    }
+
+
+@mock.patch("gitlabnotifier.slack_api.EMAIL_TO_SLACK_ID", slack_api.SlackDirectory())
+@mock.patch("gitlabnotifier.slack_api.slack_breaker", CircuitBreaker("slack", 5, 30))
+@mock.patch("gitlabnotifier.slack_api.slack_client")
+def test_slack_direct_messages_failures_do_not_fail_the_others(mock_client):
+
+    def post_message(channel, **kwargs):
+        if channel == "DU2":
+            raise OSError("connection reset")
+        return _slack_response({"ok": True, "channel": channel})
+
+    mock_client.conversations_open.side_effect = lambda users: {"channel": {"id": "D" + users}}
+    mock_client.chat_postMessage.side_effect = post_message
+    responses = slack_api.slack_direct_messages({"text": "hello"}, ["U1", "U2", "U3"])
+    assert {
+        user_id: res["ok"] for user_id, res in responses.items()
+    } == {
+        "U1": True,
+        "U2": False,
+        "U3": True
+    }
+
+
+@mock.patch("gitlabnotifier.slack_api.slack_client")
+def test_get_email_to_slack_id_paginates(mock_client):
+    pages = {
+        None:
+            {
+                "members":
+                    [
+                        {
+                            "id": "UALICE",
+                            "name": "alice",
+                            "profile": {
+                                "email": "alice@mycompany.com"
+                            }
+                        },
+                        {
+                            "id": "UBOT",
+                            "name": "bot",
+                            "profile": {}
+                        },
+                    ],
+                "response_metadata": {
+                    "next_cursor": "page2"
+                },
+            },
+        "page2":
+            {
+                "members":
+                    [
+                        {
+                            "id": "UBOB",
+                            "name": "bob",
+                            "profile": {
+                                "email": "bob@mycompany.com"
+                            }
+                        },
+                        {
+                            "id": "UCAROL",
+                            "name": "carol",
+                            "deleted": True,
+                            "profile": {
+                                "email": "carol@mycompany.com"
+                            }
+                        },
+                    ],
+                "response_metadata": {
+                    "next_cursor": ""
+                },
+            },
+    }
+    mock_client.users_list.side_effect = lambda limit, cursor=None: pages[cursor]
+    assert slack_api.get_email_to_slack_id() == {
+        "alice@mycompany.com": "UALICE",
+        "bob@mycompany.com": "UBOB",
+    }
+    mock_client.users_profile_get.assert_not_called()
+
+
+@mock.patch("gitlabnotifier.slack_api.get_email_to_slack_id")
+def test_slack_directory_refresh_swaps_map(mock_get_email_to_slack_id):
+    directory = slack_api.SlackDirectory({"alice@mycompany.com": "UALICE"})
+    mock_get_email_to_slack_id.return_value = {"bob@mycompany.com": "UBOB"}
+    directory.refresh()
+    assert directory.get("alice@mycompany.com") is None
+    assert directory["bob@mycompany.com"] == "UBOB"
+
+
+@mock.patch("gitlabnotifier.slack_api.get_email_to_slack_id")
+def test_slack_directory_try_refresh(mock_get_email_to_slack_id):
+    directory = slack_api.SlackDirectory()
+    mock_get_email_to_slack_id.side_effect = OSError("unreachable")
+    assert not directory.try_refresh()
+    assert not directory.loaded
+    mock_get_email_to_slack_id.side_effect = None
+    mock_get_email_to_slack_id.return_value = {"bob@mycompany.com": "UBOB"}
+    assert directory.try_refresh()
+    assert directory.loaded
+
+
+def test_slack_directory_update_user():
+    directory = slack_api.SlackDirectory(
+        {
+            "alice@mycompany.com": "UALICE",
+            "bob@mycompany.com": "UBOB"
+        }
+    )
+    directory.update_user({"id": "UALICE", "profile": {"email": "alice@newcompany.com"}})
+    directory.update_user(
+        {
+            "id": "UBOB",
+            "deleted": True,
+            "profile": {
+                "email": "bob@mycompany.com"
+            }
+        }
+    )
+    directory.update_user({"id": "UCAROL", "profile": {"email": "carol@mycompany.com"}})
+    assert directory.dump()["email_to_slack_id"] == {
+        "alice@newcompany.com": "UALICE",
+        "carol@mycompany.com": "UCAROL",
+    }
+
+
+@mock.patch("gitlabnotifier.app.SLACK_SIGNING_SECRET", "secret")
+@mock.patch("gitlabnotifier.app.EMAIL_TO_SLACK_ID")
+def test_slack_user_events_update_the_directory(mock_directory):
+    from gitlabnotifier.app import \
+        app  # pylint: disable=import-outside-toplevel
+    client = app.test_client()
+    user = {"id": "UALICE", "profile": {"email": "alice@newcompany.com"}}
+    body = json.dumps({"type": "event_callback", "event": {"type": "user_change", "user": user}})
+    timestamp = str(int(time.time()))
+    signature = SignatureVerifier("secret").generate_signature(timestamp=timestamp, body=body)
+    headers = {"X-Slack-Request-Timestamp": timestamp, "X-Slack-Signature": signature}
+
+    res = client.post("/slack/events", data=body, content_type="application/json", headers=headers)
+    assert res.status_code == 200
+    mock_directory.update_user.assert_called_once_with(user)
+
+    headers["X-Slack-Signature"] = "v0=invalid"
+    res = client.post("/slack/events", data=body, content_type="application/json", headers=headers)
+    assert res.status_code == 403
+    assert mock_directory.update_user.call_count == 1
+
+
+@mock.patch("gitlabnotifier.slack_api.SLACK_DIRECTORY_LOAD_TIMEOUT", 0.2)
+def test_slack_directory_lookups_wait_once_for_the_load():
+    directory = slack_api.SlackDirectory()
+    start = time.monotonic()
+    for _ in range(3):
+        assert directory.get("alice@mycompany.com") is None
+        assert "alice@mycompany.com" not in directory
+    assert 0.2 <= time.monotonic() - start < 0.4
+
+
+@mock.patch("gitlabnotifier.slack_api.slack_client")
+def test_slack_directory_keeps_dm_channels(mock_client, tmp_path):
+    path = str(tmp_path / "dm_channels.json")
+    mock_client.conversations_open.side_effect = lambda users: {"channel": {"id": "D" + users}}
+    directory = slack_api.SlackDirectory({"alice@mycompany.com": "UALICE"}, path)
+    assert directory.get_dm_channel("UALICE") == "DUALICE"
+    assert directory.get_dm_channel("UALICE") == "DUALICE"
+    assert mock_client.conversations_open.call_count == 1
+
+    # the channels aren't opened again after a restart
+    directory = slack_api.SlackDirectory({}, path)
+    assert directory.get_dm_channel("UALICE") == "DUALICE"
+    assert mock_client.conversations_open.call_count == 1
+
+    # when the channel can't be opened, the message is posted to the user ID
+    not_allowed = _slack_response({"ok": False, "error": "missing_scope"})
+    mock_client.conversations_open.side_effect = SlackApiError("missing_scope", not_allowed)
+    assert directory.get_dm_channel("UBOB") == "UBOB"
@@ -0,0 +1,66 @@
+import gzip
+import json
+import threading
+import time
+from unittest import mock
+
+from gitlabnotifier import gitlab_api, snapshot
+from gitlabnotifier.mr_store import MergeRequestStore
+from gitlabnotifier.slack_api import SlackDirectory
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "snapshot.json.gz")
+    directory = SlackDirectory({"alice@mycompany.com": "UALICE"})
+    directory._dm_channels["UALICE"] = "DALICE"  # pylint: disable=protected-access
+    store = MergeRequestStore(maxsize=10)
+    store.update(1, 2, {"author_id": 12, "title": "Feature"})
+    gitlab_api.invalidate_user_cache()
+    gitlab_api.load_user_cache([["12", {"id": 12, "email": "alice@mycompany.com"}]], age=0)
+    with mock.patch("gitlabnotifier.snapshot.EMAIL_TO_SLACK_ID", directory), \
+            mock.patch("gitlabnotifier.snapshot.mr_store", store):
+        snapshot.save_snapshot(path)
+
+    gitlab_api.invalidate_user_cache()
+    directory = SlackDirectory()
+    store = MergeRequestStore(maxsize=10)
+    with mock.patch("gitlabnotifier.snapshot.EMAIL_TO_SLACK_ID", directory), \
+            mock.patch("gitlabnotifier.snapshot.mr_store", store):
+        assert snapshot.load_snapshot(path)
+    assert directory.get("alice@mycompany.com") == "UALICE"
+    assert directory.get_dm_channel("UALICE") == "DALICE"
+    assert store.get("1", "2", "author_id") == 12
+    with mock.patch("gitlabnotifier.gitlab_api._call_api") as mock_call_api:
+        assert gitlab_api.get_user(12)["email"] == "alice@mycompany.com"
+    mock_call_api.assert_not_called()
+
+
+def test_snapshot_of_another_version_is_ignored(tmp_path):
+    path = str(tmp_path / "snapshot.json.gz")
+    with gzip.open(path, 'wt') as f:
+        json.dump({"version": snapshot.SNAPSHOT_VERSION + 1}, f)
+    assert not snapshot.load_snapshot(path)
+    assert not snapshot.load_snapshot(str(tmp_path / "missing.json.gz"))
+
+
+@mock.patch("gitlabnotifier.slack_api.get_email_to_slack_id")
+def test_slack_directory_revalidates_snapshot(mock_get_email_to_slack_id):
+    refreshed = threading.Event()
+
+    def get_email_to_slack_id():
+        refreshed.wait(5)
+        return {"bob@mycompany.com": "UBOB"}
+
+    mock_get_email_to_slack_id.side_effect = get_email_to_slack_id
+    directory = SlackDirectory()
+    directory.load({"email_to_slack_id": {"alice@mycompany.com": "UALICE"}, "dm_channels": {}})
+    directory.start_background_refresh(interval=0)
+    # the snapshot is served while it is revalidated
+    assert directory.get("alice@mycompany.com") == "UALICE"
+    refreshed.set()
+    for _ in range(50):
+        if directory.get("bob@mycompany.com"):
+            break
+        time.sleep(0.1)
+    assert directory.get("bob@mycompany.com") == "UBOB"
+    assert directory.get("alice@mycompany.com") is None
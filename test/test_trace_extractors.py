@@ -0,0 +1,138 @@
+import time
+
+import pytest
+
+from gitlabnotifier.trace_extractors import (BATCH_SIZE, DEFAULT_REGISTRY,
+                                             ExtractorRegistry, load_registry)
+
+PYTEST_TRACE = """\
+collected 3 items
+test_foo.py F..
+=================================== FAILURES ===================================
+___________________________________ test_foo ___________________________________
+    def test_foo():
+>       assert 1 == 2
+E       assert 1 == 2
+=========================== short test summary info ============================
+FAILED test_foo.py::test_foo - assert 1 == 2
+"""
+
+LINT_TRACE = """\
+$ flake8 && pylint gitlabnotifier && mypy gitlabnotifier
+gitlabnotifier/app.py:3:1: F401 'os' imported but unused
+gitlabnotifier/app.py:4:80: W505 doc line too long (82 > 79 characters)
+gitlabnotifier/app.py:12:0: E0401: Unable to import 'flask' (import-error)
+gitlabnotifier/app.py:13:0: C0116: Missing function or method docstring (missing-docstring)
+gitlabnotifier/format.py:7: error: Incompatible return value type (got "int", expected "str")
+gitlabnotifier/format.py:9: note: See https://mypy.readthedocs.io
+"""
+
+
+def _build(stage, name='job'):
+    return {'stage': stage, 'name': name}
+
+
+def test_pytest_extractor_stops_after_failures_block():
+    read_lines = []
+
+    def lines():
+        # lines are read by batches, the rest of the trace must be long enough not to be read
+        for line in PYTEST_TRACE.split("\n") + ["FAILED"] * 10 * BATCH_SIZE:
+            read_lines.append(line)
+            yield line
+
+    extractor = ExtractorRegistry(DEFAULT_REGISTRY).get_extractor(_build('test'))
+    assert list(extractor.extract(lines())) == [
+        "___________________________________ test_foo ___________________________________",
+        "    def test_foo():",
+        ">       assert 1 == 2",
+        "E       assert 1 == 2",
+    ]
+    assert len(read_lines) <= 2 * BATCH_SIZE
+
+
+def test_extractor_block_across_batches():
+    extractor = ExtractorRegistry(DEFAULT_REGISTRY).get_extractor(_build('test'))
+    failures = [f"E       assert {i} == 0" for i in range(3 * BATCH_SIZE)]
+    trace = ["collected 1 item"] * (BATCH_SIZE - 1) + PYTEST_TRACE.split("\n")[2:3] + failures
+    trace += PYTEST_TRACE.split("\n")[-3:]
+    assert list(extractor.extract(trace)) == failures
+
+
+def test_lint_extractor():
+    extractor = ExtractorRegistry(DEFAULT_REGISTRY).get_extractor(_build('lint'))
+    assert list(extractor.extract(LINT_TRACE.split("\n"))) == [
+        "gitlabnotifier/app.py:3:1: F401 'os' imported but unused",
+        "gitlabnotifier/app.py:12:0: E0401: Unable to import 'flask' (import-error)",
+        'gitlabnotifier/format.py:7: error: Incompatible return value type (got "int", expected "str")',
+    ]
+
+
+def test_registry_matches_stage_and_name():
+    registry = load_registry(
+        '[{"stage": "test", "name": "mypy*", "rules": ["mypy"]}, {"stage": "test*", "rules": ["pytest"]}]'
+    )
+    assert registry.get_extractor(_build('test',
+                                         'mypy-strict')).rules[0].pattern.endswith("error: ")
+    assert registry.get_extractor(_build('test-gpu', 'pytest')).rules[0].end_pattern is not None
+    assert registry.get_extractor(_build('lint')) is None
+    registry.register(['generic'], stage='deploy')
+    assert registry.get_extractor(_build('deploy')) is not None
+    with pytest.raises(ValueError):
+        registry.register(['unknown'])
+
+
+def _legacy_extract_lint_errors(trace):
+    for line in trace.split('\n'):
+        if "[E" in line:
+            yield line.rstrip()
+
+
+def _legacy_extract_pytest_fails(trace):
+    failures_block = False
+    for line in trace.split('\n'):
+        if line.startswith('=================================== FAILURES'):
+            failures_block = True
+            continue
+        elif failures_block and line.startswith('======================'):
+            failures_block = False
+        if failures_block:
+            yield line
+
+
+def _throughput(func, trace, repeat=3):
+    """Best throughput in MB/s over `repeat` runs"""
+    best_duration = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best_duration = min(best_duration, time.perf_counter() - start)
+    return len(trace) / 1e6 / best_duration
+
+
+def test_extraction_throughput():
+    """Micro-benchmark of the extractors against the ones they replaced (a pass over the trace per
+    extractor). Run with `pytest -s` to see the results."""
+    log_lines = "\n".join(
+        f"tests/test_module.py::test_case_{i} PASSED{' ' * 40}[ 42%]" for i in range(100000)
+    )
+    trace = f"{LINT_TRACE}{log_lines}\n{PYTEST_TRACE}"
+    registry = ExtractorRegistry(DEFAULT_REGISTRY)
+    registry.register(['pylint', 'pytest'], stage='lint-and-test')
+    registry.register(['pylint', 'flake8', 'mypy', 'pytest'], stage='all')
+    extractor = registry.get_extractor(_build('lint-and-test'))
+    all_rules_extractor = registry.get_extractor(_build('all'))
+
+    def legacy():
+        return list(_legacy_extract_lint_errors(trace)), list(_legacy_extract_pytest_fails(trace))
+
+    legacy_throughput = _throughput(legacy, trace)
+    throughput = _throughput(lambda: list(extractor.extract(trace.split('\n'))), trace)
+    all_rules_throughput = _throughput(
+        lambda: list(all_rules_extractor.extract(trace.split('\n'))), trace
+    )
+    print(
+        f"\ntrace of {len(trace) / 1e6:.1f} MB: legacy extractors {legacy_throughput:.0f} MB/s, "
+        f"single pass {throughput:.0f} MB/s (same rules), {all_rules_throughput:.0f} MB/s (all rules)"
+    )
+    assert "E       assert 1 == 2" in all_rules_extractor.extract(trace.split('\n'))
@@ -0,0 +1,113 @@
+import json
+import time
+
+import pytest
+import stub
+
+from gitlabnotifier.concurrency import map_concurrently
+from gitlabnotifier.tracing import (REDACTED, FileSpanExporter,
+                                    OtlpSpanExporter, Tracer, redact, span)
+
+
+def _process_event():
+    with span("dispatch", object_kind="note") as dispatch_span:
+        dispatch_span.set_attribute("handler", "generate_note_message")
+        map_concurrently(lambda i: _call("gitlab", i), range(2), max_workers=2)
+    _call("slack.chat_postMessage", 0)
+
+
+def _call(name, i):
+    with span(name, i=i):
+        time.sleep(0.001)
+
+
+def test_slow_events_keep_their_span_tree():
+    tracer = Tracer(slow_threshold=1e-6, sample_rate=0)
+    payload = {"object_kind": "note", "user": {"email": "a@mycompany.com"}, "object_attributes": {}}
+    with tracer.trace("event", payload=payload, object_kind="note"):
+        _process_event()
+    slow_event, = tracer.get_slow_events()
+    assert slow_event["payload"]["user"] == {"email": REDACTED}
+    tree = slow_event["spans"]
+    assert tree["name"] == "event" and tree["attributes"] == {"object_kind": "note"}
+    dispatch, slack = tree["children"]
+    assert dispatch["attributes"] == {"object_kind": "note", "handler": "generate_note_message"}
+    assert [child["name"] for child in dispatch["children"]] == ["gitlab", "gitlab"]
+    assert slack["name"] == "slack.chat_postMessage"
+    assert slack["start"] >= dispatch["start"] + dispatch["duration"]
+
+
+def test_fast_events_and_untraced_calls_are_not_kept():
+    tracer = Tracer(slow_threshold=60, sample_rate=0, slow_event_count=2)
+    with tracer.trace("event"):
+        _process_event()
+    _process_event()  # outside of a trace, the spans are no-ops
+    assert tracer.get_slow_events() == []
+
+
+def test_spans_record_errors():
+    tracer = Tracer(slow_threshold=1e-6, sample_rate=0)
+    with pytest.raises(ValueError):
+        with tracer.trace("event"):
+            with span("gitlab"):
+                raise ValueError("unavailable")
+    tree = tracer.get_slow_events()[0]["spans"]
+    assert tree["error"] == tree["children"][0]["error"] == "ValueError: unavailable"
+
+
+def test_redact():
+    payload = {
+        "object_attributes": {"note": "secret plan", "noteable_type": "MergeRequest"},
+        "merge_request": {"title": "Acquire ACME", "last_commit": {"id": "abc", "message": "Sign"}},
+        "changes": {"title": {"previous": "Draft", "current": "Acquire ACME"}},
+        "assignees": [{"id": 1, "name": "Alice", "username": "alice", "email": "alice@mycompany.com"}],
+        "user": {"email": None},
+    }  # yapf: disable
+    assert redact(payload) == {
+        "object_attributes": {"note": REDACTED, "noteable_type": "MergeRequest"},
+        "merge_request": {"title": REDACTED, "last_commit": {"id": "abc", "message": REDACTED}},
+        "changes": {"title": REDACTED},
+        "assignees": [{"id": 1, "name": REDACTED, "username": REDACTED, "email": REDACTED}],
+        "user": {"email": None},
+    }  # yapf: disable
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_file_exporter_writes_otlp(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    tracer = Tracer(slow_threshold=0, sample_rate=1, exporter=FileSpanExporter(str(path)))
+    with tracer.trace("event", username="alice"):
+        _process_event()
+    _wait_for(path.exists)
+    spans = json.loads(path.read_text())["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert sorted(otlp_span["name"] for otlp_span in spans
+                 ) == ["dispatch", "event", "gitlab", "gitlab", "slack.chat_postMessage"]
+    assert len({otlp_span["traceId"] for otlp_span in spans}) == 1
+    root, = [otlp_span for otlp_span in spans if "parentSpanId" not in otlp_span]
+    assert root["name"] == "event"
+    assert root["attributes"] == [{"key": "username", "value": {"stringValue": REDACTED}}]
+
+
+def test_otlp_exporter_posts_sampled_events():
+    requests_received = []
+
+    def handler(method, path, body):
+        requests_received.append((method, path, json.loads(body)))
+        return 200, {}, {}
+
+    with stub.serve(handler) as url:
+        tracer = Tracer(
+            slow_threshold=0, sample_rate=1, exporter=OtlpSpanExporter(f"{url}/v1/traces")
+        )
+        with tracer.trace("event"):
+            pass
+        _wait_for(lambda: requests_received)
+    method, path, body = requests_received[0]
+    assert (method, path) == ("POST", "/v1/traces")
+    assert body["resourceSpans"][0]["scopeSpans"][0]["spans"][0]["name"] == "event"
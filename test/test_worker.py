@@ -0,0 +1,196 @@
+import random
+import threading
+import time
+
+from gitlabnotifier.worker import WorkerPool
+
+
+def test_worker_pool_processes_events():
+    processed = []
+    pool = WorkerPool(lambda event: processed.append(event['id']), worker_count=3, queue_size=100)
+    for i in range(50):
+        assert pool.submit({'id': i})
+    pool.shutdown(timeout=5)
+    assert sorted(processed) == list(range(50))
+
+
+def test_worker_pool_drains_on_shutdown():
+    processed = []
+
+    def slow_handler(event):
+        time.sleep(0.01)
+        processed.append(event['id'])
+
+    pool = WorkerPool(slow_handler, worker_count=1, queue_size=100)
+    for i in range(20):
+        pool.submit({'id': i})
+    pool.shutdown(timeout=5)
+    assert processed == list(range(20))
+    assert not pool.submit({'id': 20})
+
+
+def test_worker_pool_rejects_when_full():
+    release = threading.Event()
+    pool = WorkerPool(lambda event: release.wait(), worker_count=1, queue_size=2)
+    results = [pool.submit({'id': i}) for i in range(10)]
+    assert not all(results)
+    release.set()
+    pool.shutdown(timeout=5)
+
+
+def test_worker_pool_survives_handler_errors():
+    processed = []
+
+    def failing_handler(event):
+        if event['id'] == 0:
+            raise RuntimeError("boom")
+        processed.append(event['id'])
+
+    pool = WorkerPool(failing_handler, worker_count=1, queue_size=10)
+    pool.submit({'id': 0})
+    pool.submit({'id': 1})
+    pool.shutdown(timeout=5)
+    assert processed == [1]
+
+
+def test_worker_pool_orders_events_of_a_partition():
+    processed = {key: [] for key in range(10)}
+    active = set()
+    lock = threading.Lock()
+    overlaps = []
+
+    def handler(event):
+        with lock:
+            if event['key'] in active:
+                overlaps.append(event)
+            active.add(event['key'])
+        time.sleep(random.random() / 1000)
+        with lock:
+            active.remove(event['key'])
+        processed[event['key']].append(event['id'])
+
+    pool = WorkerPool(
+        handler,
+        worker_count=8,
+        queue_size=1000,
+        partition_key=lambda event: event['key'],
+    )
+    for i in range(50):
+        for key in range(10):
+            assert pool.submit({'key': key, 'id': i})
+    pool.shutdown(timeout=10)
+    assert not overlaps
+    assert all(ids == list(range(50)) for ids in processed.values())
+
+
+def test_worker_pool_processes_partitions_in_parallel():
+    barrier = threading.Barrier(4, timeout=5)
+    processed = []
+
+    def handler(event):
+        barrier.wait()  # fails unless the 4 partitions are processed at the same time
+        processed.append(event['key'])
+
+    pool = WorkerPool(handler, worker_count=4, queue_size=10, partition_key=lambda e: e['key'])
+    for key in range(4):
+        pool.submit({'key': key})
+    pool.shutdown(timeout=5)
+    assert sorted(processed) == [0, 1, 2, 3]
+
+
+def test_worker_pool_partitions_take_turns():
+    processed = []
+    release = threading.Event()
+
+    def handler(event):
+        release.wait(5)
+        processed.append(event['key'])
+
+    pool = WorkerPool(handler, worker_count=1, queue_size=100, partition_key=lambda e: e['key'])
+    for _ in range(20):
+        pool.submit({'key': 'noisy'})
+    pool.submit({'key': 'quiet'})
+    release.set()
+    pool.shutdown(timeout=5)
+    # the event of the quiet MR doesn't wait for all the events of the noisy one
+    assert processed.index('quiet') <= 2
+
+
+def test_worker_pool_bounds_partitions():
+    release = threading.Event()
+    pool = WorkerPool(
+        lambda event: release.wait(5),
+        worker_count=1,
+        queue_size=100,
+        partition_key=lambda event: event['key'],
+        partition_size=2,
+    )
+    results = [pool.submit({'key': 'noisy'}) for _ in range(10)]
+    assert not all(results)
+    assert pool.submit({'key': 'quiet'})
+    release.set()
+    pool.shutdown(timeout=5)
+
+
+def test_worker_pool_retries_at_the_head_of_the_partition():
+    processed = []
+    failed = set()
+    pool = None
+
+    def handler(event):
+        if event['id'] == 0 and event['id'] not in failed:
+            failed.add(event['id'])
+            time.sleep(0.05)  # the next events of the partition are queued meanwhile
+            pool.retry(event)
+            return
+        processed.append(event['id'])
+
+    pool = WorkerPool(
+        handler, worker_count=4, queue_size=3, partition_key=lambda event: event['key']
+    )
+    for i in range(3):
+        assert pool.submit({'key': 'mr', 'id': i})
+    pool.shutdown(timeout=5)
+    assert processed == [0, 1, 2]
+
+
+def test_worker_pool_delays_retries():
+    processed = []
+    pool = None
+
+    def handler(event):
+        processed.append((event['id'], time.monotonic()))
+        if event['id'] == 0 and len(processed) == 1:
+            pool.retry(event, delay=0.1)
+
+    pool = WorkerPool(
+        handler, worker_count=2, queue_size=10, partition_key=lambda event: event['key']
+    )
+    assert pool.submit({'key': 'mr', 'id': 0})
+    assert pool.submit({'key': 'mr', 'id': 1})
+    assert pool.submit({'key': 'other', 'id': 2})
+    time.sleep(0.05)
+    # the other partitions aren't delayed
+    assert sorted(event_id for event_id, _ in processed) == [0, 2]
+    time.sleep(0.2)
+    assert [event_id for event_id, _ in processed if event_id != 2] == [0, 0, 1]
+    assert processed[-1][1] - processed[0][1] >= 0.1
+    pool.shutdown(timeout=5)
+
+
+def test_worker_pool_does_not_delay_retries_on_shutdown():
+    processed = []
+    pool = None
+
+    def handler(event):
+        processed.append(event['id'])
+        if len(processed) == 1:
+            pool.retry(event, delay=60)
+
+    pool = WorkerPool(handler, worker_count=1, queue_size=10)
+    assert pool.submit({'id': 0})
+    time.sleep(0.05)
+    start = time.monotonic()
+    pool.shutdown(timeout=5)
+    assert processed == [0, 0]
+    assert time.monotonic() - start < 1